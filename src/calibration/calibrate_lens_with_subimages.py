@@ -57,7 +57,7 @@ import scipy.optimize
 from pigazing_helpers import connect_db, hardware_properties
 from pigazing_helpers.dcf_ast import date_string
 from pigazing_helpers.gnomonic_project import gnomonic_project
-from pigazing_helpers.obsarchive import obsarchive_model as mp, obsarchive_db, obsarchive_sky_area
+from pigazing_helpers.obsarchive import obsarchive_model as mp, obsarchive_db, file_store, obsarchive_sky_area
 from pigazing_helpers.settings_read import settings, installation_info
 
 degrees = pi / 180
@@ -317,7 +317,7 @@ ORDER BY am.floatValue DESC LIMIT 1
         estimated_image_scale = lens_props.fov
 
         # Find image orientation orientation
-        filename = os.path.join(settings['dbFilestore'], item['repositoryFname'])
+        filename = file_store.file_path(settings['dbFilestore'], item['repositoryFname'])
 
         if not os.path.exists(filename):
             logging.info("Error: File <{}> is missing!".format(item['repositoryFname']))
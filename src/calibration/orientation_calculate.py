@@ -53,7 +53,7 @@ import numpy as np
 from PIL import Image
 from pigazing_helpers import connect_db, gnomonic_project, hardware_properties
 from pigazing_helpers.dcf_ast import date_string, ra_dec_from_j2000, ra_dec_to_j2000
-from pigazing_helpers.obsarchive import obsarchive_model as mp, obsarchive_db, obsarchive_sky_area
+from pigazing_helpers.obsarchive import obsarchive_model as mp, obsarchive_db, file_store, obsarchive_sky_area
 from pigazing_helpers.obsarchive.obsarchive_sky_area import get_sky_area
 from pigazing_helpers.settings_read import settings, installation_info
 from pigazing_helpers.sunset_times import alt_az, get_zenith_position
@@ -417,7 +417,7 @@ def analyse_image(item_index, item, utc_must_stop, batch_size, fraction_x, fract
     os.system("mkdir {}".format(tmp))
 
     # Find image's full path
-    filename = os.path.join(settings['dbFilestore'], item['repositoryFname'])
+    filename = file_store.file_path(settings['dbFilestore'], item['repositoryFname'])
 
     # Make sure that image actually exists in the file repository
     if not os.path.exists(filename):
@@ -650,7 +650,7 @@ WHERE publicId=%s;
                   camera_tilt))
 
     # Find image's full path
-    filename = os.path.join(settings['dbFilestore'], item['repositoryFname'])
+    filename = file_store.file_path(settings['dbFilestore'], item['repositoryFname'])
 
     # Estimate quality of fit
     fit_quality = estimate_fit_quality(
@@ -40,7 +40,7 @@ import numpy as np
 from pigazing_helpers import connect_db, hardware_properties
 from pigazing_helpers.dcf_ast import date_string
 from pigazing_helpers.gnomonic_project import ang_dist
-from pigazing_helpers.obsarchive import obsarchive_model as mp, obsarchive_db
+from pigazing_helpers.obsarchive import obsarchive_model as mp, obsarchive_db, file_store
 from pigazing_helpers.path_projection import PathProjection
 from pigazing_helpers.settings_read import settings, installation_info
 from pigazing_helpers.sunset_times import mean_angle, mean_angle_2d
@@ -390,7 +390,7 @@ WHERE ao.obsTime BETWEEN %s AND %s
         }
 
         # Find image's full path
-        filename = os.path.join(settings['dbFilestore'], item['repositoryFname'])
+        filename = file_store.file_path(settings['dbFilestore'], item['repositoryFname'])
 
         # Estimate quality of fit
         fit_quality = estimate_fit_quality(
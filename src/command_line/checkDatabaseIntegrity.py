@@ -23,18 +23,256 @@
 
 
 """
-Checks for missing files
+Checks for files which are missing from the file store, files in the file store with no database record, and
+observations with no files. Optionally, also checks the MD5 checksums of files against the database. The checksums
+of files which have been verified are recorded in a checkpoint file, so that subsequent runs only need to read files
+which have changed since they were last verified.
 """
 
-import glob
+import argparse
+import hashlib
 import logging
 import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-from pigazing_helpers.obsarchive import obsarchive_db
+from pigazing_helpers.obsarchive import file_store, obsarchive_db
 from pigazing_helpers.settings_read import settings, installation_info
 
+# Number of files to verify between commits of the checkpoint file, so that an interrupted run loses little work
+checkpoint_interval = 1000
 
-def check_database_integrity(purge=False):
+
+class IoBudget(object):
+    """
+    Limits the rate at which a pool of threads reads data from disk, so that verifying checksums does not starve the
+    observing code of disk bandwidth.
+    """
+
+    def __init__(self, bytes_per_second):
+        """
+        Create a new I/O budget.
+
+        :param float bytes_per_second:
+            The maximum total rate at which data may be read, or zero for no limit
+        """
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._available_at = time.monotonic()
+
+    def consume(self, byte_count):
+        """
+        Wait until we are allowed to have read <byte_count> bytes.
+
+        :param int byte_count:
+            The number of bytes which have been read
+        :return:
+            None
+        """
+        if self.bytes_per_second <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._available_at, now)
+            self._available_at = start + byte_count / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+def scan_directory(dir_path):
+    """
+    List the contents of a single directory in the file store.
+
+    :param string dir_path:
+        The path of the directory
+    :return:
+        List of (filename, path, size, mtime in ns) tuples for the files in the directory, and a list of the paths of
+        its subdirectories
+    """
+    files = []
+    subdirectories = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file():
+                if entry.name.startswith(file_store.layout_marker_filename) or entry.name.endswith(".tmp"):
+                    continue
+                stat = entry.stat()
+                files.append((entry.name, entry.path, stat.st_size, stat.st_mtime_ns))
+    return files, subdirectories
+
+
+def scan_file_store(file_store_path, threads):
+    """
+    List all of the files in the file store, scanning its subdirectories in parallel.
+
+    :param string file_store_path:
+        The path of the file store
+    :param int threads:
+        The number of directories to scan at once
+    :return:
+        Dictionary of (path, size, mtime in ns) tuples, indexed by filename
+    """
+    # Content-addressed blobs are hard links to files elsewhere in the file store, so are not listed. Files in cold
+    # storage are checked separately.
+    skipped_directories = (os.path.join(file_store_path, file_store.blob_directory),
+                           os.path.join(file_store_path, file_store.cold_directory))
+
+    store_files = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(scan_directory, file_store_path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirectories = future.result()
+                for filename, file_path, size, mtime in files:
+                    if filename in store_files:
+                        logging.info("Files: File stored twice <{}> and <{}>".format(store_files[filename][0],
+                                                                                   file_path))
+                        continue
+                    store_files[filename] = (file_path, size, mtime)
+                pending.update(executor.submit(scan_directory, dir_path) for dir_path in subdirectories
+                               if dir_path not in skipped_directories)
+    return store_files
+
+
+def md5_file(file_path, io_budget):
+    """
+    Calculate the MD5 checksum of a file, reading it no faster than <io_budget> allows.
+
+    :param string file_path:
+        The path of the file
+    :param IoBudget io_budget:
+        The I/O budget shared by all of the threads verifying checksums
+    :return:
+        The hex representation of the MD5 checksum of the file
+    """
+    checksum = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(file_store.copy_chunk_size), b''):
+            checksum.update(chunk)
+            io_budget.consume(len(chunk))
+    return checksum.hexdigest()
+
+
+def open_checkpoint(checkpoint_path):
+    """
+    Open the checkpoint file which records the checksums of the files which have already been verified.
+
+    :param string checkpoint_path:
+        The path of the checkpoint file
+    :return:
+        A :class:`sqlite3.Connection`
+    """
+    checkpoint = sqlite3.connect(checkpoint_path)
+    checkpoint.execute("""
+CREATE TABLE IF NOT EXISTS verified_files (
+    repositoryFname TEXT PRIMARY KEY,
+    fileSize INTEGER,
+    mtimeNs INTEGER,
+    fileMD5 TEXT,
+    verifiedTime REAL
+);""")
+    return checkpoint
+
+
+def verify_checksums(db_files, store_files, checkpoint, threads, io_budget, full):
+    """
+    Check the MD5 checksums of the files in the file store against the database. Files whose size and modification
+    time have not changed since they were last verified are not read again, unless <full> is set.
+
+    :param dict db_files:
+        Dictionary of database records for files, indexed by repositoryFname
+    :param dict store_files:
+        Dictionary of files in the file store, as returned by :meth:`scan_file_store`
+    :param checkpoint:
+        The :class:`sqlite3.Connection` returned by :meth:`open_checkpoint`
+    :param int threads:
+        The number of files to read at once
+    :param IoBudget io_budget:
+        The maximum rate at which to read data
+    :param bool full:
+        If true, read every file, ignoring the checkpoint
+    :return:
+        List of the repositoryFnames of files whose checksums do not match the database
+    """
+    previous = {}
+    if not full:
+        for repository_fname, size, mtime, file_md5 in checkpoint.execute(
+                "SELECT repositoryFname, fileSize, mtimeNs, fileMD5 FROM verified_files;"):
+            previous[repository_fname] = (size, mtime, file_md5)
+
+    # Work out which files have changed since they were last verified
+    mismatches = []
+    to_read = []
+    for repository_fname, (file_path, size, mtime) in store_files.items():
+        record = db_files.get(repository_fname, None)
+        if record is None:
+            continue
+        known = previous.get(repository_fname, None)
+        if known is not None and known[0] == size and known[1] == mtime:
+            if known[2] != record['fileMD5']:
+                mismatches.append(repository_fname)
+            continue
+        to_read.append((repository_fname, file_path, size, mtime))
+
+    logging.info("Verifying checksums of {:d} files ({:d} unchanged since last verified)...".format(
+        len(to_read), len(store_files) - len(to_read)))
+
+    # Read files on a pool of threads. The checkpoint is only written from this thread.
+    verified = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(md5_file, file_path, io_budget): (repository_fname, size, mtime)
+                   for repository_fname, file_path, size, mtime in to_read}
+        for future in as_completed(futures):
+            repository_fname, size, mtime = futures[future]
+            try:
+                file_md5 = future.result()
+            except OSError:
+                logging.info("Files: Could not read file ID <{}>".format(repository_fname))
+                continue
+            if file_md5 != db_files[repository_fname]['fileMD5']:
+                mismatches.append(repository_fname)
+            checkpoint.execute("REPLACE INTO verified_files VALUES (?, ?, ?, ?, ?);",
+                               (repository_fname, size, mtime, file_md5, time.time()))
+            verified += 1
+            if verified % checkpoint_interval == 0:
+                checkpoint.commit()
+                logging.info("Verified {:d} files".format(verified))
+
+    # Forget files which are no longer in the database
+    stale = [(repository_fname,) for repository_fname in previous if repository_fname not in db_files]
+    checkpoint.executemany("DELETE FROM verified_files WHERE repositoryFname=?;", stale)
+    checkpoint.commit()
+
+    for repository_fname in mismatches:
+        logging.info("Files: Checksum mismatch for file ID <{}>".format(repository_fname))
+    return mismatches
+
+
+def check_database_integrity(purge=False, verify_md5=False, threads=4, io_budget_mb=20, checkpoint_path=None,
+                             full=False):
+    """
+    Check that the database and file store agree with one another.
+
+    :param bool purge:
+        If true, delete the database records of missing files, and of observations with no files
+    :param bool verify_md5:
+        If true, check the MD5 checksums of files against the database
+    :param int threads:
+        The number of threads used to scan the file store and verify checksums
+    :param float io_budget_mb:
+        The maximum rate, in MB/sec, at which files are read when verifying checksums, or zero for no limit
+    :param string checkpoint_path:
+        The path of the file which records which files have already been verified
+    :param bool full:
+        If true, verify the checksums of all files, including those which have not changed since the last run
+    :return:
+        None
+    """
     # Open connection to image archive
     db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
                                            db_host=installation_info['mysqlHost'],
@@ -44,34 +282,67 @@ def check_database_integrity(purge=False):
                                            obstory_id=installation_info['observatoryId'])
     sql = db.con
 
+    # List the files in the database and the file store, and compare the two
+    logging.info("Listing files in database...")
+    sql.execute("SELECT f.uid, f.repositoryFname, f.fileTime, f.fileSize, f.fileMD5, f.observationId, o.observatory, "
+                "c.fileId IS NOT NULL AS isCold, c.compression "
+                "FROM archive_files f INNER JOIN archive_observations o ON f.observationId=o.uid "
+                "LEFT OUTER JOIN archive_coldFiles c ON c.fileId=f.uid;")
+    db_files = {item['repositoryFname']: item for item in sql.fetchall()}
+
+    logging.info("Listing files in file store...")
+    store_files = scan_file_store(file_store_path=db.file_store_path, threads=threads)
+    logging.info("{:d} files in database; {:d} files in file store".format(len(db_files), len(store_files)))
+
     # Check files exist
-    file_list = {}
-    logging.info("Checking whether files exist...")
-    sql.execute("SELECT repositoryFname FROM archive_files;")
-    for item in sql.fetchall():
-        id = item['repositoryFname']
-        file_list[id] = True
-        if not os.path.exists(db.file_path_for_id(id)):
-            logging.info("Files: Missing file ID <{}>".format(id))
-
-            if purge:
-                sql.execute("DELETE FROM archive_files WHERE repositoryFname=%s;", (id,))
+    missing = sorted(repository_fname for repository_fname in set(db_files) - set(store_files)
+                     if not (db_files[repository_fname]['isCold'] and os.path.exists(file_store.cold_path(
+                         file_store_path=db.file_store_path, repository_fname=repository_fname,
+                         compression=db_files[repository_fname]['compression']))))
+    for repository_fname in missing:
+        logging.info("Files: Missing file ID <{}>".format(repository_fname))
 
     # Check for files which aren't in database
-    logging.info("Checking for files with no database record...")
-    for item in glob.glob(os.path.join(db.file_store_path, "*")):
-        filename = os.path.split(item)[1]
-        if filename not in file_list:
-            logging.info("Files: File not in database <{}>".format(filename))
+    for repository_fname in sorted(set(store_files) - set(db_files)):
+        logging.info("Files: File not in database <{}>".format(store_files[repository_fname][0]))
+
+    # Check that files are the right size
+    for repository_fname, (file_path, size, mtime) in sorted(store_files.items()):
+        record = db_files.get(repository_fname, None)
+        if record is not None and record['fileSize'] != size:
+            logging.info("Files: File ID <{}> has size {:d}, but database says {:d}".format(
+                repository_fname, size, record['fileSize']))
+
+    # Check checksums
+    if verify_md5:
+        if checkpoint_path is None:
+            checkpoint_path = os.path.join(settings['dataPath'], "integrity_checkpoint.sqlite")
+        checkpoint = open_checkpoint(checkpoint_path=checkpoint_path)
+        verify_checksums(db_files=db_files, store_files=store_files, checkpoint=checkpoint, threads=threads,
+                         io_budget=IoBudget(bytes_per_second=io_budget_mb * 1e6), full=full)
+        checkpoint.close()
+
+    if purge and missing:
+        records = [db_files[repository_fname] for repository_fname in missing]
+        for batch in db.generators._batches([item['uid'] for item in records], db.generators.batch_size):
+            sql.execute("DELETE FROM archive_files WHERE uid IN ({});".format(",".join(["%s"] * len(batch))), batch)
+        db.refresh_file_usage(buckets=[(item['observatory'], item['fileTime']) for item in records])
+        db.refresh_event_summary(observation_uids=[item['observationId'] for item in records])
 
     # Checking for observations with no files
     logging.info("Checking for observations with no files...")
-    sql.execute("SELECT publicId FROM archive_observations WHERE uid NOT IN (SELECT observationId FROM archive_files)")
-    for item in sql.fetchall():
+    sql.execute("SELECT uid, publicId, observatory, obsTime FROM archive_observations "
+                "WHERE uid NOT IN (SELECT observationId FROM archive_files)")
+    empty_observations = sql.fetchall()
+    for item in empty_observations:
         logging.info("Files: Observation with no files <{}>".format(item['publicId']))
 
-        if purge:
-            sql.execute("DELETE FROM archive_observations WHERE publicId=%s;", (item['publicId'],))
+    if purge and empty_observations:
+        for batch in db.generators._batches([item['uid'] for item in empty_observations],
+                                            db.generators.batch_size):
+            sql.execute("DELETE FROM archive_observations WHERE uid IN ({});".format(",".join(["%s"] * len(batch))),
+                        batch)
+        db.refresh_activity(buckets=[(item['observatory'], item['obsTime']) for item in empty_observations])
 
     # Commit changes to database
     db.commit()
@@ -79,4 +350,33 @@ def check_database_integrity(purge=False):
 
 
 if __name__ == "__main__":
-    check_database_integrity()
+    # Read commandline arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--purge', dest='purge', action='store_true',
+                        help="Delete the database records of missing files, and of observations with no files")
+    parser.add_argument('--verify-md5', dest='verify_md5', action='store_true',
+                        help="Check the MD5 checksums of files against the database")
+    parser.add_argument('--full', dest='full', action='store_true',
+                        help="Verify the checksums of all files, not only those which have changed since the last run")
+    parser.add_argument('--threads', dest='threads', default=4, type=int,
+                        help="Number of threads used to scan the file store and verify checksums")
+    parser.add_argument('--io-budget', dest='io_budget', default=20, type=float,
+                        help="Maximum rate, in MB/sec, at which to read files when verifying checksums. "
+                             "Zero means no limit.")
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None,
+                        help="File in which to record which files have been verified")
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S',
+                        handlers=[
+                            logging.FileHandler(os.path.join(settings['pythonPath'], "../datadir/pigazing.log")),
+                            logging.StreamHandler()
+                        ])
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    check_database_integrity(purge=args.purge, verify_md5=args.verify_md5, threads=args.threads,
+                             io_budget_mb=args.io_budget, checkpoint_path=args.checkpoint, full=args.full)
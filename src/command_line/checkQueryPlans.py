@@ -0,0 +1,194 @@
+#!../../datadir/virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+# checkQueryPlans.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Run EXPLAIN on the SQL generated for a set of representative searches of the observation archive, and check that
+MySQL answers each of them from indexes, rather than by scanning entire tables. Exits with a non-zero status if any
+query plan has regressed.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+from pigazing_helpers.obsarchive import obsarchive_db
+from pigazing_helpers.obsarchive import obsarchive_model as mp
+from pigazing_helpers.obsarchive.sql_builder import search_observations_sql_builder, search_files_sql_builder, \
+    search_obsgroups_sql_builder
+from pigazing_helpers.settings_read import settings, installation_info
+
+# Tables which grow with the size of the archive, and which must never be scanned in full
+large_tables = ('archive_observations', 'archive_files', 'archive_metadata', 'archive_obs_groups')
+
+
+def representative_searches(utc, metadata_key_id):
+    """
+    Build a list of representative searches, similar to those made by the web interface and by analysis scripts.
+
+    :param utc:
+        The unix time at the end of the period to search
+    :param metadata_key_id:
+        Function used to resolve the uids of metadata keys, as passed to SQLBuilder by obsarchive_db
+    :return:
+        List of [description, SQLBuilder, columns, order] lists
+    """
+    month = 30 * 86400
+
+    meteors_search = mp.ObservationSearch(observation_type='pigazing:movingObject/',
+                                          time_min=utc - month, time_max=utc,
+                                          meta_constraints=[mp.MetaConstraint(constraint_type='greater',
+                                                                              key='pigazing:amplitudePeak',
+                                                                              value=5000)])
+    classified_search = mp.ObservationSearch(time_min=utc - month, time_max=utc,
+                                             meta_constraints=[mp.MetaConstraint(constraint_type='string_equals',
+                                                                                 key='web:category',
+                                                                                 value='Meteor')])
+    keyset_search = mp.ObservationSearch(time_min=utc - month, time_max=utc,
+                                         continuation=mp.encode_continuation_token(utc - month / 2, 1))
+    clear_sky_search = mp.FileRecordSearch(semantic_type='pigazing:timelapse/backgroundSubtracted',
+                                           time_min=utc - month, time_max=utc,
+                                           meta_constraints=[mp.MetaConstraint(constraint_type='greater',
+                                                                               key='pigazing:skyClarity',
+                                                                               value=20)])
+    group_search = mp.ObservationGroupSearch(time_min=utc - month, time_max=utc,
+                                             meta_constraints=[mp.MetaConstraint(constraint_type='number_equals',
+                                                                                 key='pigazing:triangulation/'
+                                                                                     'detectionCount',
+                                                                                 value=2)])
+
+    return [
+        ["Moving objects this month with amplitudePeak > 5000",
+         search_observations_sql_builder(meteors_search, metadata_key_id=metadata_key_id),
+         'o.uid', 'o.obsTime DESC, o.uid DESC'],
+        ["Observations this month classified as meteors",
+         search_observations_sql_builder(classified_search, metadata_key_id=metadata_key_id),
+         'o.uid', 'o.obsTime DESC, o.uid DESC'],
+        ["Page of observations after a continuation token",
+         search_observations_sql_builder(keyset_search, metadata_key_id=metadata_key_id),
+         'o.uid', 'o.obsTime DESC, o.uid DESC'],
+        ["Time-lapse images this month with skyClarity > 20",
+         search_files_sql_builder(clear_sky_search, metadata_key_id=metadata_key_id),
+         'f.uid', 'f.fileTime DESC, f.uid DESC'],
+        ["Observation groups this month with two detections",
+         search_obsgroups_sql_builder(group_search, metadata_key_id=metadata_key_id),
+         'g.uid', 'g.time DESC']
+    ]
+
+
+def plan_problems(plan, table_aliases):
+    """
+    Inspect the rows returned by EXPLAIN, and list any steps which scan a large table in its entirety.
+
+    :param plan:
+        List of rows returned by EXPLAIN
+    :param table_aliases:
+        Dictionary of the names of tables, indexed by the aliases used in the query
+    :return:
+        List of strings describing problems with the plan
+    """
+    problems = []
+    for step in plan:
+        table = table_aliases.get(step['table'], step['table'])
+        if table not in large_tables:
+            continue
+        if step['type'] in ('ALL', 'index'):
+            problems.append("Full scan of <{}> (alias <{}>, select type <{}>)".format(table, step['table'],
+                                                                                       step['select_type']))
+    return problems
+
+
+def check_query_plans(utc, verbose):
+    """
+    Run EXPLAIN on each of the representative searches, and report any regressions.
+
+    :param utc:
+        The unix time at the end of the period to search
+    :param verbose:
+        If true, display the full query plan for each search
+    :return:
+        The number of searches whose query plans scan large tables in their entirety
+    """
+    # Open connection to image archive
+    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                           db_host=installation_info['mysqlHost'],
+                                           db_user=installation_info['mysqlUser'],
+                                           db_password=installation_info['mysqlPassword'],
+                                           db_name=installation_info['mysqlDatabase'],
+                                           obstory_id=installation_info['observatoryId'])
+
+    # Aliases used for tables within the SQL generated by SQLBuilder
+    table_aliases = {'o': 'archive_observations', 'f': 'archive_files', 'm': 'archive_metadata',
+                     'g': 'archive_obs_groups'}
+
+    failures = 0
+    for description, builder, columns, order in representative_searches(utc=utc,
+                                                                         metadata_key_id=db.get_metadata_key_id):
+        sql = builder.get_select_sql(columns=columns, order=order, limit=100)
+        db.con.execute("EXPLAIN " + sql, builder.sql_args)
+        plan = db.con.fetchall()
+
+        problems = plan_problems(plan=plan, table_aliases=table_aliases)
+        logging.info("{:s} {:s}".format("FAIL" if problems else "OK  ", description))
+        for problem in problems:
+            logging.info("       {}".format(problem))
+        if verbose or problems:
+            for step in plan:
+                logging.info("       {select_type:18s} {table!s:10s} {type!s:8s} key={key!s:24s} "
+                             "rows={rows!s:8s} {Extra!s}".format(**step))
+        if problems:
+            failures += 1
+
+    # Close database handle
+    db.close_db()
+    return failures
+
+
+if __name__ == "__main__":
+    # Read input parameters
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--utc',
+                        dest='utc',
+                        default=time.time(),
+                        type=float,
+                        help="Unix time at the end of the period searched")
+    parser.add_argument('--verbose',
+                        dest='verbose',
+                        action='store_true',
+                        help="Display the query plan for every search, not only those which fail")
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S',
+                        handlers=[
+                            logging.FileHandler(os.path.join(settings['pythonPath'], "../datadir/pigazing.log")),
+                            logging.StreamHandler()
+                        ])
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    failure_count = check_query_plans(utc=args.utc, verbose=args.verbose)
+    sys.exit(1 if failure_count > 0 else 0)
@@ -29,8 +29,8 @@ import argparse
 import logging
 import os
 
-from pigazing_helpers import connect_db
-from pigazing_helpers.settings_read import settings
+from pigazing_helpers.obsarchive import obsarchive_db
+from pigazing_helpers.settings_read import settings, installation_info
 
 
 def delete_observation(id, dry_run):
@@ -46,12 +46,20 @@ def delete_observation(id, dry_run):
     :return:
         None
     """
-    # Open connection to database
-    [db0, conn] = connect_db.connect_db()
+    # Open connection to image archive
+    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                           db_host=installation_info['mysqlHost'],
+                                           db_user=installation_info['mysqlUser'],
+                                           db_password=installation_info['mysqlPassword'],
+                                           db_name=installation_info['mysqlDatabase'],
+                                           obstory_id=installation_info['observatoryId'])
+
+    # Open direct connection to database
+    conn = db.con
 
     # Search for observation
     conn.execute("""
-SELECT o.uid
+SELECT o.uid, o.observatory, o.obsTime
 FROM archive_observations o
 WHERE o.publicId=%s;
 """, (id,))
@@ -61,7 +69,7 @@ WHERE o.publicId=%s;
     for observation in results_observations:
         # Search for files
         conn.execute("""
-    SELECT f.uid, f.repositoryFname
+    SELECT f.uid, f.repositoryFname, f.fileTime
     FROM archive_files f
     WHERE f.observationId=%s
     """, (observation['uid'],))
@@ -72,22 +80,18 @@ WHERE o.publicId=%s;
 
             logging.info("Deleting file <{}>".format(file['repositoryFname']))
 
-            # Delete files
-            if not dry_run:
-                os.unlink(os.path.join(settings['dbFilestore'], file['repositoryFname']))
-
-            # Delete file record
+            # Delete file and its record, wherever it is stored
             if not dry_run:
-                conn.execute("DELETE FROM archive_files WHERE uid=%s", (file['uid'],))
+                db.delete_file(repository_fname=file['repositoryFname'])
 
         # Delete observation
         if not dry_run:
             conn.execute("DELETE FROM archive_observations WHERE uid=%s", (observation['uid'],))
+            db.refresh_activity(buckets=[(observation['observatory'], observation['obsTime'])])
 
     # Commit changes to database
-    db0.commit()
-    conn.close()
-    db0.close()
+    db.commit()
+    db.close_db()
 
 
 if __name__ == "__main__":
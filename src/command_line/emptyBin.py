@@ -56,7 +56,8 @@ def empty_bin(dry_run):
 
     # Search for observations
     conn.execute("""
-SELECT f.repositoryFname, f.fileSize, s.name AS semantic, o.publicId AS obs_id
+SELECT f.repositoryFname, f.fileSize, f.fileTime, s.name AS semantic, o.publicId AS obs_id, o.uid AS obs_uid,
+       o.observatory
 FROM archive_files f
 INNER JOIN archive_observations o ON f.observationId = o.uid
 INNER JOIN archive_semanticTypes s ON f.semanticType = s.uid
@@ -121,13 +122,9 @@ WHERE o.publicId=%s;
                                                 )
                                                 )
 
-        # Delete file
+        # Delete file and its record, wherever it is stored
         if not dry_run:
-            os.unlink(os.path.join(settings['dbFilestore'], observation['repositoryFname']))
-
-        # Delete file record
-        if not dry_run:
-            conn.execute("DELETE FROM archive_files WHERE repositoryFname=%s", (observation['repositoryFname'],))
+            db.delete_file(repository_fname=observation['repositoryFname'])
 
     # Report how much disk space we saved
     logging.info("Total storage saved: {:.3f} GB".format(total_file_size / 1e9))
@@ -73,25 +73,17 @@ def list_disk_usage(utc_min, utc_max):
 
     file_census = {}
 
-    # Get list of files in each directory
-    db.con.execute("""
-SELECT f.mimeType, f.fileTime, f.fileSize, ot.name AS semanticType
-FROM archive_files f
-INNER JOIN archive_observations o on f.observationId = o.uid
-INNER JOIN archive_semanticTypes ot on o.obsType = ot.uid
-WHERE f.fileTime BETWEEN %s AND %s;
-""", (utc_min, utc_max))
-
-    # Process each file in turn
-    for item in db.con.fetchall():
-        file_type = item['semanticType']  # item['mimeType']
-        date = dcf_ast.inv_julian_day(dcf_ast.jd_from_unix(item['fileTime']))
+    # Fetch the total size of the files of each type recorded each day, from the hourly rollup table
+    # <archive_fileUsageHourly>
+    for item in db.get_file_usage(utc_min=utc_min, utc_max=utc_max, period=86400):
+        file_type = item['obs_type']
+        date = dcf_ast.inv_julian_day(dcf_ast.jd_from_unix(item['time'] + 1))
         date_str = "{:04d} {:02d} {:02d}".format(date[0], date[1], date[2])
         if file_type not in file_census:
             file_census[file_type] = {}
         if date_str not in file_census[file_type]:
             file_census[file_type][date_str] = 0
-        file_census[file_type][date_str] += item['fileSize']
+        file_census[file_type][date_str] += item['total_bytes']
 
     # Render quick and dirty table
     out = sys.stdout
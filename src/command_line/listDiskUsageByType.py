@@ -58,23 +58,18 @@ def list_disk_usage(utc_min, utc_max):
 
     file_census = {}
 
-    # Get list of files in each directory
+    # Sum the sizes of the files of each category of moving object, using the category stored in the table
+    # <archive_event_summary>
     db.con.execute("""
-SELECT f.mimeType, f.fileTime, f.fileSize, ot.name AS semanticType, am.stringValue AS web_type
-FROM archive_files f
-INNER JOIN archive_observations o on f.observationId = o.uid
-INNER JOIN archive_semanticTypes ot on o.obsType = ot.uid
-INNER JOIN archive_metadata am on o.uid = am.observationId
-    AND am.fieldId=(SELECT x.uid FROM archive_metadataFields x WHERE x.metaKey="web:category")
-WHERE f.fileTime BETWEEN %s AND %s;
+SELECT es.category AS web_type, SUM(f.fileSize) AS total_bytes
+FROM archive_event_summary es
+INNER JOIN archive_files f ON f.observationId = es.observationId
+WHERE es.category IS NOT NULL AND f.fileTime BETWEEN %s AND %s
+GROUP BY es.category;
 """, (utc_min, utc_max))
 
-    # Process each file in turn
     for item in db.con.fetchall():
-        file_type = item['web_type']
-        if file_type not in file_census:
-            file_census[file_type] = 0
-        file_census[file_type] += item['fileSize']
+        file_census[item['web_type']] = int(item['total_bytes'])
 
     # Render quick and dirty table
     out = sys.stdout
@@ -0,0 +1,175 @@
+#!../../datadir/virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+# moveToColdStorage.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Move old files out of the file store into cold storage, which is the directory <cold> within the file store. This
+may be a symlink to a larger, slower volume. Files in cold storage remain available through the web interface: those
+stored uncompressed are served directly from cold storage, and compressed ones are restored on first access.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+from pigazing_helpers.obsarchive import file_store, obsarchive_db
+from pigazing_helpers.settings_read import settings, installation_info
+
+# MIME types of files which are already compressed, and which are therefore never compressed in cold storage
+precompressed_mime_types = ('video/mp4', 'image/png', 'image/jpeg', 'image/gif')
+
+
+def move_to_cold_storage(age, semantic_type, compression, limit, dry_run):
+    """
+    Move files older than <age> days into cold storage.
+
+    :param float age:
+        The minimum age, in days, of the files to move
+    :param string semantic_type:
+        The semantic type of the files to move, or None to move files of all types
+    :param string compression:
+        The compression to apply to files which are not already compressed, or None
+    :param int limit:
+        The maximum number of files to move, or zero for no limit
+    :param bool dry_run:
+        If true, list the files which would be moved, without moving them
+    :return:
+        None
+    """
+    # Open connection to image archive
+    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                           db_host=installation_info['mysqlHost'],
+                                           db_user=installation_info['mysqlUser'],
+                                           db_password=installation_info['mysqlPassword'],
+                                           db_name=installation_info['mysqlDatabase'],
+                                           obstory_id=installation_info['observatoryId'])
+
+    # Search for files which are not yet in cold storage
+    constraints = ["f.fileTime < %s"]
+    constraint_values = [time.time() - age * 86400]
+    if semantic_type is not None:
+        constraints.append("s.name = %s")
+        constraint_values.append(semantic_type)
+    db.con.execute("""
+SELECT f.repositoryFname, f.fileSize, f.mimeType
+FROM archive_files f
+INNER JOIN archive_semanticTypes s ON f.semanticType = s.uid
+WHERE f.uid NOT IN (SELECT fileId FROM archive_coldFiles) AND {}
+ORDER BY f.fileTime{};
+""".format(" AND ".join(constraints), " LIMIT {:d}".format(limit) if limit else ""), constraint_values)
+    results = db.con.fetchall()
+
+    # Move each file in turn
+    moved = 0
+    hot_bytes = 0
+    cold_bytes = 0
+    for item in results:
+        file_compression = compression if item['mimeType'] not in precompressed_mime_types else None
+
+        if dry_run:
+            logging.info("Would move <{}> into cold storage".format(item['repositoryFname']))
+            moved += 1
+            hot_bytes += item['fileSize']
+            continue
+
+        try:
+            stored_size = db.freeze_file(repository_fname=item['repositoryFname'], compression=file_compression)
+        except (OSError, ValueError):
+            logging.info("Could not move <{}> into cold storage: {}".format(item['repositoryFname'],
+                                                                            sys.exc_info()[1]))
+            continue
+        if stored_size is None:
+            continue
+
+        moved += 1
+        hot_bytes += item['fileSize']
+        cold_bytes += stored_size
+        if moved % 1000 == 0:
+            logging.info("Moved {:d} files".format(moved))
+
+    logging.info("Moved {:d} files into cold storage.".format(moved))
+    logging.info("Freed {:.3f} GB in the file store, using {:.3f} GB of cold storage.".format(hot_bytes / 1e9,
+                                                                                             cold_bytes / 1e9))
+
+    # Close database handle
+    db.close_db()
+
+
+def restore_from_cold_storage(repository_fnames):
+    """
+    Move files back from cold storage into the file store.
+
+    :param list repository_fnames:
+        The IDs of the files to restore
+    :return:
+        None
+    """
+    # Open connection to image archive
+    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                           db_host=installation_info['mysqlHost'],
+                                           db_user=installation_info['mysqlUser'],
+                                           db_password=installation_info['mysqlPassword'],
+                                           db_name=installation_info['mysqlDatabase'],
+                                           obstory_id=installation_info['observatoryId'])
+
+    for repository_fname in repository_fnames:
+        logging.info("Restoring <{}> to <{}>".format(repository_fname, db.restore_file(repository_fname)))
+
+    # Close database handle
+    db.close_db()
+
+
+if __name__ == "__main__":
+    # Read commandline arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--age', dest='age', default=90, type=float,
+                        help="Move files which are older than this number of days")
+    parser.add_argument('--semantic-type', dest='semantic_type', default=None,
+                        help="Only move files of this semantic type, e.g. pigazing:movingObject/video")
+    parser.add_argument('--compress', dest='compression', default=None, choices=sorted(file_store.compressions),
+                        help="Compress files which are not already compressed")
+    parser.add_argument('--limit', dest='limit', default=0, type=int,
+                        help="The maximum number of files to move in this run")
+    parser.add_argument('--restore', dest='restore', nargs='+', default=None,
+                        help="Move the files with these IDs back from cold storage, instead of moving old files")
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help="List the files which would be moved, without moving them")
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S',
+                        handlers=[
+                            logging.FileHandler(os.path.join(settings['pythonPath'], "../datadir/pigazing.log")),
+                            logging.StreamHandler()
+                        ])
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    if args.restore:
+        restore_from_cold_storage(repository_fnames=args.restore)
+    else:
+        move_to_cold_storage(age=args.age, semantic_type=args.semantic_type, compression=args.compression,
+                             limit=args.limit, dry_run=args.dry_run)
@@ -0,0 +1,81 @@
+#!../../datadir/virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+# rebuildEventSummary.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Rebuild the table <archive_event_summary>, which holds the metadata about moving objects that is used by the scripts
+which analyse them. This table is kept up to date automatically, but needs to be rebuilt after it is first created
+in an existing database, or if metadata have been edited directly in SQL.
+"""
+
+import argparse
+import logging
+import os
+
+from pigazing_helpers.obsarchive import obsarchive_db
+from pigazing_helpers.settings_read import settings, installation_info
+
+
+def rebuild_event_summary():
+    """
+    Recompute every row of the table <archive_event_summary>.
+
+    :return:
+        None
+    """
+    # Open connection to image archive
+    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                           db_host=installation_info['mysqlHost'],
+                                           db_user=installation_info['mysqlUser'],
+                                           db_password=installation_info['mysqlPassword'],
+                                           db_name=installation_info['mysqlDatabase'],
+                                           obstory_id=installation_info['observatoryId'])
+
+    # Rebuild table
+    db.refresh_event_summary()
+
+    # Report how many moving objects are now listed
+    db.con.execute("SELECT COUNT(*) AS count FROM archive_event_summary;")
+    logging.info("Event summary table now lists {:d} moving objects.".format(db.con.fetchall()[0]['count']))
+
+    # Commit changes to database
+    db.commit()
+    db.close_db()
+
+
+if __name__ == "__main__":
+    # Read commandline arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S',
+                        handlers=[
+                            logging.FileHandler(os.path.join(settings['pythonPath'], "../datadir/pigazing.log")),
+                            logging.StreamHandler()
+                        ])
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    rebuild_event_summary()
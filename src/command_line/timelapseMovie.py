@@ -30,6 +30,7 @@ import os
 import time
 
 from pigazing_helpers import dcf_ast
+from pigazing_helpers.obsarchive import file_store
 from pigazing_helpers.settings_read import settings, installation_info
 from viewImages import fetch_images
 
@@ -103,8 +104,8 @@ def timelapse_movie(utc_min, utc_max, obstory, img_types, stride, label):
         fn = filename_format % counter
 
         # Make list of input files
-        input_files = [os.path.join(settings['dbFilestore'],
-                                    file_item[semanticType]['repositoryFname'])
+        input_files = [file_store.file_path(settings['dbFilestore'],
+                                            file_item[semanticType]['repositoryFname'])
                        for semanticType in img_types]
 
         command = "\
@@ -32,33 +32,10 @@ import time
 
 import math
 from pigazing_helpers import dcf_ast
-from pigazing_helpers.obsarchive import obsarchive_db, obsarchive_model
+from pigazing_helpers.obsarchive import obsarchive_db
 from pigazing_helpers.settings_read import settings, installation_info
 
 
-def get_file_metadata(db, id, key):
-    """
-    Fetch the metadata associated with a file, turning NULL data into zeros.
-
-    :param db:
-        Pi Gazing DB handle
-    :param id:
-        The repositoryFname of the file to query
-    :param key:
-        The metadata key to query
-    :return:
-        The metadata value
-    """
-
-    # Fetch metadata value
-    val = db.get_file_metadata(id, key)
-
-    # If metadata is not set, then return zero
-    if val is None:
-        return 0
-    return val
-
-
 def list_trigger_rate(utc_min, utc_max, obstory):
     """
     Compile a histogram of the rate of camera triggers, and the rate of time lapse images, over time.
@@ -88,41 +65,33 @@ def list_trigger_rate(utc_min, utc_max, obstory):
               format(obstory))
         sys.exit(0)
 
-    # Search for time-lapse images from this observatory
-    search = obsarchive_model.FileRecordSearch(obstory_ids=[obstory],
-                                               semantic_type="pigazing:timelapse/backgroundSubtracted",
-                                               time_min=utc_min, time_max=utc_max,
-                                               limit=1000000)
-    files = db.search_files(search)
-    files = files['files']
-    files.sort(key=lambda x: x.file_time)
-
-    # Search for moving objects seen by this observatory
-    search = obsarchive_model.ObservationSearch(obstory_ids=[obstory],
-                                                observation_type="pigazing:movingObject/",
-                                                time_min=utc_min, time_max=utc_max,
-                                                limit=1000000)
-    events = db.search_observations(search)
-    events = events['obs']
-
     # Convert list of events and images into a histogram
     histogram = {}
 
-    # Loop over time-lapse images populating histogram
-    for f in files:
-        utc = f.file_time
-        hour_start = math.floor(utc / 3600) * 3600
+    # Count time-lapse images from this observatory, and their mean sky clarity and Sun altitude, from the hourly
+    # rollup table <archive_fileUsageHourly>
+    for item in db.get_file_usage(utc_min=utc_min, utc_max=utc_max, obstory_id=obstory,
+                                  semantic_type="pigazing:timelapse/backgroundSubtracted"):
+        hour_start = item['time']
         if hour_start not in histogram:
-            histogram[hour_start] = {'events': [], 'images': []}
-        histogram[hour_start]['images'].append(f)
-
-    # Loop over moving objects populating histogram
-    for e in events:
-        utc = e.obs_time
-        hour_start = math.floor(utc / 3600) * 3600
+            histogram[hour_start] = {'events': 0, 'images': 0, 'sun_alt': None, 'sky_clarity': None}
+        histogram[hour_start]['images'] += item['file_count']
+        histogram[hour_start]['sun_alt'] = item['pigazing:sunAlt']
+        histogram[hour_start]['sky_clarity'] = item['pigazing:skyClarity']
+
+    # Count moving objects seen by this observatory, from the hourly rollup table <archive_activityHourly>
+    db.con.execute("""
+SELECT hourIndex, observationCount
+FROM archive_activityHourly
+WHERE observatory=%s AND semanticType=%s AND hourIndex BETWEEN %s AND %s;
+""", (db.get_obstory_uid(obstory), db.get_obs_type_id("pigazing:movingObject/", create=False),
+      math.floor(utc_min / 3600), math.floor(utc_max / 3600)))
+
+    for item in db.con.fetchall():
+        hour_start = item['hourIndex'] * 3600
         if hour_start not in histogram:
-            histogram[hour_start] = {'events': [], 'images': []}
-        histogram[hour_start]['events'].append(e)
+            histogram[hour_start] = {'events': 0, 'images': 0, 'sun_alt': None, 'sky_clarity': None}
+        histogram[hour_start]['events'] += item['observationCount']
 
     # Find time bounds of data
     keys = list(histogram.keys())
@@ -153,20 +122,16 @@ def list_trigger_rate(utc_min, utc_max, obstory):
             sun_alt = "---"
             sky_clarity = "---"
 
-            # If we have any images, then use them to calculate mean Sun altitude and sky clairity
-            if d['images']:
-                # Calculate the mean altitude of the Sun within this time interval
-                sun_alt = "{:.1f}".format(sum(get_file_metadata(db, i.id, 'pigazing:sunAlt') for i in d['images']) /
-                                          len(d['images']))
-                # Calculate the mean sky clarity measurement within this time interval
-                sky_clarity = "{:.1f}".format(
-                    sum(get_file_metadata(db, i.id, 'pigazing:skyClarity') for i in d['images']) /
-                    len(d['images']))
+            # If we have any images, then display their mean Sun altitude and sky clarity
+            if d['sun_alt'] is not None:
+                sun_alt = "{:.1f}".format(d['sun_alt'])
+            if d['sky_clarity'] is not None:
+                sky_clarity = "{:.1f}".format(d['sky_clarity'])
 
             # Write output line
             if d['images'] or d['events']:
                 out.write(
-                    "{:12d} {:12d} {:12s} {:12s}\n".format(len(d['images']), len(d['events']), sky_clarity, sun_alt))
+                    "{:12d} {:12d} {:12s} {:12s}\n".format(d['images'], d['events'], sky_clarity, sun_alt))
                 printed_blank_line = False
 
         # If there is no data in this hour, separate it from previous line with a blank line
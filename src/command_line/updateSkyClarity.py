@@ -31,8 +31,8 @@ import os
 import subprocess
 import time
 
-from pigazing_helpers import connect_db
-from pigazing_helpers.settings_read import settings
+from pigazing_helpers.obsarchive import obsarchive_db
+from pigazing_helpers.settings_read import settings, installation_info
 
 
 def update_sky_clarity(utc_min=None, utc_max=None, username=None, obstory=None):
@@ -66,8 +66,16 @@ def update_sky_clarity(utc_min=None, utc_max=None, username=None, obstory=None):
     :return:
         None
     """
-    # Open connection to database
-    [db0, conn] = connect_db.connect_db()
+    # Open connection to image archive
+    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                           db_host=installation_info['mysqlHost'],
+                                           db_user=installation_info['mysqlUser'],
+                                           db_password=installation_info['mysqlPassword'],
+                                           db_name=installation_info['mysqlDatabase'],
+                                           obstory_id=installation_info['observatoryId'])
+
+    # Open direct connection to database
+    conn = db.con
 
     where = ["1"]
     args = []
@@ -86,7 +94,7 @@ def update_sky_clarity(utc_min=None, utc_max=None, username=None, obstory=None):
         args.append(obstory)
 
     conn.execute("""
-SELECT o.uid, o.userId, l.name AS place, o.obsTime, am.uid AS skyClarityUid
+SELECT o.uid, o.userId, l.name AS place, o.observatory, o.obsTime, am.uid AS skyClarityUid
 FROM archive_observations o
 INNER JOIN archive_observatories l ON o.observatory = l.uid
 INNER JOIN archive_semanticTypes ast ON o.obsType = ast.uid
@@ -101,12 +109,15 @@ ORDER BY obsTime ASC;
     values_unchanged = 0
     values_updated = 0
 
+    # Keep track of the hours in which we have changed images, to update <archive_fileUsageHourly>
+    updated_buckets = []
+
     # Update each observation in turn
     for counter, obs in enumerate(results):
 
         # Fetch list of files in this observation
         conn.execute("""
-SELECT ast.name AS semanticType, repositoryFname,
+SELECT ast.name AS semanticType, repositoryFname, fileTime,
 am.floatValue AS skyClarity, am.uid AS skyClarityUid, am2.floatValue AS noiseLevel
 FROM archive_files f
 INNER JOIN archive_semanticTypes ast ON f.semanticType = ast.uid
@@ -123,7 +134,7 @@ WHERE f.observationId=%s;
             # Run sky clarity calculator
             p = subprocess.Popen(args=[os.path.join(settings['imageProcessorPath'], "skyClarity"),
                                        '--input',
-                                       os.path.join(settings['dbFilestore'], item['repositoryFname']),
+                                       db.file_path_for_id(item['repositoryFname']),
                                        '--noise',
                                        str(float(item['noiseLevel']))],
                                  stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -144,6 +155,7 @@ WHERE f.observationId=%s;
             # Commit to database
             conn.execute("UPDATE archive_metadata SET floatValue=%s WHERE uid=%s",
                          (new_sky_clarity, item['skyClarityUid']))
+            updated_buckets.append((obs['observatory'], item['fileTime']))
 
             # Update the observation with the background-subtracted image's sky clarity
             if ((item['semanticType'] == 'pigazing:timelapse/backgroundSubtracted') and
@@ -151,9 +163,12 @@ WHERE f.observationId=%s;
                 conn.execute("UPDATE archive_metadata SET floatValue=%s WHERE uid=%s",
                              (new_sky_clarity, obs['skyClarityUid']))
 
+    # Update the mean sky clarity of the time-lapse images recorded each hour
+    db.refresh_file_usage(buckets=updated_buckets)
+
     # Commit changes to database
-    db0.commit()
-    db0.close()
+    db.commit()
+    db.close_db()
 
     # Report how many values we changed
     logging.info("Updated {:d} images. Left {:d} images unchanged".format(values_updated, values_unchanged))
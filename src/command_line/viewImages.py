@@ -36,6 +36,7 @@ import os
 import time
 
 from pigazing_helpers import dcf_ast, connect_db
+from pigazing_helpers.obsarchive import file_store
 from pigazing_helpers.settings_read import settings, installation_info
 
 
@@ -196,8 +197,8 @@ def view_images(utc_min, utc_max, obstory, img_types, stride):
         fn = "img___{:04d}_{:02d}_{:02d}___{:02d}_{:02d}_{:02d}.png".format(year, month, day, h, m, int(s))
 
         # Make list of input files
-        input_files = [os.path.join(settings['dbFilestore'],
-                                    file_item[semanticType]['repositoryFname'])
+        input_files = [file_store.file_path(settings['dbFilestore'],
+                                            file_item[semanticType]['repositoryFname'])
                        for semanticType in img_types]
 
         command = "\
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# clipping_mask.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Functions for writing the clipping region of an observatory -- the polygons within which moving objects may be
+detected -- into mask files which can be passed to the video analysis binaries with their <--mask> argument. Mask
+files are cached, keyed by a hash of the observatory and its clipping region, so they only need to be written once.
+
+Two kinds of mask file are produced: a text file listing the corners of each polygon, and a bitmap in binary PBM
+format, in which set bits mark the pixels within the clipping region. The bitmap saves the binaries from rasterising
+the polygons, but can only be used when the size of the video frames is known in advance.
+"""
+
+import hashlib
+import json
+import os
+import uuid
+
+from .settings_read import settings
+
+# The directory where mask files are cached
+cache_directory = os.path.join(settings['dataPath'], 'mask_cache')
+
+
+def clipping_region_key(obstory_id, clipping_region):
+    """
+    Make a key which identifies the clipping region of an observatory, for use in the filenames of cached mask files.
+
+    :param string obstory_id:
+        The publicId of the observatory
+    :param list clipping_region:
+        List of polygons, each of which is a list of [x, y] points
+    :return:
+        String key
+    """
+    canonical_region = json.dumps(clipping_region, separators=(',', ':'))
+    return "{}_{}".format(obstory_id, hashlib.sha256(canonical_region.encode('utf-8')).hexdigest()[:24])
+
+
+def polygon_text(clipping_region):
+    """
+    Format a clipping region as a text file which lists the corners of each polygon, one per line, with blank lines
+    between polygons.
+
+    :param list clipping_region:
+        List of polygons, each of which is a list of [x, y] points
+    :return:
+        String contents of the text file
+    """
+    return "\n\n".join(["\n".join([("%d %d" % tuple(point)) for point in point_list])
+                        for point_list in clipping_region])
+
+
+def rasterise(clipping_region, width, height):
+    """
+    Work out which pixels of a video frame lie within a clipping region. This gives exactly the same result as
+    <fill_polygons_from_file> in the video analysis code, including allowing triggers across the whole frame if the
+    clipping region is empty.
+
+    :param list clipping_region:
+        List of polygons, each of which is a list of [x, y] points
+    :param int width:
+        The width of the video frame
+    :param int height:
+        The height of the video frame
+    :return:
+        A bytearray of width * height bytes, which are one for pixels within the clipping region
+    """
+    mask = bytearray(width * height)
+    filled_pixels = 0
+
+    # Polygons with fewer than three corners carry over into the next polygon, as they do when read from a file
+    corners = []
+    for point_list in clipping_region:
+        corners.extend((int(point[0]), int(point[1])) for point in point_list)
+        if len(corners) < 3:
+            continue
+
+        for pixel_y in range(height):
+            # Find where the edges of the polygon cross this row of pixels
+            nodes = []
+            for i in range(len(corners)):
+                x_i, y_i = corners[i]
+                x_j, y_j = corners[i - 1]
+                if (y_i < pixel_y <= y_j) or (y_j < pixel_y <= y_i):
+                    nodes.append(int(x_i + (pixel_y - y_i) / (y_j - y_i) * (x_j - x_i)))
+            nodes.sort()
+
+            # Fill the pixels between pairs of crossings
+            for i in range(0, len(nodes) - 1, 2):
+                if nodes[i] >= width:
+                    break
+                if nodes[i + 1] > 0:
+                    x_min = max(nodes[i], 0)
+                    x_max = min(nodes[i + 1], width)
+                    mask[x_min + width * pixel_y:x_max + width * pixel_y] = b'\x01' * (x_max - x_min)
+                    filled_pixels += x_max - x_min
+        corners = []
+
+    if filled_pixels < 1:
+        mask = bytearray(b'\x01' * (width * height))
+    return mask
+
+
+def pbm_bitmap(mask, width, height):
+    """
+    Encode a mask as a bitmap in binary PBM format.
+
+    :param bytearray mask:
+        A bytearray of width * height bytes, as returned by <rasterise>
+    :param int width:
+        The width of the video frame
+    :param int height:
+        The height of the video frame
+    :return:
+        Bytes of the PBM file
+    """
+    output = bytearray("P4\n{:d} {:d}\n".format(width, height).encode('ascii'))
+    for y in range(height):
+        row = mask[y * width:(y + 1) * width]
+        for x in range(0, width, 8):
+            byte = 0
+            for bit, value in enumerate(row[x:x + 8]):
+                byte |= value << (7 - bit)
+            output.append(byte)
+    return bytes(output)
+
+
+def _write_atomically(file_path, contents):
+    """
+    Write a file into the cache. It is written to a temporary file and then renamed, so that other processes never see
+    it half-written.
+
+    :param string file_path:
+        The path of the file
+    :param bytes contents:
+        The contents of the file
+    :return:
+        None
+    """
+    temp_path = "{}.{}.tmp".format(file_path, uuid.uuid4().hex)
+    with open(temp_path, "wb") as f:
+        f.write(contents)
+    os.replace(temp_path, file_path)
+
+
+def mask_file(obstory_id, clipping_region, width=None, height=None):
+    """
+    Return the path of a mask file for a clipping region, writing it into the cache if it is not there already. If
+    the size of the video frames is given, this is a bitmap; otherwise it is a list of polygons.
+
+    :param string obstory_id:
+        The publicId of the observatory
+    :param clipping_region:
+        List of polygons, each of which is a list of [x, y] points, or a JSON string encoding this
+    :param int width:
+        The width of the video frames, if known
+    :param int height:
+        The height of the video frames, if known
+    :return:
+        The path of the mask file
+    """
+    if isinstance(clipping_region, str):
+        clipping_region = json.loads(clipping_region)
+    key = clipping_region_key(obstory_id=obstory_id, clipping_region=clipping_region)
+
+    if (width is None) or (height is None):
+        file_path = os.path.join(cache_directory, "{}.txt".format(key))
+    else:
+        file_path = os.path.join(cache_directory, "{}_{:d}x{:d}.pbm".format(key, int(width), int(height)))
+
+    if not os.path.exists(file_path):
+        os.makedirs(cache_directory, exist_ok=True)
+        if (width is None) or (height is None):
+            contents = polygon_text(clipping_region=clipping_region).encode('utf-8')
+        else:
+            contents = pbm_bitmap(mask=rasterise(clipping_region=clipping_region, width=int(width),
+                                                 height=int(height)),
+                                  width=int(width), height=int(height))
+        _write_atomically(file_path=file_path, contents=contents)
+
+    return file_path
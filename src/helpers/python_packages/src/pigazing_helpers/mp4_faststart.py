@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# mp4_faststart.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Functions for preparing MP4 videos to be streamed over HTTP. MP4 encoders usually write the index of a video -- the
+<moov> atom -- after the video data, since they do not know how big it will be until they have finished. Browsers
+then have to fetch the end of the file before they can start playing it. These functions move the <moov> atom to the
+start of the file, without re-encoding the video, and extract a list of the keyframes in the video, so that players
+can seek to them with a single range request.
+"""
+
+import json
+import os
+import struct
+import uuid
+
+# Atoms which contain other atoms, on the path from <moov> to the tables which index the video samples
+container_atoms = (b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts', b'dinf')
+
+# Number of bytes copied at a time when rewriting files
+copy_chunk_size = 1024 * 1024
+
+
+def _atoms(data, start=0, end=None):
+    """
+    Iterate over the atoms in a block of an MP4 file.
+
+    :param data:
+        The bytes of the block, or a file object opened in binary mode
+    :param int start:
+        The offset of the first atom
+    :param int end:
+        The offset of the end of the block, or None for the end of <data>
+    :return:
+        Iterator over (atom type, offset, total size, header size) tuples
+    """
+    if hasattr(data, 'read'):
+        data.seek(0, os.SEEK_END)
+        data_length = data.tell()
+
+        def read(offset, length):
+            data.seek(offset)
+            return data.read(length)
+    else:
+        data_length = len(data)
+
+        def read(offset, length):
+            return data[offset:offset + length]
+
+    if end is None:
+        end = data_length
+
+    position = start
+    while position + 8 <= end:
+        size, atom_type = struct.unpack(">I4s", read(position, 8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", read(position + 8, 8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - position
+        if size < header_size or position + size > end:
+            raise ValueError("Malformed MP4 atom <{}> at offset {:d}".format(atom_type, position))
+        yield atom_type, position, size, header_size
+        position += size
+
+
+def _find_atoms(data, path, start=0, end=None):
+    """
+    Find all of the atoms at a particular path within a block of an MP4 file.
+
+    :param bytes data:
+        The bytes of the block
+    :param tuple path:
+        The types of the nested atoms to descend through, e.g. (b'trak', b'mdia', b'mdhd')
+    :param int start:
+        The offset of the first atom
+    :param int end:
+        The offset of the end of the block
+    :return:
+        List of (offset of payload, offset of end of atom) tuples
+    """
+    output = []
+    for atom_type, offset, size, header_size in _atoms(data, start, end):
+        if atom_type != path[0]:
+            continue
+        if len(path) == 1:
+            output.append((offset + header_size, offset + size))
+        else:
+            output.extend(_find_atoms(data, path[1:], offset + header_size, offset + size))
+    return output
+
+
+def _chunk_offset_tables(moov, start=0, end=None):
+    """
+    Find all of the <stco> and <co64> tables, which list the offsets of chunks of samples, within a <moov> atom.
+
+    :param bytearray moov:
+        The bytes of the <moov> atom's payload
+    :return:
+        List of (atom type, offset of payload) tuples
+    """
+    output = []
+    for atom_type, offset, size, header_size in _atoms(moov, start, end):
+        if atom_type in container_atoms:
+            output.extend(_chunk_offset_tables(moov, offset + header_size, offset + size))
+        elif atom_type in (b'stco', b'co64'):
+            output.append((atom_type, offset + header_size))
+    return output
+
+
+def _copy_range(source, output, offset, length):
+    """
+    Copy a range of bytes from one file to another.
+
+    :param source:
+        File object to read from
+    :param output:
+        File object to write to
+    :param int offset:
+        The offset of the first byte to copy
+    :param int length:
+        The number of bytes to copy
+    :return:
+        None
+    """
+    source.seek(offset)
+    while length > 0:
+        chunk = source.read(min(length, copy_chunk_size))
+        if not chunk:
+            raise ValueError("Unexpected end of MP4 file")
+        output.write(chunk)
+        length -= len(chunk)
+
+
+def faststart(file_path):
+    """
+    Move the <moov> atom of an MP4 file to before its video data, if it is not there already. The audio and video
+    streams are copied unchanged; only the offsets in the chunk offset tables are updated. The new file is written
+    alongside the old one, and atomically renamed over it.
+
+    :param string file_path:
+        The path of the MP4 file
+    :return:
+        True if the file was rewritten, or False if it was already suitable for streaming
+    """
+    with open(file_path, 'rb') as source:
+        atoms = list(_atoms(source))
+        moov = [item for item in atoms if item[0] == b'moov']
+        mdat = [item for item in atoms if item[0] == b'mdat']
+        if len(moov) != 1 or len(mdat) == 0:
+            raise ValueError("<{}> does not look like an MP4 video".format(file_path))
+        moov_type, moov_offset, moov_size, moov_header_size = moov[0]
+        first_mdat_offset = mdat[0][1]
+        if moov_offset < first_mdat_offset:
+            return False
+
+        # Every chunk of video data moves later in the file by the size of the <moov> atom
+        source.seek(moov_offset)
+        moov_data = bytearray(source.read(moov_size))
+        for table_type, table_offset in _chunk_offset_tables(moov_data, moov_header_size):
+            entry_count = struct.unpack_from(">I", moov_data, table_offset + 4)[0]
+            entry_format = ">{:d}{}".format(entry_count, "I" if table_type == b'stco' else "Q")
+            offsets = [offset + moov_size for offset in struct.unpack_from(entry_format, moov_data, table_offset + 8)]
+            if table_type == b'stco' and max(offsets, default=0) >= 2 ** 32:
+                raise ValueError("<{}> is too large to rewrite".format(file_path))
+            struct.pack_into(entry_format, moov_data, table_offset + 8, *offsets)
+
+        # Write atoms in their new order: everything before the video data, the <moov> atom, and then the rest
+        temp_path = "{}.{}.tmp".format(file_path, uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb') as output:
+                for atom_type, offset, size, header_size in atoms:
+                    if offset < first_mdat_offset:
+                        _copy_range(source, output, offset, size)
+                output.write(moov_data)
+                for atom_type, offset, size, header_size in atoms:
+                    if offset >= first_mdat_offset and atom_type != b'moov':
+                        _copy_range(source, output, offset, size)
+            os.replace(temp_path, file_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+    return True
+
+
+def keyframe_index(file_path):
+    """
+    List the keyframes in the video track of an MP4 file, with their times and byte offsets.
+
+    :param string file_path:
+        The path of the MP4 file
+    :return:
+        Dictionary containing the duration of the video in seconds, and a list of [time, byte offset] pairs for the
+        keyframes
+    """
+    with open(file_path, 'rb') as source:
+        moov = [item for item in _atoms(source) if item[0] == b'moov']
+        if len(moov) != 1:
+            raise ValueError("<{}> does not look like an MP4 video".format(file_path))
+        source.seek(moov[0][1])
+        data = source.read(moov[0][2])
+    moov_start, moov_end = moov[0][3], len(data)
+
+    # Read the overall duration of the video from the movie header
+    mvhd = _find_atoms(data, (b'mvhd',), moov_start, moov_end)[0][0]
+    if data[mvhd] == 1:
+        timescale, duration = struct.unpack_from(">IQ", data, mvhd + 20)
+    else:
+        timescale, duration = struct.unpack_from(">II", data, mvhd + 12)
+    output = {
+        'duration': duration / timescale,
+        'keyframes': []
+    }
+
+    # Find the video track
+    for trak_start, trak_end in _find_atoms(data, (b'trak',), moov_start, moov_end):
+        hdlr = _find_atoms(data, (b'mdia', b'hdlr'), trak_start, trak_end)
+        if not hdlr or data[hdlr[0][0] + 8:hdlr[0][0] + 12] != b'vide':
+            continue
+
+        mdhd = _find_atoms(data, (b'mdia', b'mdhd'), trak_start, trak_end)[0][0]
+        track_timescale = struct.unpack_from(">I", data, mdhd + (20 if data[mdhd] == 1 else 12))[0]
+
+        def table(atom_type, entry_format):
+            payloads = _find_atoms(data, (b'mdia', b'minf', b'stbl', atom_type), trak_start, trak_end)
+            if not payloads:
+                return None
+            payload = payloads[0][0]
+            entry_count = struct.unpack_from(">I", data, payload + 4)[0]
+            entry_size = struct.calcsize(">" + entry_format)
+            return [struct.unpack_from(">" + entry_format, data, payload + 8 + i * entry_size)
+                    for i in range(entry_count)]
+
+        # Decode time of each sample
+        sample_times = []
+        decode_time = 0
+        for sample_count, sample_delta in table(b'stts', "II"):
+            for i in range(sample_count):
+                sample_times.append(decode_time)
+                decode_time += sample_delta
+
+        # Size of each sample
+        stsz = _find_atoms(data, (b'mdia', b'minf', b'stbl', b'stsz'), trak_start, trak_end)[0][0]
+        sample_size, sample_count = struct.unpack_from(">II", data, stsz + 4)
+        if sample_size == 0:
+            sample_sizes = struct.unpack_from(">{:d}I".format(sample_count), data, stsz + 12)
+        else:
+            sample_sizes = [sample_size] * sample_count
+
+        # Byte offset of each sample, from the offsets of the chunks and the number of samples in each chunk
+        chunk_offsets = table(b'stco', "I") or table(b'co64', "Q")
+        sample_to_chunk = table(b'stsc', "III")
+        sample_offsets = []
+        sample_index = 0
+        for entry_index, (first_chunk, samples_per_chunk, description) in enumerate(sample_to_chunk):
+            last_chunk = (sample_to_chunk[entry_index + 1][0] - 1 if entry_index + 1 < len(sample_to_chunk)
+                          else len(chunk_offsets))
+            for chunk in range(first_chunk, last_chunk + 1):
+                offset = chunk_offsets[chunk - 1][0]
+                for i in range(samples_per_chunk):
+                    if sample_index >= sample_count:
+                        break
+                    sample_offsets.append(offset)
+                    offset += sample_sizes[sample_index]
+                    sample_index += 1
+
+        # Samples which are keyframes are listed in the sync sample table. If it is absent, every sample is one.
+        sync_samples = table(b'stss', "I")
+        keyframes = [item[0] - 1 for item in sync_samples] if sync_samples is not None else range(sample_count)
+        output['keyframes'] = [[round(sample_times[i] / track_timescale, 3), sample_offsets[i]]
+                               for i in keyframes if i < len(sample_offsets)]
+        break
+
+    return output
+
+
+def prepare_for_streaming(file_path):
+    """
+    Move the index of an MP4 video to the start of the file, and return metadata describing it.
+
+    :param string file_path:
+        The path of the MP4 file
+    :return:
+        Dictionary of metadata, containing <videoDuration> in seconds and <videoKeyframes>, a JSON list of
+        [time, byte offset] pairs for the keyframes in the video
+    """
+    faststart(file_path=file_path)
+    index = keyframe_index(file_path=file_path)
+    return {
+        'videoDuration': index['duration'],
+        'videoKeyframes': json.dumps(index['keyframes'], separators=(',', ':'))
+    }
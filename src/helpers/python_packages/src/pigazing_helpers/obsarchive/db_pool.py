@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# db_pool.py
+
+# A thread-safe pool of open connections to the observation database
+
+import itertools
+import threading
+import time
+from logging import getLogger
+
+import MySQLdb
+
+from .obsarchive_db import ObservationDatabase
+
+
+class ObservationDatabasePool(object):
+    """
+    A bounded, thread-safe pool of :class:`obsarchive_db.ObservationDatabase` instances, each with its own open
+    connection to the database. This saves web applications from having to open a new connection to MySQL on every
+    request.
+
+    Instances are taken from the pool with :meth:`checkout`. Calling :meth:`obsarchive_db.ObservationDatabase.close_db`
+    on a pooled instance returns it to the pool, rather than closing its connection, so code which opens and closes
+    its own database handles does not need to be modified to use a pool.
+
+    Each checkout is given a token, stored in the instance's <pool_token> attribute. Code which may try to return a
+    handle after it has already been returned -- and perhaps handed out again to someone else -- should keep the token
+    it was given, and pass it to :meth:`checkin`, which ignores tokens from earlier checkouts.
+
+    :cvar logger:
+        Logs to 'obsarchive.db_pool'
+    :ivar int max_size:
+        The maximum number of connections which may be open at once
+    :ivar float max_idle_time:
+        Connections which have been idle in the pool for longer than this number of seconds are closed, rather than
+        being handed out again
+    :ivar float ping_interval:
+        Connections which have been idle for longer than this number of seconds are pinged before being handed out, to
+        check that the server has not closed them
+    :ivar float checkout_timeout:
+        The maximum number of seconds to wait for a connection to become free when the pool is exhausted
+    """
+
+    logger = getLogger("obsarchive.db_pool")
+
+    def __init__(self, file_store_path, db_host, db_user, db_password, db_name, obstory_id,
+                 max_size=8, max_idle_time=600, ping_interval=10, checkout_timeout=30):
+        """
+        Create a new, empty, pool of database connections. Connections are opened as they are needed.
+
+        :param file_store_path:
+            Path to the file store on disk
+        :param db_host:
+            Host of the database
+        :param db_user:
+            User login to the database
+        :param db_password:
+            Password for the database
+        :param db_name:
+            Database name
+        :param obstory_id:
+            The local obstory ID
+        :param int max_size:
+            The maximum number of connections which may be open at once
+        :param float max_idle_time:
+            The number of seconds after which idle connections are closed
+        :param float ping_interval:
+            The number of seconds after which idle connections are pinged before being handed out
+        :param float checkout_timeout:
+            The maximum number of seconds to wait for a connection to become free when the pool is exhausted
+        """
+        self.file_store_path = file_store_path
+        self.db_host = db_host
+        self.db_user = db_user
+        self.db_password = db_password
+        self.db_name = db_name
+        self.obstory_id = obstory_id
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.ping_interval = ping_interval
+        self.checkout_timeout = checkout_timeout
+
+        self._condition = threading.Condition()
+
+        # List of [ObservationDatabase, time returned to pool] for connections which are not in use
+        self._idle = []
+
+        # Dictionary of the tokens of ObservationDatabase instances which are currently checked out, indexed by id()
+        self._checked_out = {}
+        self._tokens = itertools.count(1)
+
+        # Total number of connections open, including those currently being opened
+        self._size = 0
+
+    def checkout(self):
+        """
+        Take a database handle from the pool, opening a new connection if none are idle and the pool is not full, or
+        otherwise waiting for one to be returned.
+
+        :return:
+            An :class:`obsarchive_db.ObservationDatabase`, which should be returned to the pool by calling its
+            close_db() method
+        """
+        deadline = time.time() + self.checkout_timeout
+        while True:
+            db = None
+            idle_since = None
+            with self._condition:
+                while (not self._idle) and (self._size >= self.max_size):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ValueError("Timed out waiting for a free database connection")
+                    self._condition.wait(remaining)
+                if self._idle:
+                    # Reuse the most recently returned connection, so that rarely-used ones can expire
+                    db, idle_since = self._idle.pop()
+                else:
+                    self._size += 1
+
+            # Open a new connection if there were none idle
+            if db is None:
+                try:
+                    db = ObservationDatabase(file_store_path=self.file_store_path,
+                                             db_host=self.db_host,
+                                             db_user=self.db_user,
+                                             db_password=self.db_password,
+                                             db_name=self.db_name,
+                                             obstory_id=self.obstory_id)
+                except Exception:
+                    self._discard(db=None)
+                    raise
+                db.pool = self
+                return self._mark_checked_out(db)
+
+            # Check that idle connections are still usable
+            idle_time = time.time() - idle_since
+            if idle_time > self.max_idle_time:
+                self._discard(db=db)
+                continue
+            if idle_time > self.ping_interval:
+                try:
+                    db.db.ping()
+                except MySQLdb.Error:
+                    self.logger.info("Discarding broken database connection")
+                    self._discard(db=db)
+                    continue
+            return self._mark_checked_out(db)
+
+    def checkin(self, db, token=None):
+        """
+        Return a database handle to the pool. Any uncommitted changes are rolled back, so that the next user of the
+        connection starts a fresh transaction. Handles which have already been returned are ignored.
+
+        :param db:
+            An :class:`obsarchive_db.ObservationDatabase` previously returned by :meth:`checkout`
+        :param int token:
+            The <pool_token> the handle was given when it was checked out. If this does not match its current checkout,
+            the handle has already been returned, and is ignored. If None, the handle's current checkout is ended.
+        :return:
+            None
+        """
+        with self._condition:
+            if id(db) not in self._checked_out:
+                return
+            if (token is not None) and (token != self._checked_out[id(db)]):
+                return
+            del self._checked_out[id(db)]
+
+        try:
+            db.rollback()
+        except MySQLdb.Error:
+            self.logger.info("Discarding broken database connection")
+            self._discard(db=db)
+            return
+
+        with self._condition:
+            self._idle.append([db, time.time()])
+            self._condition.notify()
+
+    def close_all(self):
+        """
+        Close all of the idle connections in the pool. Connections which are checked out are closed when they are
+        returned.
+
+        :return:
+            None
+        """
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+        for db, idle_since in idle:
+            self._discard(db=db)
+
+    def _mark_checked_out(self, db):
+        with self._condition:
+            db.pool_token = next(self._tokens)
+            self._checked_out[id(db)] = db.pool_token
+        return db
+
+    def _discard(self, db):
+        """
+        Close a connection and remove it from the pool's count of open connections.
+
+        :param db:
+            An :class:`obsarchive_db.ObservationDatabase`, or None if the connection was never successfully opened
+        :return:
+            None
+        """
+        if db is not None:
+            db.pool = None
+            try:
+                db.close_db()
+            except MySQLdb.Error:
+                pass
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
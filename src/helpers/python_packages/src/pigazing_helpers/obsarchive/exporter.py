@@ -3,6 +3,7 @@
 
 # Functions which export database objects to an external server
 
+import os
 import traceback
 
 from requests import post
@@ -166,7 +167,10 @@ ORDER BY o.fileTime ASC, o.uid ASC LIMIT 1
                 file_record = self.db.get_file(repository_fname=file_id)
                 if file_record is None:
                     return export_state.failed()
-                with open(self.db.file_path_for_id(file_id), 'rb') as file_content:
+                file_path = self.db.file_path_for_id(file_id)
+                if not os.path.exists(file_path):
+                    file_path = self.db.restore_file(file_id)
+                with open(file_path, 'rb') as file_content:
                     multi = MultipartEncoder(fields={'file': ('file', file_content, file_record.mime_type)})
                     response = post(url="{0}/data/{1}/{2}".format(target_url, file_id, file_record.file_md5),
                                     data=multi, verify=False,
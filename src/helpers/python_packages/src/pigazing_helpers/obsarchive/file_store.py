@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+# file_store.py
+
+# Functions which work out where files are kept within the file store, and move files into it
+
+import hashlib
+import lzma
+import os
+import re
+import uuid
+
+from . import obsarchive_model as mp
+
+# The ways in which files may be arranged within the file store. In the <flat> layout, every file is stored directly
+# in the file store directory. In the <date> layout, files are stored in subdirectories YYYY/MM/DD, taken from the
+# time stamp at the start of their repositoryFname, as produced by obsarchive_model.get_hash().
+layouts = ('flat', 'date')
+
+# The name of the file, in the root of the file store, which records which layout it uses
+layout_marker_filename = ".layout"
+
+# Regular expression matching the time stamp at the start of a repositoryFname
+_date_prefix = re.compile(r"^(\d{4})(\d{2})(\d{2})_")
+
+# The name of the directory, in the root of the file store, which holds content-addressed blobs. If it exists, files
+# with identical contents are stored once, as hard links to a single blob named after their MD5 checksum.
+blob_directory = "blobs"
+
+# The name of the directory, in the root of the file store, which holds files moved into cold storage. This may be a
+# symlink to a different volume. Files in cold storage are always arranged in the <date> layout.
+cold_directory = "cold"
+
+# The ways in which files in cold storage may be compressed, indexed by the suffix added to their filenames. Each entry
+# is a function which opens a compressed file, given a file object and a mode.
+compressions = {
+    'xz': lambda fileobj, mode: lzma.LZMAFile(fileobj, mode=mode)
+}
+
+# Number of bytes read at a time when copying files into the file store
+copy_chunk_size = 1024 * 1024
+
+# Cache of the layouts of file stores, used by file_path() and indexed by the paths of the file stores
+_layout_cache = {}
+
+
+def read_layout(file_store_path):
+    """
+    Work out which layout a file store uses. This is recorded in the file <.layout> in the root of the file store.
+    File stores without this file which are empty are new, and use the <date> layout, which we record. Those which
+    already contain files were created before file stores were divided into subdirectories, and use the <flat> layout.
+
+    :param string file_store_path:
+        The path of the file store
+    :return:
+        The name of the layout, which is one of <layouts>
+    """
+    marker_path = os.path.join(file_store_path, layout_marker_filename)
+    try:
+        with open(marker_path) as f:
+            layout = f.read().strip()
+        if layout not in layouts:
+            raise ValueError("Unknown file store layout <{}> in <{}>".format(layout, marker_path))
+        return layout
+    except FileNotFoundError:
+        pass
+
+    # Only look at the first entry of the file store, since it may contain millions of files
+    with os.scandir(file_store_path) as entries:
+        is_empty = next(entries, None) is None
+    if not is_empty:
+        return 'flat'
+
+    try:
+        write_layout(file_store_path=file_store_path, layout='date')
+    except OSError:
+        pass
+    return 'date'
+
+
+def write_layout(file_store_path, layout):
+    """
+    Record which layout a file store uses.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string layout:
+        The name of the layout, which must be one of <layouts>
+    :return:
+        None
+    """
+    if layout not in layouts:
+        raise ValueError("Unknown file store layout <{}>".format(layout))
+    marker_path = os.path.join(file_store_path, layout_marker_filename)
+    temp_path = marker_path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(layout + "\n")
+    os.replace(temp_path, marker_path)
+
+
+def relative_path(repository_fname, layout):
+    """
+    Return the path of a file relative to the root of the file store, in a particular layout. Files whose names do
+    not start with a time stamp are always stored in the root of the file store.
+
+    :param string repository_fname:
+        The repositoryFname of the file
+    :param string layout:
+        The name of the layout, which must be one of <layouts>
+    :return:
+        Relative path of the file
+    """
+    if layout == 'flat':
+        return repository_fname
+    if layout == 'date':
+        test = _date_prefix.match(repository_fname)
+        if test is None:
+            return repository_fname
+        return os.path.join(test.group(1), test.group(2), test.group(3), repository_fname)
+    raise ValueError("Unknown file store layout <{}>".format(layout))
+
+
+def find_file(file_store_path, repository_fname, layout):
+    """
+    Return the path of a file in the file store. While a file store is being migrated from one layout to another,
+    files may be in either place, so if the file is not where <layout> puts it, we look for it in the other layouts,
+    and then in cold storage. Compressed files in cold storage are not found; see :meth:`thaw_file`. If the file does
+    not exist at all, the path where <layout> would put it is returned.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string repository_fname:
+        The repositoryFname of the file
+    :param string layout:
+        The name of the layout the file store uses
+    :return:
+        Path of the file
+    """
+    preferred_path = os.path.join(file_store_path, relative_path(repository_fname=repository_fname, layout=layout))
+    if os.path.exists(preferred_path):
+        return preferred_path
+    for other_layout in layouts:
+        if other_layout != layout:
+            other_path = os.path.join(file_store_path,
+                                      relative_path(repository_fname=repository_fname, layout=other_layout))
+            if os.path.exists(other_path):
+                return other_path
+    stored_cold_path = cold_path(file_store_path=file_store_path, repository_fname=repository_fname)
+    if os.path.exists(stored_cold_path):
+        return stored_cold_path
+    return preferred_path
+
+
+def file_path(file_store_path, repository_fname):
+    """
+    Return the path of a file in the file store, for use by code which does not have an ObservationDatabase to call
+    :meth:`obsarchive_db.ObservationDatabase.file_path_for_id` on. The layout of the file store is read once per
+    process.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string repository_fname:
+        The repositoryFname of the file
+    :return:
+        Path of the file
+    """
+    if file_store_path not in _layout_cache:
+        _layout_cache[file_store_path] = read_layout(file_store_path=file_store_path)
+    return find_file(file_store_path=file_store_path, repository_fname=repository_fname,
+                     layout=_layout_cache[file_store_path])
+
+
+def _fsync_directory(dir_path):
+    """
+    Flush a directory to disk, so that files which have just been renamed into it survive a power cut.
+
+    :param string dir_path:
+        The path of the directory
+    :return:
+        None
+    """
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_with_hash(source, target_path, compression=None):
+    """
+    Copy the contents of an open file into a new file, calculating their MD5 checksum as they are copied, so that
+    they are read only once. The data are written to a temporary file alongside <target_path>, flushed to disk, and
+    then atomically renamed, so that a partially written file never appears at <target_path>.
+
+    :param source:
+        A file object, opened in binary mode, to read from
+    :param string target_path:
+        The path of the file to write
+    :param string compression:
+        The compression to apply to the new file, which must be one of the keys of <compressions>, or None
+    :return:
+        The hex representation of the MD5 checksum of the uncompressed data
+    """
+    checksum = hashlib.md5()
+    temp_path = "{}.{}.tmp".format(target_path, uuid.uuid4().hex)
+    try:
+        with open(temp_path, 'wb') as raw_output:
+            output = raw_output if compression is None else compressions[compression](raw_output, 'wb')
+            for chunk in iter(lambda: source.read(copy_chunk_size), b''):
+                checksum.update(chunk)
+                output.write(chunk)
+            if output is not raw_output:
+                output.close()
+            raw_output.flush()
+            os.fsync(raw_output.fileno())
+        os.replace(temp_path, target_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    _fsync_directory(os.path.dirname(target_path))
+    return checksum.hexdigest()
+
+
+def ingest_file(source_path, target_path, file_md5=None):
+    """
+    Move a file into the file store, and calculate its MD5 checksum, reading the file no more than once. If the file
+    is on the same filesystem as the file store, it is renamed, and only read if its checksum is not already known.
+    Otherwise, it is copied and checksummed in a single pass by :meth:`copy_with_hash`, and then deleted.
+
+    :param string source_path:
+        The path of the file to move
+    :param string target_path:
+        The path in the file store to move it to
+    :param string file_md5:
+        The MD5 checksum of the file, if it is already known
+    :return:
+        The hex representation of the MD5 checksum of the file
+    """
+    target_dir = os.path.dirname(target_path)
+    os.makedirs(target_dir, exist_ok=True)
+
+    if os.stat(source_path).st_dev == os.stat(target_dir).st_dev:
+        if file_md5 is None:
+            file_md5 = mp.get_md5_hash(source_path)
+        os.rename(source_path, target_path)
+        _fsync_directory(target_dir)
+        return file_md5
+
+    with open(source_path, 'rb') as source:
+        file_md5 = copy_with_hash(source=source, target_path=target_path)
+    os.unlink(source_path)
+    return file_md5
+
+
+def content_addressed(file_store_path):
+    """
+    Test whether a file store stores files with identical contents only once. This is switched on by creating the
+    directory <blob_directory> in the root of the file store, as done by <initialisation/deduplicateFileStore.py>.
+
+    :param string file_store_path:
+        The path of the file store
+    :return:
+        Boolean
+    """
+    return os.path.isdir(os.path.join(file_store_path, blob_directory))
+
+
+def blob_path(file_store_path, file_md5):
+    """
+    Return the path of the blob which holds files with a particular MD5 checksum.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string file_md5:
+        The hex representation of the MD5 checksum of the file
+    :return:
+        Path of the blob
+    """
+    return os.path.join(file_store_path, blob_directory, file_md5[0:2], file_md5[2:4], file_md5)
+
+
+def link_to_blob(file_store_path, file_path, file_md5):
+    """
+    Store a file in a content-addressed file store. If a blob with the same checksum already exists, the file is
+    replaced with a hard link to it. Otherwise, the file becomes the blob. The number of files sharing a blob is its
+    hard link count, less one for the blob itself.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string file_path:
+        The path of the file, which must already be in the file store
+    :param string file_md5:
+        The hex representation of the MD5 checksum of the file, which the caller must have verified
+    :return:
+        The number of bytes of disk space saved
+    """
+    target_blob = blob_path(file_store_path=file_store_path, file_md5=file_md5)
+    file_stat = os.stat(file_path)
+    os.makedirs(os.path.dirname(target_blob), exist_ok=True)
+
+    try:
+        blob_stat = os.stat(target_blob)
+    except FileNotFoundError:
+        try:
+            os.link(file_path, target_blob)
+            return 0
+        except FileExistsError:
+            # Another process has just created this blob
+            blob_stat = os.stat(target_blob)
+
+    if os.path.samestat(file_stat, blob_stat):
+        return 0
+
+    # Files with equal checksums but different sizes are not the same; leave them alone
+    if file_stat.st_size != blob_stat.st_size:
+        return 0
+
+    # Atomically replace the file with a link to the blob, so that it never appears to be missing
+    temp_path = "{}.{}.tmp".format(file_path, uuid.uuid4().hex)
+    try:
+        os.link(target_blob, temp_path)
+    except OSError:
+        # The blob has been deleted, or has reached the maximum number of links the filesystem allows
+        return 0
+    os.replace(temp_path, file_path)
+    return file_stat.st_size if file_stat.st_nlink == 1 else 0
+
+
+def remove_file(file_store_path, file_path, file_md5):
+    """
+    Delete a file from the file store. In a content-addressed file store, the blob it links to is also deleted once
+    no other files link to it.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string file_path:
+        The path of the file
+    :param string file_md5:
+        The hex representation of the MD5 checksum of the file
+    :return:
+        None
+    """
+    file_stat = os.stat(file_path)
+    os.unlink(file_path)
+
+    if file_stat.st_nlink != 2 or not file_md5:
+        return
+    target_blob = blob_path(file_store_path=file_store_path, file_md5=file_md5)
+    try:
+        blob_stat = os.stat(target_blob)
+    except FileNotFoundError:
+        return
+    if os.path.samestat(file_stat, blob_stat) and blob_stat.st_nlink == 1:
+        os.unlink(target_blob)
+
+
+def cold_path(file_store_path, repository_fname, compression=None):
+    """
+    Return the path of a file in cold storage.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string repository_fname:
+        The repositoryFname of the file
+    :param string compression:
+        The compression applied to the file, which must be one of the keys of <compressions>, or None
+    :return:
+        Path of the file
+    """
+    stored_path = os.path.join(file_store_path, cold_directory,
+                               relative_path(repository_fname=repository_fname, layout='date'))
+    if compression is not None:
+        stored_path += "." + compression
+    return stored_path
+
+
+def freeze_file(file_store_path, repository_fname, file_path, file_md5, compression=None):
+    """
+    Copy a file into cold storage, optionally compressing it, and check that its contents were read correctly. The
+    original file is left in place, for the caller to delete once the move has been recorded.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string repository_fname:
+        The repositoryFname of the file
+    :param string file_path:
+        The current path of the file
+    :param string file_md5:
+        The MD5 checksum of the file, as recorded in the database
+    :param string compression:
+        The compression to apply, which must be one of the keys of <compressions>, or None
+    :return:
+        The size of the file in cold storage
+    """
+    target_path = cold_path(file_store_path=file_store_path, repository_fname=repository_fname,
+                            compression=compression)
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with open(file_path, 'rb') as source:
+        cold_md5 = copy_with_hash(source=source, target_path=target_path, compression=compression)
+    if cold_md5 != file_md5:
+        os.unlink(target_path)
+        raise ValueError("File <{}> does not match its checksum".format(file_path))
+    return os.stat(target_path).st_size
+
+
+def thaw_file(file_store_path, repository_fname, target_path, file_md5, compression=None):
+    """
+    Copy a file out of cold storage, decompressing it if needed, and check that it is intact. The copy in cold storage
+    is left in place, for the caller to delete once the move has been recorded.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string repository_fname:
+        The repositoryFname of the file
+    :param string target_path:
+        The path to copy the file to
+    :param string file_md5:
+        The MD5 checksum of the file, as recorded in the database
+    :param string compression:
+        The compression applied to the file in cold storage, which must be one of the keys of <compressions>, or None
+    :return:
+        None
+    """
+    source_path = cold_path(file_store_path=file_store_path, repository_fname=repository_fname,
+                            compression=compression)
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with open(source_path, 'rb') as raw_source:
+        source = raw_source if compression is None else compressions[compression](raw_source, 'rb')
+        restored_md5 = copy_with_hash(source=source, target_path=target_path)
+    if restored_md5 != file_md5:
+        os.unlink(target_path)
+        raise ValueError("File <{}> in cold storage does not match its checksum".format(source_path))
@@ -46,11 +46,181 @@ def first_non_null(values):
 class ObservationDatabaseGenerators(object):
     """
     Generator functions used to retrieve, and cache, items from the database.
+
+    Metadata, files and likes are fetched for whole batches of rows at a time, using a few queries of the form
+    'WHERE x IN (...)', rather than issuing several queries for every row returned.
+
+    :ivar int batch_size:
+        The maximum number of rows whose associated items are fetched in each batch.
     """
 
-    def __init__(self, db, con):
+    def __init__(self, db, con, batch_size=1000):
         self.con = con
         self.db = db
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _batches(items, batch_size):
+        """
+        Split a list of items into a sequence of lists of at most <batch_size> items.
+
+        :param items:
+            The list of items to split.
+        :param batch_size:
+            The maximum number of items in each batch.
+        :return:
+            A generator of lists.
+        """
+        for i in range(0, len(items), batch_size):
+            yield items[i:i + batch_size]
+
+    def metadata_for_items(self, id_column, uids):
+        """
+        Fetch all of the metadata associated with a list of files, observations or observation groups.
+
+        :param id_column:
+            The column of <archive_metadata> which refers to the items, i.e. 'fileId', 'observationId' or 'groupId'.
+        :param uids:
+            A list of the database uids of the items.
+        :return:
+            Dictionary of lists of :class:`obsarchive_model.Meta`, indexed by item uid.
+        """
+        output = {uid: [] for uid in uids}
+        if len(uids) == 0:
+            return output
+
+        sql = """SELECT m.{0} AS itemId, f.metaKey, stringValue, floatValue
+FROM archive_metadata m
+INNER JOIN archive_metadataFields f ON m.fieldId=f.uid
+WHERE m.{0} IN ({1})
+ORDER BY m.uid
+""".format(id_column, ', '.join(["%s"] * len(uids)))
+        self.con.execute(sql, tuple(uids))
+        for item in self.con.fetchall():
+            value = first_non_null([item['stringValue'], item['floatValue']])
+            output[item['itemId']].append(mp.Meta(item['metaKey'], value))
+        return output
+
+    def files_for_observations(self, uids):
+        """
+        Fetch all of the files associated with a list of observations, together with their metadata.
+
+        :param uids:
+            A list of the database uids of the observations.
+        :return:
+            Dictionary of lists of :class:`obsarchive_model.FileRecord`, indexed by observation uid.
+        """
+        output = {uid: [] for uid in uids}
+        if len(uids) == 0:
+            return output
+
+        sql = """SELECT f.uid, f.observationId AS observationUid, o.publicId AS observationId, f.mimeType,
+       f.fileName, s2.name AS semanticType, f.fileTime, f.primaryImage,
+       f.fileSize, f.fileMD5, l.publicId AS obstory_id, l.name AS obstory_name, f.repositoryFname
+FROM archive_files f
+INNER JOIN archive_semanticTypes s2 ON f.semanticType=s2.uid
+INNER JOIN archive_observations o ON f.observationId=o.uid
+INNER JOIN archive_observatories l ON o.observatory=l.uid
+WHERE f.observationId IN ({0})
+ORDER BY f.uid
+""".format(', '.join(["%s"] * len(uids)))
+        self.con.execute(sql, tuple(uids))
+        results = self.con.fetchall()
+
+        for file_record, result in zip(self.file_records_from_rows(results), results):
+            output[result['observationUid']].append(file_record)
+        return output
+
+    def likes_for_observations(self, uids):
+        """
+        Count the number of likes received by each of a list of observations.
+
+        :param uids:
+            A list of the database uids of the observations.
+        :return:
+            Dictionary of like counts, indexed by observation uid.
+        """
+        output = {uid: 0 for uid in uids}
+        if len(uids) == 0:
+            return output
+
+        sql = """SELECT observationId, COUNT(*) AS likes
+FROM archive_obs_likes
+WHERE observationId IN ({0})
+GROUP BY observationId
+""".format(', '.join(["%s"] * len(uids)))
+        self.con.execute(sql, tuple(uids))
+        for item in self.con.fetchall():
+            output[item['observationId']] = item['likes']
+        return output
+
+    def file_records_from_rows(self, results):
+        """
+        Turn rows describing files into FileRecord instances, with their metadata attached.
+
+        :param results:
+            A list of rows describing files.
+        :return:
+            A list of :class:`obsarchive_model.FileRecord`
+        """
+        output = []
+        for batch in self._batches(results, self.batch_size):
+            metadata = self.metadata_for_items(id_column='fileId', uids=[result['uid'] for result in batch])
+            for result in batch:
+                file_record = mp.FileRecord(obstory_id=result['obstory_id'], obstory_name=result['obstory_name'],
+                                            observation_id=result['observationId'],
+                                            repository_fname=result['repositoryFname'],
+                                            file_time=result['fileTime'], file_size=result['fileSize'],
+                                            file_name=result['fileName'], mime_type=result['mimeType'],
+                                            primary_image=result['primaryImage'],
+                                            file_md5=result['fileMD5'],
+                                            semantic_type=result['semanticType'],
+                                            meta=metadata[result['uid']])
+                output.append(file_record)
+        return output
+
+    def observations_from_rows(self, results):
+        """
+        Turn rows describing observations into Observation instances, with their metadata, files and likes attached.
+
+        :param results:
+            A list of rows describing observations.
+        :return:
+            A list of :class:`obsarchive_model.Observation`
+        """
+        output = []
+        for batch in self._batches(results, self.batch_size):
+            uids = [result['uid'] for result in batch]
+            metadata = self.metadata_for_items(id_column='observationId', uids=uids)
+            files = self.files_for_observations(uids=uids)
+            likes = self.likes_for_observations(uids=uids)
+
+            for result in batch:
+                observation = mp.Observation(obstory_id=result['obstory_id'], obstory_name=result['obstory_name'],
+                                             obstory_owner=result['obstory_owner'],
+                                             obs_time=result['obsTime'], obs_id=result['publicId'],
+                                             creation_time=result['creationTime'],
+                                             published=result['published'],
+                                             moderated=result['moderated'],
+                                             featured=result['featured'],
+                                             ra=result['ra'],
+                                             dec=result['decl'],
+                                             field_width=result['fieldWidth'],
+                                             field_height=result['fieldHeight'],
+                                             position_angle=result['positionAngle'],
+                                             central_constellation=result['centralConstellation'],
+                                             altitude=result['altitude'],
+                                             azimuth=result['azimuth'],
+                                             alt_az_pa=result['altAzPositionAngle'],
+                                             astrometry_processed=result['astrometryProcessed'],
+                                             astrometry_processing_time=result['astrometryProcessingTime'],
+                                             astrometry_source=result['astrometrySource'],
+                                             obs_type=result['obsType'],
+                                             file_records=files[result['uid']],
+                                             meta=metadata[result['uid']])
+                observation.likes = likes[result['uid']]
+                output.append(observation)
+        return output
 
     def file_generator(self, sql, sql_args):
         """
@@ -67,30 +237,7 @@ class ObservationDatabaseGenerators(object):
 
         self.con.execute(sql, sql_args)
         results = self.con.fetchall()
-        output = []
-        for result in results:
-            file_record = mp.FileRecord(obstory_id=result['obstory_id'], obstory_name=result['obstory_name'],
-                                        observation_id=result['observationId'],
-                                        repository_fname=result['repositoryFname'],
-                                        file_time=result['fileTime'], file_size=result['fileSize'],
-                                        file_name=result['fileName'], mime_type=result['mimeType'],
-                                        primary_image=result['primaryImage'],
-                                        file_md5=result['fileMD5'],
-                                        semantic_type=result['semanticType'])
-
-            # Look up observation metadata
-            sql = """SELECT f.metaKey, stringValue, floatValue
-FROM archive_metadata m
-INNER JOIN archive_metadataFields f ON m.fieldId=f.uid
-WHERE m.fileId=%s
-"""
-            self.con.execute(sql, (result['uid'],))
-            for item in self.con.fetchall():
-                value = first_non_null([item['stringValue'], item['floatValue']])
-                file_record.meta.append(mp.Meta(item['metaKey'], value))
-
-            output.append(file_record)
-        return output
+        return self.file_records_from_rows(results)
 
     def observation_generator(self, sql, sql_args):
         """
@@ -106,54 +253,71 @@ WHERE m.fileId=%s
 
         self.con.execute(sql, sql_args)
         results = self.con.fetchall()
-        output = []
-        for result in results:
-            observation = mp.Observation(obstory_id=result['obstory_id'], obstory_name=result['obstory_name'],
-                                         obstory_owner=result['obstory_owner'],
-                                         obs_time=result['obsTime'], obs_id=result['publicId'],
-                                         creation_time=result['creationTime'],
-                                         published=result['published'],
-                                         moderated=result['moderated'],
-                                         featured=result['featured'],
-                                         ra=result['ra'],
-                                         dec=result['decl'],
-                                         field_width=result['fieldWidth'],
-                                         field_height=result['fieldHeight'],
-                                         position_angle=result['positionAngle'],
-                                         central_constellation=result['centralConstellation'],
-                                         altitude=result['altitude'],
-                                         azimuth=result['azimuth'],
-                                         alt_az_pa=result['altAzPositionAngle'],
-                                         astrometry_processed=result['astrometryProcessed'],
-                                         astrometry_processing_time=result['astrometryProcessingTime'],
-                                         astrometry_source=result['astrometrySource'],
-                                         obs_type=result['obsType'])
-
-            # Look up observation metadata
-            sql = """SELECT f.metaKey, stringValue, floatValue
-FROM archive_metadata m
-INNER JOIN archive_metadataFields f ON m.fieldId=f.uid
-WHERE m.observationId=%s
-"""
-            self.con.execute(sql, (result['uid'],))
-            for item in self.con.fetchall():
-                value = first_non_null([item['stringValue'], item['floatValue']])
-                observation.meta.append(mp.Meta(item['metaKey'], value))
+        return self.observations_from_rows(results)
 
-            # Fetch file objects
-            sql = "SELECT f.repositoryFname FROM archive_files f WHERE f.observationId=%s"
-            self.con.execute(sql, (result['uid'],))
-            for item in self.con.fetchall():
-                observation.file_records.append(self.db.get_file(item['repositoryFname']))
+    def row_stream(self, sql, sql_args, page_size):
+        """
+        Run a query on an unbuffered server-side cursor, and yield its results in pages.
 
-            # Count votes for observation
-            self.con.execute("SELECT COUNT(*) FROM archive_obs_likes WHERE observationId="
-                             "(SELECT uid FROM archive_observations WHERE publicId=%s);", (result['publicId'],))
-            observation.likes = self.con.fetchone()['COUNT(*)']
+        :param sql:
+            A SQL statement
+        :param sql_args:
+            Any variables required to populate the query provided in 'sql'
+        :param page_size:
+            The maximum number of rows in each page
+        :return:
+            A generator which produces lists of rows, closing the cursor and its connection on completion.
+        """
+        cursor = self.db.streaming_cursor()
+        try:
+            cursor.execute(sql, sql_args)
+            while True:
+                results = cursor.fetchmany(page_size)
+                if not results:
+                    break
+                yield results
+        finally:
+            connection = cursor.connection
+            cursor.close()
+            connection.close()
+
+    def file_stream(self, sql, sql_args, page_size=1000):
+        """
+        Streaming generator for FileRecord. Rows are read from a server-side cursor one page at a time, and the
+        metadata for each page is fetched in a batch on the main connection.
 
-            output.append(observation)
+        :param sql:
+            A SQL statement which must return rows describing files.
+        :param sql_args:
+            Any variables required to populate the query provided in 'sql'
+        :param page_size:
+            The number of rows to read from the server at a time
+        :return:
+            A generator which produces FileRecord instances from the supplied SQL, closing any opened cursors on
+            completion.
+        """
+        for results in self.row_stream(sql=sql, sql_args=sql_args, page_size=page_size):
+            for file_record in self.file_records_from_rows(results):
+                yield file_record
 
-        return output
+    def observation_stream(self, sql, sql_args, page_size=1000):
+        """
+        Streaming generator for Observation. Rows are read from a server-side cursor one page at a time, and the
+        metadata, files and likes for each page are fetched in a batch on the main connection.
+
+        :param sql:
+            A SQL statement which must return rows describing observations
+        :param sql_args:
+            Any variables required to populate the query provided in 'sql'
+        :param page_size:
+            The number of rows to read from the server at a time
+        :return:
+            A generator which produces Observation instances from the supplied SQL, closing any opened cursors on
+            completion.
+        """
+        for results in self.row_stream(sql=sql, sql_args=sql_args, page_size=page_size):
+            for observation in self.observations_from_rows(results):
+                yield observation
 
     def obsgroup_generator(self, sql, sql_args):
         """
@@ -177,15 +341,7 @@ WHERE m.observationId=%s
                                             user_id=result['setByUser'])
 
             # Look up observation group metadata
-            sql = """SELECT f.metaKey, stringValue, floatValue
-FROM archive_metadata m
-INNER JOIN archive_metadataFields f ON m.fieldId=f.uid
-WHERE m.groupId=%s
-"""
-            self.con.execute(sql, (result['uid'],))
-            for item in self.con.fetchall():
-                value = first_non_null([item['stringValue'], item['floatValue']])
-                obs_group.meta.append(mp.Meta(item['metaKey'], value))
+            obs_group.meta.extend(self.metadata_for_items(id_column='groupId', uids=[result['uid']])[result['uid']])
 
             # Fetch observation objects
             sql = """SELECT o.publicId
@@ -2,12 +2,13 @@
 # importer_api.py
 
 from logging import getLogger
-from os import path, remove
+from os import makedirs, path, remove
 
 from flask import request, g
 from flask_jsonpify import jsonify
 from yaml import safe_load
 
+from . import file_store
 from . import obsarchive_model as model
 
 
@@ -66,9 +67,13 @@ class ObservationDatabaseImportReceiver(object):
     def receive_file_data(self, file_id, file_data, md5_hex):
         file_path = self.db.file_path_for_id(file_id)
         if not path.isfile(file_path):
-            file_data.save(file_path)
-            if md5_hex != model.get_md5_hash(file_path):
+            makedirs(path.dirname(file_path), exist_ok=True)
+            # Checksum the data as it is written, rather than reading the file back afterwards
+            if md5_hex != file_store.copy_with_hash(source=file_data.stream, target_path=file_path):
                 remove(file_path)
+            elif file_store.content_addressed(file_store_path=self.db.file_store_path):
+                file_store.link_to_blob(file_store_path=self.db.file_store_path, file_path=file_path,
+                                        file_md5=md5_hex)
 
 
 class ImportRequest(object):
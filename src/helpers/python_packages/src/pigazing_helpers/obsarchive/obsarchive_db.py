@@ -4,15 +4,16 @@
 # Classes which interact with the observation database
 
 import json
+import math
 import numbers
 import os
-import shutil
 import sys
 import time
 
 import MySQLdb
 import passlib.hash
 
+from . import file_store
 from . import obsarchive_model as mp
 from .dcf_ast import inv_julian_day, jd_from_unix
 from .generators import first_from_generator, ObservationDatabaseGenerators
@@ -39,12 +40,63 @@ class ObservationDatabase(object):
         Database name
     :ivar file_store_path:
         Path to the file store on disk
+    :ivar string file_store_layout:
+        The way in which files are arranged within the file store; one of <file_store.layouts>
     :ivar string obstory_id:
         The local obstory ID
     :ivar object generator:
         Object generator class
+    :ivar object pool:
+        The :class:`db_pool.ObservationDatabasePool` this instance belongs to, if any
+    :ivar int pool_token:
+        The token identifying the current checkout of this instance from its pool, if any
+    :ivar dict pending_interned_ids:
+        The interned IDs which may depend on rows inserted in the current transaction, indexed by the name of the
+        dimension table. These are only added to the process-wide cache when the transaction is committed.
+    :cvar dict obstory_status_cache:
+        Process-wide cache of observatory statuses, indexed by observatory publicId. Each entry is a list of
+        [valid_from, valid_until, expiry, status] lists, giving the status of the observatory at any time in the
+        interval valid_from <= time < valid_until.
+    :cvar float obstory_status_cache_lifetime:
+        The number of seconds for which cached observatory statuses are trusted. Metadata registered by other processes
+        does not invalidate our cache, so we need to refresh it periodically.
+    :cvar int obstory_status_cache_size:
+        The maximum number of time intervals cached per observatory.
+    :cvar dict interned_id_cache:
+        Process-wide cache of the uids of the rows in small dimension tables -- metadata fields, semantic types,
+        sources of astrometry, and observatories -- which almost never change. Indexed by (db_host, db_name), and then
+        by the name of the dimension table, each entry is a dictionary of uids indexed by name.
+    :cvar tuple event_summary_fields:
+        The metadata fields copied into the table <archive_event_summary>. Each entry is a tuple of the metadata key,
+        the name of the column in <archive_event_summary>, the column of <archive_metadata> which holds its value, and
+        a boolean indicating whether values set on an object's video file take precedence over those set on the
+        observation.
+    :cvar string event_summary_video_type:
+        The semantic type of the video files referenced by <archive_event_summary>
+    :cvar tuple file_usage_fields:
+        The numerical file metadata whose sums are kept in the table <archive_fileUsageHourly>. Each entry is a tuple
+        of the metadata key, and the prefix of the columns <...Count> and <...Sum> which hold the number of files with
+        this key set, and the sum of their values.
     """
 
+    obstory_status_cache = {}
+    obstory_status_cache_lifetime = 60
+    obstory_status_cache_size = 64
+    interned_id_cache = {}
+    event_summary_fields = (
+        ('pigazing:path', 'path', 'stringValue', True),
+        ('pigazing:pathBezier', 'pathBezier', 'stringValue', True),
+        ('pigazing:duration', 'duration', 'floatValue', True),
+        ('pigazing:detectionCount', 'detectionCount', 'floatValue', True),
+        ('pigazing:videoStart', 'videoStart', 'floatValue', True),
+        ('web:category', 'category', 'stringValue', False)
+    )
+    event_summary_video_type = 'pigazing:movingObject/video'
+    file_usage_fields = (
+        ('pigazing:skyClarity', 'skyClarity'),
+        ('pigazing:sunAlt', 'sunAlt')
+    )
+
     def __init__(self, file_store_path, db_host='localhost', db_user='obsarchive', db_password='obsarchive',
                  db_name='obsarchive', obstory_id='Undefined'):
         """
@@ -64,25 +116,27 @@ class ObservationDatabase(object):
         :param obstory_id:
             The local obstory ID
         """
-        self.db = MySQLdb.connect(host=db_host, user=db_user, passwd=db_password, db=db_name)
+        self.db = self.connect(db_host=db_host, db_user=db_user, db_password=db_password, db_name=db_name)
         self.con = self.db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
 
-        self.db.set_character_set('utf8mb4')
-        self.con.execute('SET NAMES utf8mb4;')
-        self.con.execute('SET CHARACTER SET utf8mb4;')
-        self.con.execute('SET character_set_connection=utf8mb4;')
-
         if not os.path.exists(file_store_path):
             os.makedirs(file_store_path)
         if not os.path.isdir(file_store_path):
             raise ValueError('File store path already exists but is not a directory!')
         self.file_store_path = file_store_path
+        self.file_store_layout = file_store.read_layout(file_store_path=file_store_path)
         self.db_host = db_host
         self.db_user = db_user
         self.db_password = db_password
         self.db_name = db_name
         self.obstory_id = obstory_id
         self.generators = ObservationDatabaseGenerators(db=self, con=self.con)
+        self.pool = None
+        self.pool_token = None
+        self.pending_interned_ids = {}
+
+        # Make sure that the IDs of metadata fields, semantic types, etc, are loaded into the process-wide cache
+        self.interned_ids()
 
     def __str__(self):
         """Simple string representation of this db object
@@ -99,10 +153,129 @@ class ObservationDatabase(object):
             self.db_name,
             self.obstory_id))
 
+    @staticmethod
+    def connect(db_host, db_user, db_password, db_name):
+        """
+        Open a new MySQL connection, configured to use the utf8mb4 character set.
+
+        :param db_host:
+            Host of the database
+        :param db_user:
+            User login to the database
+        :param db_password:
+            Password for the database
+        :param db_name:
+            Database name
+        :return:
+            MySQLdb connection object
+        """
+        db = MySQLdb.connect(host=db_host, user=db_user, passwd=db_password, db=db_name)
+        db.set_character_set('utf8mb4')
+        c = db.cursor()
+        c.execute('SET NAMES utf8mb4;')
+        c.execute('SET CHARACTER SET utf8mb4;')
+        c.execute('SET character_set_connection=utf8mb4;')
+        c.close()
+        return db
+
+    def streaming_cursor(self):
+        """
+        Open an unbuffered, server-side cursor, which returns rows as they are read from the server rather than
+        holding the whole result set in memory. The cursor has its own connection to the database, since no other
+        queries can be run on a connection while an unbuffered result set is being read. The connection is closed when
+        the cursor's <connection> is closed.
+
+        :return:
+            A MySQLdb.cursors.SSDictCursor
+        """
+        db = self.connect(db_host=self.db_host, db_user=self.db_user, db_password=self.db_password,
+                          db_name=self.db_name)
+        return db.cursor(cursorclass=MySQLdb.cursors.SSDictCursor)
+
+    def interned_ids(self):
+        """
+        Return the process-wide cache of the uids of metadata fields, semantic types, sources of astrometry and
+        observatories in this database. The first time this is called in any process, the contents of these tables are
+        preloaded in their entirety. Subsequently, any new entries are added to the cache as they are looked up.
+
+        Once a row has been inserted into one of these tables, any uids we look up in that table are held in
+        <self.pending_interned_ids> until the transaction is committed, since they may not survive a rollback.
+
+        :return:
+            Dictionary of {table name: {name: uid}}
+        """
+        cache_key = (self.db_host, self.db_name)
+        if cache_key not in ObservationDatabase.interned_id_cache:
+            cache = {}
+            for table, name_column, uid_column in (('archive_metadataFields', 'metaKey', 'uid'),
+                                                   ('archive_semanticTypes', 'name', 'uid'),
+                                                   ('pigazing_sources', 'name', 'sourceId'),
+                                                   ('archive_observatories', 'publicId', 'uid')):
+                self.con.execute("SELECT {0} AS name, {1} AS uid FROM {2};".format(name_column, uid_column, table))
+                cache[table] = dict((item['name'], item['uid']) for item in self.con.fetchall())
+            ObservationDatabase.interned_id_cache[cache_key] = cache
+        return ObservationDatabase.interned_id_cache[cache_key]
+
+    def _look_up_interned_id(self, table, name, select_sql, insert_sql=None, insert_args=None):
+        """
+        Look up the uid of a row in a dimension table, using the process-wide cache of interned IDs.
+
+        :param string table:
+            The name of the dimension table
+        :param string name:
+            The name of the row
+        :param string select_sql:
+            SQL query which returns the uid of the row as <uid>, with <name> as its only parameter
+        :param string insert_sql:
+            SQL query which inserts the row if it does not exist. If None, None is returned for unknown rows.
+        :param tuple insert_args:
+            The parameters of <insert_sql>
+        :return:
+            The uid of the row, or None
+        """
+        cache = self.interned_ids()[table]
+        if name in cache:
+            return cache[name]
+        pending = self.pending_interned_ids.get(table, None)
+        if (pending is not None) and (name in pending):
+            return pending[name]
+
+        self.con.execute(select_sql, (name,))
+        results = self.con.fetchall()
+        if len(results) < 1:
+            if insert_sql is None:
+                return None
+            self.con.execute(insert_sql, insert_args)
+            self.pending_interned_ids.setdefault(table, {})
+            self.con.execute(select_sql, (name,))
+            results = self.con.fetchall()
+
+        # If we have inserted rows into this table in this transaction, this may be one of them
+        uid = results[0]['uid']
+        if table in self.pending_interned_ids:
+            self.pending_interned_ids[table][name] = uid
+        else:
+            cache[name] = uid
+        return uid
+
     def commit(self):
         self.db.commit()
 
+        # Interned IDs which depended on this transaction are now safe to share with the rest of the process
+        cache = self.interned_ids()
+        for table, pending in self.pending_interned_ids.items():
+            cache[table].update(pending)
+        self.pending_interned_ids = {}
+
+    def rollback(self):
+        self.db.rollback()
+        self.pending_interned_ids = {}
+
     def close_db(self):
+        # Instances which belong to a connection pool are returned to it, rather than being closed
+        if self.pool is not None:
+            self.pool.checkin(self)
+            return
         self.con.close()
         self.db.close()
 
@@ -111,6 +284,18 @@ class ObservationDatabase(object):
         self.con.execute('SELECT 1 FROM archive_observatories WHERE publicId=%s;', (obstory_id,))
         return len(self.con.fetchall()) > 0
 
+    def get_obstory_uid(self, obstory_id):
+        """
+        Look up the uid of an observatory, using the process-wide cache of interned IDs.
+
+        :param string obstory_id:
+            The publicId of the observatory
+        :return:
+            The uid of the observatory, or None if it does not exist
+        """
+        return self._look_up_interned_id(table='archive_observatories', name=obstory_id,
+                                         select_sql='SELECT uid FROM archive_observatories WHERE publicId=%s;')
+
     def get_obstory_from_id(self, obstory_id):
         self.con.execute("""
 SELECT uid, publicId, userId, name, ST_X(location) AS longitude, ST_Y(location) AS latitude
@@ -127,9 +312,13 @@ INSERT INTO archive_observatories
 VALUES
 (%s, %s, POINT(%s, %s), %s);
 """, (obstory_id, obstory_name, longitude, latitude, owner))
+        self.pending_interned_ids.setdefault('archive_observatories', {})
         return obstory_id
 
     def delete_obstory(self, obstory_id):
+        self.invalidate_obstory_status_cache(obstory_id=obstory_id)
+        self.interned_ids()['archive_observatories'].pop(obstory_id, None)
+        self.pending_interned_ids.get('archive_observatories', {}).pop(obstory_id, None)
         self.con.execute("DELETE FROM archive_observatories WHERE publicId=%s;", (obstory_id,))
 
     def get_obstory_ids(self):
@@ -220,6 +409,9 @@ VALUES
         if self.has_obstory_metadata(item_id):
             return
 
+        obstory_uid = self.get_obstory_uid(obstory_id)
+        if obstory_uid is None:
+            raise ValueError("No such obstory: {}".format(obstory_id))
         key_id = self.get_metadata_key_id(key)
         str_value = float_value = None
         if isinstance(value, numbers.Number):
@@ -227,91 +419,140 @@ VALUES
         else:
             str_value = str(value)
 
+        # Cached observatory statuses may no longer be valid
+        self.invalidate_obstory_status_cache(obstory_id=obstory_id)
+
         # Insert into database
         self.con.execute("""
 INSERT INTO archive_metadata
 (publicId, observatory, fieldId, time, setAtTime, setByUser, stringValue, floatValue)
 VALUES
-(%s, (SELECT uid FROM archive_observatories WHERE publicId=%s), %s, %s, %s, %s, %s, %s);
-""", (item_id, obstory_id, key_id, metadata_time, time_created, user_created, str_value, float_value))
+(%s, %s, %s, %s, %s, %s, %s, %s);
+""", (item_id, obstory_uid, key_id, metadata_time, time_created, user_created, str_value, float_value))
 
     def get_obstory_status(self, time=None, obstory_id=None):
+        """
+        Return a dictionary of all the metadata which was in force for an observatory at a particular time. Metadata
+        set before the observatory was last serviced (i.e. before the most recent 'refresh' key) is not reported.
+
+        Statuses are fetched with a single grouped query, and cached in-process, together with the interval of time
+        over which they remain valid. The cache is invalidated whenever metadata is registered for the observatory.
+
+        :param float time:
+            The unix time at which we should return the observatory's status. Defaults to now.
+        :param string obstory_id:
+            The publicId of the observatory. Defaults to the local observatory.
+        :return:
+            Dictionary of metadata values, indexed by metadata key
+        """
         if time is None:
             time = mp.now()
         if obstory_id is None:
             obstory_id = self.obstory_id
 
-        output = {}
+        # See if we have already cached the status of this observatory at this time
+        time_now = mp.now()
+        cache = ObservationDatabase.obstory_status_cache.setdefault(obstory_id, [])
+        for valid_from, valid_until, expiry, status in cache:
+            if (expiry > time_now) and (valid_from <= time) and ((valid_until is None) or (time < valid_until)):
+                return dict(status)
 
-        # See when this observatory was last serviced. Do not report any metadata set before this time.
-        last_serviced = 0
+        # Look up the uids of the observatory and of the 'refresh' metadata field
+        obstory_uid = self.get_obstory_uid(obstory_id)
+        refresh_key_id = self.get_metadata_key_id('refresh', create=False)
+
+        # For each metadata field, fetch the most recent value set since the observatory was last serviced.
+        # We also fetch the time of the next metadata change after <time>, which bounds the validity of the result.
         self.con.execute("""
-SELECT time FROM archive_metadata
-WHERE observatory=(SELECT uid FROM archive_observatories WHERE publicId=%s)
-      AND fieldId=(SELECT uid FROM archive_metadataFields WHERE metaKey='refresh')
-      AND time <= %s
-ORDER BY time DESC LIMIT 1
-""", (obstory_id, time))
+SELECT f.metaKey, m.time, m.floatValue, m.stringValue, next_item.time AS next_change
+FROM archive_metadata m
+INNER JOIN archive_metadataFields f ON m.fieldId=f.uid
+INNER JOIN (
+    SELECT x.observatory, x.fieldId, MAX(x.time) AS time
+    FROM archive_metadata x
+    CROSS JOIN (
+        SELECT COALESCE(MAX(r.time), 0) AS time
+        FROM archive_metadata r
+        WHERE r.observatory=%s AND r.fieldId=%s AND r.time <= %s
+    ) last_serviced
+    WHERE x.observatory=%s AND x.time BETWEEN last_serviced.time AND %s
+    GROUP BY x.observatory, x.fieldId
+) latest ON m.observatory=latest.observatory AND m.fieldId=latest.fieldId AND m.time=latest.time
+CROSS JOIN (
+    SELECT MIN(n.time) AS time
+    FROM archive_metadata n
+    WHERE n.observatory=%s AND n.time > %s
+) next_item
+ORDER BY m.uid;
+""", (obstory_uid, refresh_key_id, time, obstory_uid, time, obstory_uid, time))
         results = self.con.fetchall()
-        if len(results) > 0:
-            last_serviced = results[0]['time']
-
-        # Loop over each known metadata field in turn, and see when it was most recently set
-        self.con.execute('SELECT uid,metaKey FROM archive_metadataFields;')
-        for item in self.con.fetchall():
-            self.con.execute("""
-SELECT floatValue, stringValue FROM archive_metadata
-WHERE observatory=(SELECT uid FROM archive_observatories WHERE publicId=%s) AND fieldId=%s
-      AND time BETWEEN %s AND %s
-ORDER BY time DESC LIMIT 1
-""", (obstory_id, item['uid'], last_serviced, time))
-            results = self.con.fetchall()
 
-            # See if this metadata field has ever been set for this observatory
-            if len(results) > 0:
-                result = results[0]
+        output = {}
+        for item in results:
+            # Return each value as a floating-point value if possible, otherwise as a string
+            if item['stringValue'] is None:
+                output[item['metaKey']] = item['floatValue']
+            else:
+                output[item['metaKey']] = item['stringValue']
+
+        # The 'refresh' key is not reported, so is not cached either
+        if 'refresh' in output:
+            del output['refresh']
 
-                # If so, return it as a floating-point value if possible, otherwise as a string
-                if result['stringValue'] is None:
-                    value = result['floatValue']
-                else:
-                    value = result['stringValue']
-                output[item['metaKey']] = value
+        # The status is unchanged between the last metadata change before <time>, and the first one after it
+        if len(results) > 0:
+            valid_from = max(item['time'] for item in results)
+            valid_until = results[0]['next_change']
+            cache.append([valid_from, valid_until, time_now + ObservationDatabase.obstory_status_cache_lifetime,
+                          dict(output)])
+            del cache[:-ObservationDatabase.obstory_status_cache_size]
 
         # Return dictionary of results
-        if 'refresh' in output:
-            del output['refresh']
         return output
 
+    @staticmethod
+    def invalidate_obstory_status_cache(obstory_id=None):
+        """
+        Discard any cached observatory statuses, after metadata has been changed.
+
+        :param string obstory_id:
+            The publicId of the observatory whose metadata has changed. If None, the entire cache is cleared.
+        :return:
+            None
+        """
+        if obstory_id is None:
+            ObservationDatabase.obstory_status_cache.clear()
+        else:
+            ObservationDatabase.obstory_status_cache.pop(obstory_id, None)
+
     def lookup_obstory_metadata(self, key, time=None, obstory_id=None):
         if time is None:
             time = mp.now()
         if obstory_id is None:
             obstory_id = self.obstory_id
 
+        obstory_uid = self.get_obstory_uid(obstory_id)
+        key_id = self.get_metadata_key_id(key, create=False)
+        if key_id is None:
+            return None, None
+
         # See when this observatory was last serviced. Do not report any metadata set before this time.
         last_serviced = 0
         self.con.execute("""
 SELECT time FROM archive_metadata
-WHERE observatory=(SELECT uid FROM archive_observatories WHERE publicId=%s)
-      AND fieldId=(SELECT uid FROM archive_metadataFields WHERE metaKey='refresh')
-      AND time <= %s
+WHERE observatory=%s AND fieldId=%s AND time <= %s
 ORDER BY time DESC LIMIT 1
-""", (obstory_id, time))
+""", (obstory_uid, self.get_metadata_key_id('refresh', create=False), time))
         results = self.con.fetchall()
         if len(results) > 0:
             last_serviced = results[0]['time']
 
-        self.con.execute('SELECT uid FROM archive_metadataFields WHERE metaKey=%s;', (key,))
-        results = self.con.fetchall()
-        if len(results) < 1:
-            return None, None
         self.con.execute("""
 SELECT floatValue, stringValue, time FROM archive_metadata
-WHERE observatory=(SELECT uid FROM archive_observatories WHERE publicId=%s) AND fieldId=%s
+WHERE observatory=%s AND fieldId=%s
       AND time BETWEEN %s AND %s
 ORDER BY time DESC LIMIT 1
-""", (obstory_id, results[0]['uid'], last_serviced, time))
+""", (obstory_uid, key_id, last_serviced, time))
         results = self.con.fetchall()
         if len(results) < 1:
             return None, None
@@ -323,26 +564,125 @@ ORDER BY time DESC LIMIT 1
         return value, result['time']
 
     # Functions relating to metadata keys
-    def get_metadata_key_id(self, metakey):
-        self.con.execute("SELECT uid FROM archive_metadataFields WHERE metaKey=%s;", (metakey,))
-        results = self.con.fetchall()
-        if len(results) < 1:
-            self.con.execute("INSERT INTO archive_metadataFields (metaKey) VALUES (%s);", (metakey,))
-            self.con.execute("SELECT uid FROM archive_metadataFields WHERE metaKey=%s;", (metakey,))
-            results = self.con.fetchall()
-        return results[0]['uid']
+    def get_metadata_key_id(self, metakey, create=True):
+        """
+        Look up the uid of a metadata key, using the process-wide cache of interned IDs.
+
+        :param string metakey:
+            The metadata key
+        :param bool create:
+            If true, unknown metadata keys are inserted into the database. If false, None is returned for them.
+        :return:
+            The uid of the metadata key
+        """
+        return self._look_up_interned_id(
+            table='archive_metadataFields', name=metakey,
+            select_sql="SELECT uid FROM archive_metadataFields WHERE metaKey=%s;",
+            insert_sql="INSERT INTO archive_metadataFields (metaKey) VALUES (%s);" if create else None,
+            insert_args=(metakey,))
+
+    def set_metadata_bulk(self, entity_type, items, update_event_summary=True, update_file_usage=True):
+        """
+        Set many metadata values on files or observations in one go. This is much faster than calling
+        :meth:`set_file_metadata` or :meth:`set_observation_metadata` repeatedly, since the IDs of the files or
+        observations, and of the metadata fields, are each looked up only once, and the new values are inserted with a
+        single multi-row INSERT statement. Nothing is committed until :meth:`commit` is called.
+
+        :param string entity_type:
+            Either 'file' or 'observation'
+        :param list items:
+            A list of (entity_id, user_id, meta, utc) tuples, where <entity_id> is the ID of a file or observation,
+            and <meta> is a :class:`obsarchive_model.Meta`. If the same key is set more than once on the same entity,
+            the last value is kept.
+        :param bool update_event_summary:
+            If true, refresh the rows of <archive_event_summary> affected by these metadata. Callers which make further
+            changes to the same observations may set this to false, and call :meth:`refresh_event_summary` themselves.
+        :param bool update_file_usage:
+            If true, refresh the rows of <archive_fileUsageHourly> affected by these metadata. Callers which make
+            further changes to the same files may set this to false, and call :meth:`refresh_file_usage` themselves.
+        :return:
+            None
+        """
+        if entity_type == 'file':
+            table, public_id_column, id_column = 'archive_files', 'repositoryFname', 'fileId'
+            obs_column = 'observationId'
+        elif entity_type == 'observation':
+            table, public_id_column, id_column = 'archive_observations', 'publicId', 'observationId'
+            obs_column = 'uid'
+        else:
+            raise ValueError("Unknown entity type <{}>".format(entity_type))
+
+        if len(items) == 0:
+            return
+
+        # Look up the uids of all the entities we are setting metadata on
+        entity_uids = {}
+        observation_uids = {}
+        public_ids = list(set(item[0] for item in items))
+        for batch in self.generators._batches(public_ids, self.generators.batch_size):
+            self.con.execute("SELECT uid, {0}, {1} AS observationUid FROM {2} WHERE {0} IN ({3});".format(
+                public_id_column, obs_column, table, ",".join(["%s"] * len(batch))), batch)
+            for result in self.con.fetchall():
+                entity_uids[result[public_id_column]] = result['uid']
+                observation_uids[result['uid']] = result['observationUid']
+
+        # Look up the uids of all the metadata fields
+        field_ids = {}
+        for key in set(item[2].key for item in items):
+            field_ids[key] = self.get_metadata_key_id(key)
+
+        # Work out the new value of each metadata field
+        values = {}
+        for entity_id, user_id, meta, utc in items:
+            if entity_id not in entity_uids:
+                raise ValueError("No {} with ID <{}>".format(entity_type, entity_id))
+            if utc is None:
+                utc = mp.now()
+            values[(entity_uids[entity_id], field_ids[meta.key])] = (mp.get_hash(utc, meta.key, user_id), user_id,
+                                                                     meta.string_value(), meta.float_value())
+
+        # Delete any existing values of these metadata fields
+        keys = list(values.keys())
+        for batch in self.generators._batches(keys, self.generators.batch_size):
+            self.con.execute("DELETE FROM archive_metadata WHERE ({}, fieldId) IN ({});".format(
+                id_column, ",".join(["(%s, %s)"] * len(batch))), [value for key in batch for value in key])
+
+        # Insert new values
+        set_at_time = mp.now()
+        self.con.executemany("""
+INSERT INTO archive_metadata (publicId, fieldId, setAtTime, setByUser, stringValue, floatValue, {})
+VALUES (%s, %s, %s, %s, %s, %s, %s);
+""".format(id_column), [(public_id, field_id, set_at_time, user_id, string_value, float_value, entity_uid)
+                        for (entity_uid, field_id), (public_id, user_id, string_value, float_value)
+                        in values.items()])
+
+        # Update the event summary table, if any of the fields it contains have changed
+        if update_event_summary:
+            summary_field_ids = set(self.get_metadata_key_id(item[0]) for item in self.event_summary_fields)
+            self.refresh_event_summary(observation_uids=[observation_uids[entity_uid]
+                                                         for (entity_uid, field_id) in keys
+                                                         if field_id in summary_field_ids])
+
+        # Update the file usage table, if any of the fields it sums have changed
+        if update_file_usage and entity_type == 'file':
+            usage_field_ids = set(self.get_metadata_key_id(item[0]) for item in self.file_usage_fields)
+            self.refresh_file_usage(buckets=self._file_usage_buckets(
+                file_uids=[entity_uid for (entity_uid, field_id) in keys if field_id in usage_field_ids]))
 
     # Functions relating to file objects
     def file_path_for_id(self, repository_fname):
         """
-        Get the system file path for a given file ID. Does not guarantee that the file exists!
+        Get the system file path for a given file ID. Does not guarantee that the file exists! While the file store
+        is being migrated between layouts, the file may be found in either layout; new files are placed according to
+        <file_store_layout>.
 
         :param string repository_fname:
             ID of a file (which may or may not exist, this method doesn't check)
         :return:
             System file path for the file
         """
-        return os.path.join(self.file_store_path, repository_fname)
+        return file_store.find_file(file_store_path=self.file_store_path, repository_fname=repository_fname,
+                                    layout=self.file_store_layout)
 
     def has_file_id(self, repository_fname):
         """
@@ -357,13 +697,99 @@ ORDER BY time DESC LIMIT 1
         return len(self.con.fetchall()) > 0
 
     def delete_file(self, repository_fname):
-        file_path = self.file_path_for_id(repository_fname)
+        self.con.execute('SELECT f.observationId, o.observatory, f.fileTime, f.fileMD5, '
+                         'c.fileId IS NOT NULL AS isCold, c.compression FROM archive_files f '
+                         'INNER JOIN archive_observations o ON f.observationId=o.uid '
+                         'LEFT OUTER JOIN archive_coldFiles c ON c.fileId=f.uid '
+                         'WHERE f.repositoryFname = %s', (repository_fname,))
+        results = self.con.fetchall()
+        if results and results[0]['isCold']:
+            file_path = file_store.cold_path(file_store_path=self.file_store_path, repository_fname=repository_fname,
+                                             compression=results[0]['compression'])
+        else:
+            file_path = self.file_path_for_id(repository_fname)
         try:
-            os.unlink(file_path)
+            file_store.remove_file(file_store_path=self.file_store_path, file_path=file_path,
+                                   file_md5=results[0]['fileMD5'] if results else None)
         except OSError:
             print("Could not delete file <%s>" % file_path)
             pass
         self.con.execute('DELETE FROM archive_files WHERE repositoryFname = %s', (repository_fname,))
+        self.refresh_event_summary(observation_uids=[item['observationId'] for item in results])
+        self.refresh_file_usage(buckets=[(item['observatory'], item['fileTime']) for item in results])
+
+    def freeze_file(self, repository_fname, compression=None):
+        """
+        Move a file out of the file store into cold storage, optionally compressing it. The database is committed
+        before the original file is deleted, so that the file can always be found, even if we are interrupted.
+
+        :param string repository_fname:
+            The file ID
+        :param string compression:
+            The compression to apply, which must be one of the keys of <file_store.compressions>, or None
+        :return:
+            The size of the file in cold storage, or None if the file was already in cold storage
+        """
+        self.con.execute('SELECT f.uid, f.fileMD5, c.fileId IS NOT NULL AS isCold FROM archive_files f '
+                         'LEFT OUTER JOIN archive_coldFiles c ON c.fileId=f.uid '
+                         'WHERE f.repositoryFname = %s', (repository_fname,))
+        results = self.con.fetchall()
+        if len(results) < 1:
+            raise ValueError("No file with ID <%s>" % repository_fname)
+        if results[0]['isCold']:
+            return None
+
+        file_path = self.file_path_for_id(repository_fname)
+        stored_size = file_store.freeze_file(file_store_path=self.file_store_path, repository_fname=repository_fname,
+                                             file_path=file_path, file_md5=results[0]['fileMD5'],
+                                             compression=compression)
+        self.con.execute('INSERT INTO archive_coldFiles (fileId, compression, storedSize, movedTime) '
+                         'VALUES (%s, %s, %s, %s);', (results[0]['uid'], compression, stored_size, mp.now()))
+        self.commit()
+        file_store.remove_file(file_store_path=self.file_store_path, file_path=file_path,
+                               file_md5=results[0]['fileMD5'])
+        return stored_size
+
+    def restore_file(self, repository_fname):
+        """
+        Move a file back from cold storage into the file store, decompressing it if needed. Files which are not in
+        cold storage are left alone. The database is committed before the copy in cold storage is deleted.
+
+        :param string repository_fname:
+            The file ID
+        :return:
+            System file path for the file
+        """
+        self.con.execute('SELECT c.fileId, c.compression, f.fileMD5 FROM archive_coldFiles c '
+                         'INNER JOIN archive_files f ON c.fileId=f.uid '
+                         'WHERE f.repositoryFname = %s', (repository_fname,))
+        results = self.con.fetchall()
+        if len(results) < 1:
+            return self.file_path_for_id(repository_fname)
+        item = results[0]
+
+        file_path = os.path.join(self.file_store_path, file_store.relative_path(repository_fname=repository_fname,
+                                                                                layout=self.file_store_layout))
+        try:
+            file_store.thaw_file(file_store_path=self.file_store_path, repository_fname=repository_fname,
+                                 target_path=file_path, file_md5=item['fileMD5'], compression=item['compression'])
+        except FileNotFoundError:
+            # Another process has just restored this file
+            if os.path.exists(file_path):
+                return file_path
+            raise
+        if file_store.content_addressed(file_store_path=self.file_store_path):
+            file_store.link_to_blob(file_store_path=self.file_store_path, file_path=file_path,
+                                    file_md5=item['fileMD5'])
+
+        self.con.execute('DELETE FROM archive_coldFiles WHERE fileId=%s;', (item['fileId'],))
+        self.commit()
+        try:
+            os.unlink(file_store.cold_path(file_store_path=self.file_store_path, repository_fname=repository_fname,
+                                           compression=item['compression']))
+        except FileNotFoundError:
+            pass
+        return file_path
 
     def get_file(self, repository_fname):
         """
@@ -375,7 +801,7 @@ ORDER BY time DESC LIMIT 1
             A :class:`obsarchive_model.FileRecord` instance, or None if not found
         """
         search = mp.FileRecordSearch(repository_fname=repository_fname)
-        b = search_files_sql_builder(search)
+        b = search_files_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
         sql = b.get_select_sql(columns='f.uid, o.publicId AS observationId, f.mimeType, '
                                        'f.fileName, s2.name AS semanticType, f.fileTime, f.primaryImage, '
                                        'f.fileSize, f.fileMD5, l.publicId AS obstory_id, l.name AS obstory_name, '
@@ -394,25 +820,56 @@ ORDER BY time DESC LIMIT 1
             an instance of :class:`obsarchive_model.FileRecordSearch` used to constrain the observations returned from
             the DB
         :return:
-            a structure of {count:int total rows of an unrestricted search, observations:list of
-            :class:`obsarchive_model.FileRecord`}
+            a structure of {count:int total rows of an unrestricted search, files:list of
+            :class:`obsarchive_model.FileRecord`, continuation:token to pass in the search for the next page of
+            results, or None if there are no more results}
         """
-        b = search_files_sql_builder(search)
+        b = search_files_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
         sql = b.get_select_sql(columns='f.uid, o.publicId AS observationId, f.mimeType, '
                                        'f.fileName, s2.name AS semanticType, f.fileTime, f.primaryImage, '
                                        'f.fileSize, f.fileMD5, l.publicId AS obstory_id, l.name AS obstory_name, '
                                        'f.repositoryFname',
                                skip=search.skip,
                                limit=search.limit,
-                               order='f.fileTime DESC')
-        files = list(self.generators.file_generator(sql=sql, sql_args=b.sql_args))
+                               order='f.fileTime DESC, f.uid DESC')
+        self.con.execute(sql, b.sql_args)
+        results = self.con.fetchall()
+        files = self.generators.file_records_from_rows(results)
         rows_returned = len(files)
         total_rows = rows_returned + search.skip
-        if (rows_returned == search.limit > 0) or (rows_returned == 0 and search.skip > 0):
-            self.con.execute(b.get_count_sql(), b.sql_args)
+        continuation = None
+        if rows_returned == search.limit > 0:
+            continuation = mp.encode_continuation_token(results[-1]['fileTime'], results[-1]['uid'])
+        if (rows_returned == search.limit > 0) or (rows_returned == 0 and search.skip > 0) or search.continuation:
+            b_count = search_files_sql_builder(search, use_continuation=False, metadata_key_id=self.get_metadata_key_id)
+            self.con.execute(b_count.get_count_sql(), b_count.sql_args)
             total_rows = self.con.fetchone()['COUNT(*)']
         return {"count": total_rows,
-                "files": files}
+                "files": files,
+                "continuation": continuation}
+
+    def stream_files(self, search, page_size=1000):
+        """
+        Search for :class:`obsarchive_model.FileRecord` entities, yielding them one page at a time from a server-side
+        cursor. Unlike :meth:`search_files`, this never holds more than one page of results in memory, so is suitable
+        for scanning very large numbers of files.
+
+        :param search:
+            an instance of :class:`obsarchive_model.FileRecordSearch` used to constrain the files returned from the DB
+        :param int page_size:
+            the number of rows fetched from the server, and materialised into FileRecords, at a time
+        :return:
+            a generator of :class:`obsarchive_model.FileRecord`
+        """
+        b = search_files_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
+        sql = b.get_select_sql(columns='f.uid, o.publicId AS observationId, f.mimeType, '
+                                       'f.fileName, s2.name AS semanticType, f.fileTime, f.primaryImage, '
+                                       'f.fileSize, f.fileMD5, l.publicId AS obstory_id, l.name AS obstory_name, '
+                                       'f.repositoryFname',
+                               skip=search.skip,
+                               limit=search.limit,
+                               order='f.fileTime DESC, f.uid DESC')
+        return self.generators.file_stream(sql=sql, sql_args=b.sql_args, page_size=page_size)
 
     def register_file(self, observation_id, user_id, file_path, file_time, mime_type, semantic_type,
                       primary_image=False, file_md5=None, file_meta=None, random_id=False):
@@ -444,83 +901,170 @@ ORDER BY time DESC LIMIT 1
         :return:
             The resultant :class:`obsarchive_model.FileRecord` as stored in the database
         """
+        return self.register_files_bulk(files=[{
+            'observation_id': observation_id,
+            'user_id': user_id,
+            'file_path': file_path,
+            'file_time': file_time,
+            'mime_type': mime_type,
+            'semantic_type': semantic_type,
+            'primary_image': primary_image,
+            'file_md5': file_md5,
+            'file_meta': file_meta,
+            'random_id': random_id
+        }])[0]
+
+    def register_files_bulk(self, files):
+        """
+        Register many files in the database in one go, also moving them into the file store. This is much faster than
+        calling :meth:`register_file` repeatedly, since the parent observations, semantic types and metadata fields
+        are each looked up only once, and the new rows are inserted using multi-row INSERT statements. Nothing is
+        committed until :meth:`commit` is called, so a whole batch of files can be registered in a single transaction.
 
-        if file_meta is None:
-            file_meta = []
-
-        # Check that file exists
-        if not os.path.exists(file_path):
-            raise ValueError('No file exists at {0}'.format(file_path))
-
-        # Get checksum for file, and size
-        file_size_bytes = os.stat(file_path).st_size
-        file_name = os.path.split(file_path)[1]
+        :param list files:
+            A list of dictionaries, each containing the keyword arguments which :meth:`register_file` accepts
+        :return:
+            A list of the resultant :class:`obsarchive_model.FileRecord` objects, in the same order as <files>
+        """
 
-        if file_md5 is None:
-            file_md5 = mp.get_md5_hash(file_path)
+        if len(files) == 0:
+            return []
 
-        # Fetch information about parent observation
-        self.con.execute("""
-SELECT obsTime, l.publicId AS obstory_id, l.name AS obstory_name FROM archive_observations o
+        # Fetch information about all of the parent observations
+        observations = {}
+        observation_ids = list(set(item['observation_id'] for item in files))
+        for batch in self.generators._batches(observation_ids, self.generators.batch_size):
+            self.con.execute("""
+SELECT o.uid, o.publicId, obsTime, observatory, l.publicId AS obstory_id, l.name AS obstory_name
+FROM archive_observations o
 INNER JOIN archive_observatories l ON observatory=l.uid
-WHERE o.publicId=%s
-""", (observation_id,))
-        obs = self.con.fetchall()
-        if len(obs) == 0:
-            raise ValueError("No observation with ID <%s>" % observation_id)
-        obs = obs[0]
-
-        # Pick a public Id for this file
-        if random_id:
-            repository_fname = mp.get_hash(obs['obsTime'], obs['obstory_id'], file_name, time.time())
-        else:
-            repository_fname = mp.get_hash(obs['obsTime'], obs['obstory_id'], file_name, obs['obsTime'])
-
-        # Get ID code for obs_type
-        semantic_type_id = self.get_obs_type_id(semantic_type)
-
-        # Insert into database
-        self.con.execute("""
+WHERE o.publicId IN ({})
+""".format(",".join(["%s"] * len(batch))), batch)
+            for obs in self.con.fetchall():
+                observations[obs['publicId']] = obs
+
+        # Get ID codes for semantic types
+        semantic_type_ids = {}
+        for semantic_type in set(item['semantic_type'] for item in files):
+            semantic_type_ids[semantic_type] = self.get_obs_type_id(semantic_type)
+
+        # Check that all the files exist, and work out what they should be called in the file store
+        new_files = []
+        for item in files:
+            file_path = item['file_path']
+
+            # Check that file exists
+            if not os.path.exists(file_path):
+                raise ValueError('No file exists at {0}'.format(file_path))
+
+            # Check that parent observation exists
+            obs = observations.get(item['observation_id'], None)
+            if obs is None:
+                raise ValueError("No observation with ID <%s>" % item['observation_id'])
+
+            # Pick a public Id for this file
+            file_name = os.path.split(file_path)[1]
+            if item.get('random_id', False):
+                repository_fname = mp.get_hash(obs['obsTime'], obs['obstory_id'], file_name, time.time())
+            else:
+                repository_fname = mp.get_hash(obs['obsTime'], obs['obstory_id'], file_name, obs['obsTime'])
+
+            new_files.append((item, obs, file_name, repository_fname))
+
+        # Move the files into the file store. Their checksums are calculated as they are moved, so that each file is
+        # read only once.
+        content_addressed = file_store.content_addressed(file_store_path=self.file_store_path)
+        file_records = []
+        file_rows = []
+        file_metadata = []
+        moved_files = []
+        summary_keys = set(field[0] for field in self.event_summary_fields)
+        summary_observation_uids = []
+        for item, obs, file_name, repository_fname in new_files:
+            file_meta = item.get('file_meta', None)
+            if file_meta is None:
+                file_meta = []
+
+            file_size_bytes = os.stat(item['file_path']).st_size
+            target_file_path = self.file_path_for_id(repository_fname)
+            try:
+                file_md5 = file_store.ingest_file(source_path=item['file_path'], target_path=target_file_path,
+                                                  file_md5=item.get('file_md5', None))
+                moved_files.append((item['file_path'], target_file_path, file_md5))
+            except OSError:
+                sys.stderr.write("Could not move file into repository\n")
+                file_md5 = item.get('file_md5', None)
+                if file_md5 is None:
+                    file_md5 = mp.get_md5_hash(item['file_path'])
+
+            primary_image = item.get('primary_image', False)
+            file_rows.append((obs['uid'], item['mime_type'], file_name, semantic_type_ids[item['semantic_type']],
+                              item['file_time'], file_size_bytes, repository_fname, file_md5, primary_image))
+            file_metadata.extend([(repository_fname, item['user_id'], meta, item['file_time']) for meta in file_meta])
+            if (item['semantic_type'] == self.event_summary_video_type or
+                    any(meta.key in summary_keys for meta in file_meta)):
+                summary_observation_uids.append(obs['uid'])
+
+            file_records.append(mp.FileRecord(obstory_id=obs['obstory_id'],
+                                              obstory_name=obs['obstory_name'],
+                                              observation_id=item['observation_id'],
+                                              repository_fname=repository_fname,
+                                              file_time=item['file_time'],
+                                              file_size=file_size_bytes,
+                                              file_name=file_name,
+                                              mime_type=item['mime_type'],
+                                              semantic_type=item['semantic_type'],
+                                              primary_image=primary_image,
+                                              file_md5=file_md5,
+                                              meta=file_meta
+                                              ))
+
+        # Insert into database. If this fails, put the files back where we found them.
+        try:
+            self.con.executemany("""
 INSERT INTO archive_files
 (observationId, mimeType, fileName, semanticType, fileTime, fileSize, repositoryFname, fileMD5, primaryImage)
-VALUES
-((SELECT uid FROM archive_observations WHERE publicId=%s), %s, %s, %s, %s, %s, %s, %s, %s);
-""", (observation_id, mime_type, file_name, semantic_type_id, file_time, file_size_bytes,
-      repository_fname, file_md5, primary_image))
-
-        # Move the original file from its path
-        target_file_path = os.path.join(self.file_store_path, repository_fname)
-        try:
-            shutil.move(file_path, target_file_path)
-        except OSError:
-            sys.stderr.write("Could not move file into repository\n")
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+""", file_rows)
+        except MySQLdb.Error:
+            for file_path, target_file_path, file_md5 in moved_files:
+                file_store.ingest_file(source_path=target_file_path, target_path=file_path, file_md5=file_md5)
+            raise
+
+        # In a content-addressed file store, files whose contents are already stored become links. This is only done
+        # once the files have rows in the database, so that a failed INSERT cannot leave behind unused blobs.
+        if content_addressed:
+            for file_path, target_file_path, file_md5 in moved_files:
+                try:
+                    file_store.link_to_blob(file_store_path=self.file_store_path, file_path=target_file_path,
+                                            file_md5=file_md5)
+                except OSError:
+                    sys.stderr.write("Could not link file to blob in repository\n")
 
         # Store the file metadata
-        for meta in file_meta:
-            self.set_file_metadata(user_id, repository_fname, meta, file_time)
-
-        result_file = mp.FileRecord(obstory_id=obs['obstory_id'],
-                                    obstory_name=obs['obstory_name'],
-                                    observation_id=observation_id,
-                                    repository_fname=repository_fname,
-                                    file_time=file_time,
-                                    file_size=file_size_bytes,
-                                    file_name=file_name,
-                                    mime_type=mime_type,
-                                    semantic_type=semantic_type,
-                                    primary_image=primary_image,
-                                    file_md5=file_md5,
-                                    meta=file_meta
-                                    )
-
-        # Return the resultant file object
-        return result_file
+        self.set_metadata_bulk(entity_type='file', items=file_metadata, update_event_summary=False,
+                               update_file_usage=False)
+
+        # Update the event summary table with new video files and their metadata
+        self.refresh_event_summary(observation_uids=summary_observation_uids)
+
+        # Update the file usage table with the hours in which the new files were recorded
+        self.refresh_file_usage(buckets=[(observations[item['observation_id']]['observatory'], item['file_time'])
+                                         for item in files])
+
+        # Return the resultant file objects
+        return file_records
 
     def import_file(self, file_item, user_id):
         if self.has_file_id(file_item.repository_fname):
             return
-        if not self.has_observation_id(file_item.observation_id):
+        self.con.execute('SELECT uid, observatory FROM archive_observations WHERE publicId=%s',
+                         (file_item.observation_id,))
+        results = self.con.fetchall()
+        if len(results) < 1:
             raise ValueError("No observation with ID <%s>" % file_item.observation_id)
+        observation_uid = results[0]['uid']
+        obstory_uid = results[0]['observatory']
 
         # Get ID code for obs_type
         semantic_type_id = self.get_obs_type_id(file_item.semantic_type)
@@ -530,15 +1074,22 @@ VALUES
 INSERT INTO archive_files
 (observationId, mimeType, fileName, semanticType, fileTime, fileSize, repositoryFname, fileMD5, primaryImage)
 VALUES
-((SELECT uid FROM archive_observations WHERE publicId=%s), %s, %s, %s, %s, %s, %s, %s, %s);
+(%s, %s, %s, %s, %s, %s, %s, %s, %s);
 """, (
-            file_item.observation_id, file_item.mime_type, file_item.file_name, semantic_type_id,
+            observation_uid, file_item.mime_type, file_item.file_name, semantic_type_id,
             file_item.file_time, file_item.file_size,
             file_item.repository_fname, file_item.file_md5, file_item.primary_image))
 
         # Store the file metadata
-        for meta in file_item.meta:
-            self.set_file_metadata(user_id, file_item.repository_fname, meta, file_item.file_time)
+        self.set_metadata_bulk(entity_type='file',
+                               items=[(file_item.repository_fname, user_id, meta, file_item.file_time)
+                                      for meta in file_item.meta],
+                               update_file_usage=False)
+        self.refresh_file_usage(buckets=[(obstory_uid, file_item.file_time)])
+
+        # Update the event summary table if this is a new video file
+        if file_item.semantic_type == self.event_summary_video_type:
+            self.refresh_event_summary(observation_uids=[observation_uid])
 
     def set_file_metadata(self, user_id, file_id, meta, utc=None):
         meta_id = self.get_metadata_key_id(meta.key)
@@ -559,12 +1110,16 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_files WHERE repositoryF
             meta.string_value(),
             meta.float_value(),
             file_id))
+        self._refresh_event_summary_after_edit(entity_type='file', entity_id=file_id, key=meta.key)
+        self._refresh_file_usage_after_edit(file_id=file_id, key=meta.key)
 
     def unset_file_metadata(self, file_id, key):
         meta_id = self.get_metadata_key_id(key)
         self.con.execute("DELETE FROM archive_metadata WHERE "
                          "fieldId=%s AND fileId=(SELECT uid FROM archive_files WHERE repositoryFname=%s);",
                          (meta_id, file_id))
+        self._refresh_event_summary_after_edit(entity_type='file', entity_id=file_id, key=key)
+        self._refresh_file_usage_after_edit(file_id=file_id, key=key)
 
     def get_file_metadata(self, file_id, key):
         meta_id = self.get_metadata_key_id(key)
@@ -591,23 +1146,19 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_files WHERE repositoryF
         self.con.execute('SELECT 1 FROM archive_observations WHERE publicId=%s', (observation_id,))
         return len(self.con.fetchall()) > 0
 
-    def get_obs_type_id(self, name):
-        self.con.execute("SELECT uid FROM archive_semanticTypes WHERE name=%s;", (name,))
-        results = self.con.fetchall()
-        if len(results) < 1:
-            self.con.execute("INSERT INTO archive_semanticTypes (name) VALUES (%s);", (name,))
-            self.con.execute("SELECT uid FROM archive_semanticTypes WHERE name=%s;", (name,))
-            results = self.con.fetchall()
-        return results[0]['uid']
+    def get_obs_type_id(self, name, create=True):
+        return self._look_up_interned_id(
+            table='archive_semanticTypes', name=name,
+            select_sql="SELECT uid FROM archive_semanticTypes WHERE name=%s;",
+            insert_sql="INSERT INTO archive_semanticTypes (name) VALUES (%s);" if create else None,
+            insert_args=(name,))
 
     def get_source_id(self, name):
-        self.con.execute("SELECT sourceId FROM pigazing_sources WHERE name=%s;", (name,))
-        results = self.con.fetchall()
-        if len(results) < 1:
-            self.con.execute("INSERT INTO pigazing_sources (abbrev, name) VALUES (%s, %s);", (name, name))
-            self.con.execute("SELECT sourceId FROM pigazing_sources WHERE name=%s;", (name,))
-            results = self.con.fetchall()
-        return results[0]['sourceId']
+        return self._look_up_interned_id(
+            table='pigazing_sources', name=name,
+            select_sql="SELECT sourceId AS uid FROM pigazing_sources WHERE name=%s;",
+            insert_sql="INSERT INTO pigazing_sources (abbrev, name) VALUES (%s, %s);",
+            insert_args=(name, name))
 
     def delete_observation(self, observation_id):
         self.con.execute('SELECT repositoryFname FROM archive_files f '
@@ -615,7 +1166,10 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_files WHERE repositoryF
                          'WHERE o.publicId=%s;', (observation_id,))
         for file_item in self.con.fetchall():
             self.delete_file(file_item['repositoryFname'])
+        self.con.execute('SELECT observatory, obsTime FROM archive_observations WHERE publicId=%s', (observation_id,))
+        buckets = [(item['observatory'], item['obsTime']) for item in self.con.fetchall()]
         self.con.execute('DELETE FROM archive_observations WHERE publicId=%s', (observation_id,))
+        self.refresh_activity(buckets=buckets)
 
     def get_observation(self, observation_id):
         """
@@ -627,7 +1181,7 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_files WHERE repositoryF
             A :class:`obsarchive_model.Observation` instance, or None if not found
         """
         search = mp.ObservationSearch(observation_id=observation_id)
-        b = search_observations_sql_builder(search)
+        b = search_observations_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
         sql = b.get_select_sql(columns='l.publicId AS obstory_id, l.name AS obstory_name, l.userId AS obstory_owner, '
                                        'o.obsTime, s.name AS obsType, o.publicId, o.uid, o.creationTime, '
                                        'o.published, o.moderated, o.featured, ST_X(o.position) AS ra, '
@@ -651,10 +1205,11 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_files WHERE repositoryF
             an instance of :class:`obsarchive_model.ObservationSearch` used to constrain the observations returned from
             the DB
         :return:
-            a structure of {count:int total rows of an unrestricted search, observations:list of
-            :class:`obsarchive_model.Observation`}
+            a structure of {count:int total rows of an unrestricted search, obs:list of
+            :class:`obsarchive_model.Observation`, continuation:token to pass in the search for the next page of
+            results, or None if there are no more results}
         """
-        b = search_observations_sql_builder(search)
+        b = search_observations_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
         sql = b.get_select_sql(columns='l.publicId AS obstory_id, l.name AS obstory_name, l.userId AS obstory_owner, '
                                        'o.obsTime, s.name AS obsType, o.publicId, o.uid, o.creationTime, '
                                        'o.published, o.moderated, o.featured, ST_X(o.position) AS ra, '
@@ -666,15 +1221,52 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_files WHERE repositoryF
                                        '    AS astrometrySource ',
                                skip=search.skip,
                                limit=search.limit,
-                               order='o.obsTime DESC')
-        obs = list(self.generators.observation_generator(sql=sql, sql_args=b.sql_args))
+                               order='o.obsTime DESC, o.uid DESC')
+        self.con.execute(sql, b.sql_args)
+        results = self.con.fetchall()
+        obs = self.generators.observations_from_rows(results)
         rows_returned = len(obs)
         total_rows = rows_returned + search.skip
-        if (rows_returned == search.limit > 0) or (rows_returned == 0 and search.skip > 0):
-            self.con.execute(b.get_count_sql(), b.sql_args)
+        continuation = None
+        if rows_returned == search.limit > 0:
+            continuation = mp.encode_continuation_token(results[-1]['obsTime'], results[-1]['uid'])
+        if (rows_returned == search.limit > 0) or (rows_returned == 0 and search.skip > 0) or search.continuation:
+            b_count = search_observations_sql_builder(search, use_continuation=False,
+                                                      metadata_key_id=self.get_metadata_key_id)
+            self.con.execute(b_count.get_count_sql(), b_count.sql_args)
             total_rows = self.con.fetchone()['COUNT(*)']
         return {"count": total_rows,
-                "obs": obs}
+                "obs": obs,
+                "continuation": continuation}
+
+    def stream_observations(self, search, page_size=1000):
+        """
+        Search for :class:`obsarchive_model.Observation` entities, yielding them one page at a time from a server-side
+        cursor. Unlike :meth:`search_observations`, this never holds more than one page of results in memory, so is
+        suitable for scanning very large numbers of observations.
+
+        :param search:
+            an instance of :class:`obsarchive_model.ObservationSearch` used to constrain the observations returned from
+            the DB
+        :param int page_size:
+            the number of rows fetched from the server, and materialised into Observations, at a time
+        :return:
+            a generator of :class:`obsarchive_model.Observation`
+        """
+        b = search_observations_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
+        sql = b.get_select_sql(columns='l.publicId AS obstory_id, l.name AS obstory_name, l.userId AS obstory_owner, '
+                                       'o.obsTime, s.name AS obsType, o.publicId, o.uid, o.creationTime, '
+                                       'o.published, o.moderated, o.featured, ST_X(o.position) AS ra, '
+                                       'ST_Y(o.position) AS decl, o.fieldWidth, o.fieldHeight, o.positionAngle, '
+                                       'o.centralConstellation, '
+                                       'ST_X(o.altAz) AS altitude, ST_Y(o.altAz) AS azimuth, o.altAzPositionAngle, '
+                                       'o.astrometryProcessed, o.astrometryProcessingTime, '
+                                       '(SELECT abbrev FROM pigazing_sources WHERE sourceId=o.astrometrySource) '
+                                       '    AS astrometrySource ',
+                               skip=search.skip,
+                               limit=search.limit,
+                               order='o.obsTime DESC, o.uid DESC')
+        return self.generators.observation_stream(sql=sql, sql_args=b.sql_args, page_size=page_size)
 
     def register_observation(self, obstory_id, user_id, obs_time, obs_type, creation_time, published, moderated,
                              featured, ra, dec, field_width, field_height, position_angle, central_constellation,
@@ -733,36 +1325,130 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_files WHERE repositoryF
             The :class:`obsarchive_model.Observation` as stored in the database
         """
 
-        if obs_meta is None:
-            obs_meta = []
-
-        # Get obstory id from name
-        obstory = self.get_obstory_from_id(obstory_id)
+        return self.register_observations_bulk(observations=[{
+            'obstory_id': obstory_id,
+            'user_id': user_id,
+            'obs_time': obs_time,
+            'obs_type': obs_type,
+            'creation_time': creation_time,
+            'published': published,
+            'moderated': moderated,
+            'featured': featured,
+            'ra': ra,
+            'dec': dec,
+            'field_width': field_width,
+            'field_height': field_height,
+            'position_angle': position_angle,
+            'central_constellation': central_constellation,
+            'altitude': altitude,
+            'azimuth': azimuth,
+            'alt_az_pa': alt_az_pa,
+            'astrometry_processed': astrometry_processed,
+            'astrometry_processing_time': astrometry_processing_time,
+            'astrometry_source': astrometry_source,
+            'obs_meta': obs_meta,
+            'random_id': random_id
+        }])[0]
+
+    def register_observations_bulk(self, observations):
+        """
+        Register many new observations in one go. This is much faster than calling :meth:`register_observation`
+        repeatedly, since the observatories, semantic types, astrometry sources and metadata fields are each looked up
+        only once, and the new rows are inserted using multi-row INSERT statements. Nothing is committed until
+        :meth:`commit` is called, so a whole batch of observations can be registered in a single transaction.
 
-        # Create a unique ID for this observation
-        if random_id:
-            observation_id = mp.get_hash(obs_time, obstory['publicId'], obs_type, time.time())
-        else:
-            observation_id = mp.get_hash(obs_time, obstory['publicId'], obs_type)
+        :param list observations:
+            A list of dictionaries, each containing the keyword arguments which :meth:`register_observation` accepts
+        :return:
+            A list of the resultant :class:`obsarchive_model.Observation` objects, in the same order as <observations>
+        """
 
-        # Get ID code for obs_type
-        obs_type_id = self.get_obs_type_id(obs_type)
+        if len(observations) == 0:
+            return []
 
-        # Get a polygon representing the sky area of this image
-        sky_area = get_sky_area(ra=ra, dec=dec, pa=position_angle, scale_x=field_width, scale_y=field_height)
+        # Get obstories from their IDs
+        obstories = {}
+        for obstory_id in set(item['obstory_id'] for item in observations):
+            obstories[obstory_id] = self.get_obstory_from_id(obstory_id)
 
-        # Get ID for the source of astrometry
-        if astrometry_source:
-            astrometry_source_id = self.get_source_id(name=astrometry_source)
-        else:
-            astrometry_source_id = None
+        # Get ID codes for obs_types
+        obs_type_ids = {}
+        for obs_type in set(item['obs_type'] for item in observations):
+            obs_type_ids[obs_type] = self.get_obs_type_id(obs_type)
 
-        # Convert times into calendar dates to aid indexing of observations
-        observed_calendar_date = inv_julian_day(jd_from_unix(obs_time))
-        published_calendar_date = inv_julian_day(jd_from_unix(creation_time))
+        # Get IDs for the sources of astrometry
+        source_ids = {None: None}
+        for astrometry_source in set(item['astrometry_source'] for item in observations):
+            if astrometry_source and (astrometry_source not in source_ids):
+                source_ids[astrometry_source] = self.get_source_id(name=astrometry_source)
 
-        # Insert into database
-        self.con.execute("""
+        output = []
+        observation_rows = []
+        observation_metadata = []
+        for item in observations:
+            obstory = obstories[item['obstory_id']]
+            obs_meta = item.get('obs_meta', None)
+            if obs_meta is None:
+                obs_meta = []
+
+            # Create a unique ID for this observation
+            if item.get('random_id', False):
+                observation_id = mp.get_hash(item['obs_time'], obstory['publicId'], item['obs_type'], time.time())
+            else:
+                observation_id = mp.get_hash(item['obs_time'], obstory['publicId'], item['obs_type'])
+
+            # Get a polygon representing the sky area of this image
+            sky_area = get_sky_area(ra=item['ra'], dec=item['dec'], pa=item['position_angle'],
+                                    scale_x=item['field_width'], scale_y=item['field_height'])
+
+            # Convert times into calendar dates to aid indexing of observations
+            observed_calendar_date = inv_julian_day(jd_from_unix(item['obs_time']))
+            published_calendar_date = inv_julian_day(jd_from_unix(item['creation_time']))
+
+            observation_rows.append(
+                (observation_id, obstory['uid'], item['user_id'], item['obs_time'], obs_type_ids[item['obs_type']],
+                 item['creation_time'], item['published'], item['moderated'],
+                 item['featured'], item['ra'], item['dec'], item['field_width'], item['field_height'],
+                 item['position_angle'], item['central_constellation'],
+                 item['altitude'], item['azimuth'], item['alt_az_pa'],
+                 item['astrometry_processed'], item['astrometry_processing_time'],
+                 source_ids[item['astrometry_source'] or None],
+                 sky_area,
+                 observed_calendar_date[0], observed_calendar_date[1], observed_calendar_date[2],
+                 published_calendar_date[0], published_calendar_date[1], published_calendar_date[2]
+                 ))
+            observation_metadata.extend([(observation_id, item['user_id'], meta, item['obs_time'])
+                                         for meta in obs_meta])
+
+            output.append(mp.Observation(obstory_name=obstory['name'],
+                                         obstory_id=obstory['publicId'],
+                                         obstory_owner=obstory['userId'],
+                                         obs_time=item['obs_time'],
+                                         obs_id=observation_id,
+                                         obs_type=item['obs_type'],
+                                         creation_time=item['creation_time'],
+                                         published=item['published'],
+                                         moderated=item['moderated'],
+                                         featured=item['featured'],
+                                         ra=item['ra'],
+                                         dec=item['dec'],
+                                         field_width=item['field_width'],
+                                         field_height=item['field_height'],
+                                         position_angle=item['position_angle'],
+                                         central_constellation=item['central_constellation'],
+                                         altitude=item['altitude'],
+                                         azimuth=item['azimuth'],
+                                         alt_az_pa=item['alt_az_pa'],
+                                         astrometry_processed=item['astrometry_processed'],
+                                         astrometry_processing_time=item['astrometry_processing_time'],
+                                         astrometry_source=item['astrometry_source'],
+                                         file_records=[],
+                                         meta=obs_meta))
+
+        # Insert into database. MySQLdb's executemany() cannot batch rows containing function calls such as POINT(),
+        # so we build multi-row INSERT statements ourselves.
+        for batch in self.generators._batches(observation_rows, self.generators.batch_size):
+            self.con.execute("""
 INSERT INTO archive_observations (publicId, observatory, userId, obsTime, obsType, creationTime, published, moderated,
                                   featured, position, fieldWidth, fieldHeight, positionAngle, centralConstellation,
                                   altAz, altAzPositionAngle,
@@ -771,59 +1457,30 @@ INSERT INTO archive_observations (publicId, observatory, userId, obsTime, obsTyp
                                   derived_observed_year, derived_observed_month, derived_observed_day,
                                   derived_published_year, derived_published_month, derived_published_day)
 VALUES
+""" + ",\n".join(["""
 (%s, %s, %s, %s, %s, %s, %s, %s,
  %s, POINT(%s, %s), %s, %s, %s, %s,
  POINT(%s, %s), %s,
  %s, %s, %s,
  ST_GEOMFROMTEXT(%s),
- %s, %s, %s, %s, %s, %s);
-""",
-                         (observation_id, obstory['uid'], user_id, obs_time, obs_type_id,
-                          creation_time, published, moderated,
-                          featured, ra, dec, field_width, field_height, position_angle, central_constellation,
-                          altitude, azimuth, alt_az_pa,
-                          astrometry_processed, astrometry_processing_time, astrometry_source_id,
-                          sky_area,
-                          observed_calendar_date[0], observed_calendar_date[1], observed_calendar_date[2],
-                          published_calendar_date[0], published_calendar_date[1], published_calendar_date[2]
-                          ))
+ %s, %s, %s, %s, %s, %s)"""] * len(batch)) + ";", [value for row in batch for value in row])
+
+        # Update the counts of observations in each hour
+        self.refresh_activity(buckets=[(row[1], row[3]) for row in observation_rows])
 
         # Store the observation metadata
-        for meta in obs_meta:
-            self.set_observation_metadata(user_id, observation_id, meta, obs_time)
-
-        observation = mp.Observation(obstory_name=obstory['name'],
-                                     obstory_id=obstory['publicId'],
-                                     obstory_owner=obstory['userId'],
-                                     obs_time=obs_time,
-                                     obs_id=observation_id,
-                                     obs_type=obs_type,
-                                     creation_time=creation_time,
-                                     published=published,
-                                     moderated=moderated,
-                                     featured=featured,
-                                     ra=ra,
-                                     dec=dec,
-                                     field_width=field_width,
-                                     field_height=field_height,
-                                     position_angle=position_angle,
-                                     central_constellation=central_constellation,
-                                     altitude=altitude,
-                                     azimuth=azimuth,
-                                     alt_az_pa=alt_az_pa,
-                                     astrometry_processed=astrometry_processed,
-                                     astrometry_processing_time=astrometry_processing_time,
-                                     astrometry_source=astrometry_source,
-                                     file_records=[],
-                                     meta=obs_meta)
-        return observation
+        self.set_metadata_bulk(entity_type='observation', items=observation_metadata)
+
+        return output
 
     def import_observation(self, observation, user_id):
         if self.has_observation_id(observation.obs_id):
             return
 
         # Get obstory id from name
-        obstory = self.get_obstory_from_id(observation.obstory_id)
+        obstory_uid = self.get_obstory_uid(observation.obstory_id)
+        if obstory_uid is None:
+            raise ValueError("No such obstory: {}".format(observation.obstory_id))
 
         # Get ID code for obs_type
         obs_type_id = self.get_obs_type_id(observation.obs_type)
@@ -861,7 +1518,7 @@ VALUES
  ST_GEOMFROMTEXT(%s),
  %s, %s, %s, %s, %s, %s);
 """,
-                         (observation.obs_id, obstory['uid'], user_id, observation.obs_time, obs_type_id,
+                         (observation.obs_id, obstory_uid, user_id, observation.obs_time, obs_type_id,
                           observation.creation_time, observation.published, observation.moderated,
                           observation.featured, observation.ra, observation.dec,
                           observation.field_width, observation.field_height,
@@ -873,9 +1530,12 @@ VALUES
                           published_calendar_date[0], published_calendar_date[1], published_calendar_date[2]
                           ))
 
+        # Update the count of observations in this hour
+        self.refresh_activity(buckets=[(obstory_uid, observation.obs_time)])
+
         # Store the observation metadata
-        for meta in observation.meta:
-            self.set_observation_metadata(user_id, observation.obs_id, meta)
+        self.set_metadata_bulk(entity_type='observation',
+                               items=[(observation.obs_id, user_id, meta, None) for meta in observation.meta])
 
     def set_observation_metadata(self, user_id, observation_id, meta, utc=None):
         meta_id = self.get_metadata_key_id(meta.key)
@@ -896,12 +1556,14 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_observations WHERE publ
             meta.string_value(),
             meta.float_value(),
             observation_id))
+        self._refresh_event_summary_after_edit(entity_type='observation', entity_id=observation_id, key=meta.key)
 
     def unset_observation_metadata(self, observation_id, key):
         meta_id = self.get_metadata_key_id(key)
         self.con.execute("DELETE FROM archive_metadata WHERE "
                          "fieldId=%s AND observationId=(SELECT uid FROM archive_observations WHERE publicId=%s);",
                          (meta_id, observation_id))
+        self._refresh_event_summary_after_edit(entity_type='observation', entity_id=observation_id, key=key)
 
     def get_observation_metadata(self, observation_id, key):
         meta_id = self.get_metadata_key_id(key)
@@ -938,6 +1600,383 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_observations WHERE publ
                          "observationId=(SELECT uid FROM archive_observations WHERE publicId=%s);",
                          (uid, observation_id))
 
+    # Functions relating to the event summary table
+    def refresh_event_summary(self, observation_uids=None):
+        """
+        Recompute rows of the denormalised table <archive_event_summary>, which holds the metadata most often needed
+        by scripts which analyse moving objects, together with the uid of each object's video file. This is called
+        automatically whenever any of these metadata fields are changed through this class.
+
+        :param observation_uids:
+            List of the uids of the observations to refresh, or None to rebuild the whole table. Observations which
+            are not moving objects are ignored.
+        :return:
+            None
+        """
+        if observation_uids is None:
+            self.con.execute("DELETE FROM archive_event_summary;")
+            batches = [None]
+        else:
+            observation_uids = list(set(observation_uids))
+            if len(observation_uids) == 0:
+                return
+            batches = self.generators._batches(observation_uids, self.generators.batch_size)
+
+        # Each column takes its value from the video file if set there, or otherwise from the observation
+        columns = []
+        column_args = []
+        for key, column, value_column, on_file in self.event_summary_fields:
+            field_id = self.get_metadata_key_id(key)
+            obs_value = "(SELECT m.{} FROM archive_metadata m WHERE m.fieldId=%s AND m.observationId=e.uid)". \
+                format(value_column)
+            if on_file:
+                columns.append("COALESCE((SELECT m.{} FROM archive_metadata m WHERE m.fieldId=%s AND "
+                               "m.fileId=e.videoFileId), {})".format(value_column, obs_value))
+                column_args.extend([field_id, field_id])
+            else:
+                columns.append(obs_value)
+                column_args.append(field_id)
+
+        video_type_id = self.get_obs_type_id(self.event_summary_video_type)
+        moving_object_type_id = self.get_obs_type_id('pigazing:movingObject/')
+
+        for batch in batches:
+            where = ["o.obsType=%s"]
+            args = column_args + [video_type_id, moving_object_type_id]
+            if batch is not None:
+                where.append("o.uid IN ({})".format(",".join(["%s"] * len(batch))))
+                args.extend(batch)
+
+            self.con.execute("""
+REPLACE INTO archive_event_summary
+(observationId, observatory, obsTime, videoFileId, {columns})
+SELECT e.uid, e.observatory, e.obsTime, e.videoFileId, {values}
+FROM (
+    SELECT o.uid, o.observatory, o.obsTime,
+        (SELECT MIN(f.uid) FROM archive_files f WHERE f.observationId=o.uid AND f.semanticType=%s) AS videoFileId
+    FROM archive_observations o
+    WHERE {where}
+) e;
+""".format(columns=", ".join(item[1] for item in self.event_summary_fields),
+           values=", ".join(columns),
+           where=" AND ".join(where)), args)
+
+    def _refresh_event_summary_after_edit(self, entity_type, entity_id, key):
+        """
+        Refresh the row of <archive_event_summary> for a single observation, after a metadata field has been changed on
+        the observation or on one of its files.
+
+        :param string entity_type:
+            Either 'file' or 'observation'
+        :param string entity_id:
+            The ID of the file or observation whose metadata was changed
+        :param string key:
+            The metadata key which was changed. Nothing is done if it is not one of <event_summary_fields>.
+        :return:
+            None
+        """
+        if key not in set(field[0] for field in self.event_summary_fields):
+            return
+        if entity_type == 'file':
+            self.con.execute("SELECT observationId AS uid FROM archive_files WHERE repositoryFname=%s;", (entity_id,))
+        else:
+            self.con.execute("SELECT uid FROM archive_observations WHERE publicId=%s;", (entity_id,))
+        self.refresh_event_summary(observation_uids=[item['uid'] for item in self.con.fetchall()])
+
+    def bulk_load_events(self, utc_min=None, utc_max=None, category=None):
+        """
+        Fetch all the moving objects observed within a span of time, together with the metadata needed to analyse
+        them, with a single range scan of <archive_event_summary>. This is much faster than calling
+        :meth:`get_observation` and :meth:`get_file` on each object in turn. Objects are included once they have a
+        video file, or any of the metadata fields in <event_summary_fields>.
+
+        :param utc_min:
+            Only return objects observed at or after this unix time
+        :param utc_max:
+            Only return objects observed at or before this unix time
+        :param category:
+            Only return objects with this web:category
+        :return:
+            A list of dictionaries, in order of observation time, each containing the keys 'observationId', 'obsTime',
+            'observatory' (the publicId of the observatory), 'repositoryFname' (the ID of the video file, or None),
+            'category' and 'metadata'. The last of these is a dictionary of the values of the metadata fields in
+            <event_summary_fields>, indexed by key, with fields which are not set being omitted.
+        """
+        where = ["1"]
+        args = []
+        if utc_min is not None:
+            where.append("e.obsTime>=%s")
+            args.append(utc_min)
+        if utc_max is not None:
+            where.append("e.obsTime<=%s")
+            args.append(utc_max)
+        if category is not None:
+            where.append("e.category=%s")
+            args.append(category)
+
+        self.con.execute("""
+SELECT o.publicId AS observationId, e.obsTime, l.publicId AS observatory, f.repositoryFname, {columns}
+FROM archive_event_summary e
+INNER JOIN archive_observations o ON e.observationId = o.uid
+INNER JOIN archive_observatories l ON e.observatory = l.uid
+LEFT OUTER JOIN archive_files f ON e.videoFileId = f.uid
+WHERE {where}
+ORDER BY e.obsTime;
+""".format(columns=", ".join("e.{}".format(item[1]) for item in self.event_summary_fields),
+           where=" AND ".join(where)), args)
+
+        output = []
+        for row in self.con.fetchall():
+            output.append({
+                'observationId': row['observationId'],
+                'obsTime': row['obsTime'],
+                'observatory': row['observatory'],
+                'repositoryFname': row['repositoryFname'],
+                'category': row['category'],
+                'metadata': {key: row[column] for key, column, value_column, on_file in self.event_summary_fields
+                             if row[column] is not None}
+            })
+        return output
+
+    # Functions relating to the activity rollup table
+    def refresh_activity(self, buckets=None):
+        """
+        Recompute rows of the table <archive_activityHourly>, which counts the observations of each semantic type made
+        by each observatory in each hour. This is called automatically whenever observations are registered or
+        deleted through this class.
+
+        :param buckets:
+            List of (observatory uid, unix time) tuples, identifying the hours to recompute, or None to rebuild the
+            whole table
+        :return:
+            None
+        """
+        if buckets is None:
+            self.con.execute("DELETE FROM archive_activityHourly;")
+            self.con.execute("""
+INSERT INTO archive_activityHourly (observatory, semanticType, hourIndex, observationCount)
+SELECT observatory, obsType, FLOOR(obsTime / 3600) AS hourIndex, COUNT(*)
+FROM archive_observations
+GROUP BY observatory, obsType, hourIndex;
+""")
+            return
+
+        hours = sorted(set((observatory, int(math.floor(utc / 3600))) for observatory, utc in buckets))
+        for batch in self.generators._batches(hours, self.generators.batch_size):
+            self.con.execute("DELETE FROM archive_activityHourly WHERE (observatory, hourIndex) IN ({});".format(
+                ",".join(["(%s, %s)"] * len(batch))), [value for hour in batch for value in hour])
+            self.con.execute("""
+INSERT INTO archive_activityHourly (observatory, semanticType, hourIndex, observationCount)
+SELECT observatory, obsType, FLOOR(obsTime / 3600) AS hourIndex, COUNT(*)
+FROM archive_observations
+WHERE {}
+GROUP BY observatory, obsType, hourIndex;
+""".format(" OR ".join(["(observatory=%s AND obsTime>=%s AND obsTime<%s)"] * len(batch))),
+                             [value for observatory, hour in batch for value in (observatory, hour * 3600,
+                                                                                 (hour + 1) * 3600)])
+
+    def get_activity(self, obstory_id, semantic_type, utc_min, utc_max, period, max_bins=250):
+        """
+        Count the observations of a particular type made by an observatory in a sequence of time intervals. Where the
+        intervals are whole hours, the counts are read from the table <archive_activityHourly>; otherwise they are
+        counted from <archive_observations>. In either case, a single GROUP BY query is used.
+
+        :param string obstory_id:
+            The publicId of the observatory
+        :param string semantic_type:
+            The semantic type of the observations to count
+        :param float utc_min:
+            The start of the first time interval
+        :param float utc_max:
+            The time at which the last time interval should end. Intervals stop once they pass this time.
+        :param float period:
+            The length of each time interval, in seconds
+        :param int max_bins:
+            The maximum number of time intervals to return
+        :return:
+            A list of the number of observations in each time interval
+        """
+        if not period > 0:
+            raise ValueError("Time interval must be positive, not <{}>".format(period))
+        bin_count = int(min(max_bins, max(1, math.ceil((utc_max - utc_min) / period))))
+        output = [0] * bin_count
+
+        obstory_uid = self.get_obstory_uid(obstory_id)
+        semantic_type_id = self.get_obs_type_id(semantic_type, create=False)
+        if obstory_uid is None or semantic_type_id is None:
+            return output
+
+        if utc_min % 3600 == 0 and period % 3600 == 0:
+            self.con.execute("""
+SELECT FLOOR((hourIndex * 3600 - %s) / %s) AS bin, SUM(observationCount) AS count
+FROM archive_activityHourly
+WHERE observatory=%s AND semanticType=%s AND hourIndex>=%s AND hourIndex<%s
+GROUP BY bin;
+""", (utc_min, period, obstory_uid, semantic_type_id, utc_min / 3600, (utc_min + period * bin_count) / 3600))
+        else:
+            self.con.execute("""
+SELECT FLOOR((obsTime - %s) / %s) AS bin, COUNT(*) AS count
+FROM archive_observations
+WHERE observatory=%s AND obsType=%s AND obsTime>=%s AND obsTime<%s
+GROUP BY bin;
+""", (utc_min, period, obstory_uid, semantic_type_id, utc_min, utc_min + period * bin_count))
+
+        for item in self.con.fetchall():
+            if 0 <= item['bin'] < bin_count:
+                output[int(item['bin'])] += int(item['count'])
+        return output
+
+    # Functions relating to the file usage rollup table
+    def refresh_file_usage(self, buckets=None):
+        """
+        Recompute rows of the table <archive_fileUsageHourly>, which holds the number and total size of the files of
+        each semantic type recorded by each observatory in each hour, together with sums of the metadata listed in
+        <file_usage_fields>. This is called automatically whenever files or their metadata are changed through this
+        class.
+
+        :param buckets:
+            List of (observatory uid, unix time) tuples, identifying the hours to recompute, or None to rebuild the
+            whole table
+        :return:
+            None
+        """
+        columns = ["fileCount", "totalBytes"]
+        values = ["COUNT(*)", "SUM(f.fileSize)"]
+        joins = []
+        join_args = []
+        for index, (key, prefix) in enumerate(self.file_usage_fields):
+            columns.extend(["{}Count".format(prefix), "{}Sum".format(prefix)])
+            values.extend(["COUNT(m{0}.floatValue)".format(index), "COALESCE(SUM(m{0}.floatValue), 0)".format(index)])
+            joins.append("LEFT OUTER JOIN archive_metadata m{0} ON m{0}.fileId=f.uid AND m{0}.fieldId=%s".format(index))
+            join_args.append(self.get_metadata_key_id(key))
+
+        sql = """
+INSERT INTO archive_fileUsageHourly (observatory, obsType, semanticType, hourIndex, {columns})
+SELECT o.observatory, o.obsType, f.semanticType, FLOOR(f.fileTime / 3600) AS hourIndex, {values}
+FROM archive_files f
+INNER JOIN archive_observations o ON f.observationId = o.uid
+{joins}
+WHERE {{}}
+GROUP BY o.observatory, o.obsType, f.semanticType, hourIndex;
+""".format(columns=", ".join(columns), values=", ".join(values), joins="\n".join(joins))
+
+        if buckets is None:
+            self.con.execute("DELETE FROM archive_fileUsageHourly;")
+            self.con.execute(sql.format("1"), join_args)
+            return
+
+        hours = sorted(set((observatory, int(math.floor(utc / 3600))) for observatory, utc in buckets))
+        for batch in self.generators._batches(hours, self.generators.batch_size):
+            self.con.execute("DELETE FROM archive_fileUsageHourly WHERE (observatory, hourIndex) IN ({});".format(
+                ",".join(["(%s, %s)"] * len(batch))), [value for hour in batch for value in hour])
+            self.con.execute(sql.format(" OR ".join(["(o.observatory=%s AND f.fileTime>=%s AND f.fileTime<%s)"] *
+                                                    len(batch))),
+                             join_args + [value for observatory, hour in batch
+                                          for value in (observatory, hour * 3600, (hour + 1) * 3600)])
+
+    def _file_usage_buckets(self, file_uids):
+        """
+        Look up the hours of <archive_fileUsageHourly> which hold a list of files.
+
+        :param list file_uids:
+            The uids of the files
+        :return:
+            List of (observatory uid, unix time) tuples, as accepted by :meth:`refresh_file_usage`
+        """
+        buckets = []
+        for batch in self.generators._batches(sorted(set(file_uids)), self.generators.batch_size):
+            self.con.execute("""
+SELECT o.observatory, f.fileTime
+FROM archive_files f
+INNER JOIN archive_observations o ON f.observationId = o.uid
+WHERE f.uid IN ({});
+""".format(",".join(["%s"] * len(batch))), batch)
+            buckets.extend((item['observatory'], item['fileTime']) for item in self.con.fetchall())
+        return buckets
+
+    def _refresh_file_usage_after_edit(self, file_id, key):
+        """
+        Refresh the row of <archive_fileUsageHourly> which includes a file, after one of its metadata has been
+        changed, if that metadata field is summed in the table.
+
+        :param string file_id:
+            The repositoryFname of the file
+        :param string key:
+            The metadata key which was changed
+        :return:
+            None
+        """
+        if key not in [item[0] for item in self.file_usage_fields]:
+            return
+        self.con.execute("SELECT uid FROM archive_files WHERE repositoryFname=%s;", (file_id,))
+        self.refresh_file_usage(buckets=self._file_usage_buckets(file_uids=[item['uid']
+                                                                            for item in self.con.fetchall()]))
+
+    def get_file_usage(self, utc_min, utc_max, period=3600, obstory_id=None, obs_type=None, semantic_type=None):
+        """
+        Summarise the files recorded within a time span, from the table <archive_fileUsageHourly>. The files are
+        counted in bins of a fixed length, and separately for each observatory and semantic type. Since the table is
+        divided into hours, files are included if they were recorded within any hour which overlaps the time span.
+
+        :param float utc_min:
+            Only include files recorded after this unix time
+        :param float utc_max:
+            Only include files recorded before this unix time
+        :param int period:
+            The length of each bin, in seconds. Must be a whole number of hours. Bins are aligned to the unix epoch.
+        :param string obstory_id:
+            If set, only include files recorded by the observatory with this publicId
+        :param string obs_type:
+            If set, only include files which belong to observations with this semantic type
+        :param string semantic_type:
+            If set, only include files with this semantic type
+        :return:
+            List of dictionaries, each containing the fields <time> (the unix time at the start of the bin),
+            <obstory_id>, <obs_type>, <semantic_type>, <file_count> and <total_bytes>, and the mean value of each of
+            the metadata in <file_usage_fields>, indexed by its key, or None if it was not set on any file.
+        """
+        if not (period > 0 and period % 3600 == 0):
+            raise ValueError("Bin length must be a whole number of hours, not <{}>".format(period))
+        hours_per_bin = int(period // 3600)
+
+        where = ["u.hourIndex>=%s", "u.hourIndex<=%s"]
+        args = [int(math.floor(utc_min / 3600)), int(math.floor(utc_max / 3600))]
+        for column, value in (("l.publicId", obstory_id), ("ot.name", obs_type), ("st.name", semantic_type)):
+            if value is not None:
+                where.append("{}=%s".format(column))
+                args.append(value)
+
+        sums = ["SUM(u.{0}Count) AS {0}Count, SUM(u.{0}Sum) AS {0}Sum".format(prefix)
+                for key, prefix in self.file_usage_fields]
+
+        self.con.execute("""
+SELECT FLOOR(u.hourIndex / {hours}) * {period} AS time, l.publicId AS obstory_id, ot.name AS obs_type,
+       st.name AS semantic_type, SUM(u.fileCount) AS file_count, SUM(u.totalBytes) AS total_bytes, {sums}
+FROM archive_fileUsageHourly u
+INNER JOIN archive_observatories l ON u.observatory = l.uid
+INNER JOIN archive_semanticTypes ot ON u.obsType = ot.uid
+INNER JOIN archive_semanticTypes st ON u.semanticType = st.uid
+WHERE {where}
+GROUP BY time, obstory_id, obs_type, semantic_type
+ORDER BY time;
+""".format(hours=hours_per_bin, period=period, sums=", ".join(sums), where=" AND ".join(where)), args)
+
+        output = []
+        for item in self.con.fetchall():
+            row = {
+                'time': int(item['time']),
+                'obstory_id': item['obstory_id'],
+                'obs_type': item['obs_type'],
+                'semantic_type': item['semantic_type'],
+                'file_count': int(item['file_count']),
+                'total_bytes': int(item['total_bytes'])
+            }
+            for key, prefix in self.file_usage_fields:
+                count = int(item['{}Count'.format(prefix)])
+                row[key] = item['{}Sum'.format(prefix)] / count if count > 0 else None
+            output.append(row)
+        return output
+
     # Functions for handling observation groups
     def has_obsgroup_id(self, group_id):
         """
@@ -964,7 +2003,7 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_observations WHERE publ
             A :class:`obsarchive_model.Observation` instance, or None if not found
         """
         search = mp.ObservationGroupSearch(group_id=group_id)
-        b = search_obsgroups_sql_builder(search)
+        b = search_obsgroups_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
         sql = b.get_select_sql(columns='g.uid, g.time, g.setAtTime, g.setByUser, g.publicId, g.title,'
                                        's.name AS semanticType',
                                skip=0, limit=1, order='g.time DESC')
@@ -984,7 +2023,7 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_observations WHERE publ
             a structure of {count:int total rows of an unrestricted search, observations:list of
             :class:`obsarchive_model.ObservationGroup`}
         """
-        b = search_obsgroups_sql_builder(search)
+        b = search_obsgroups_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
         sql = b.get_select_sql(columns='g.uid, g.time, g.setAtTime, g.setByUser, g.publicId, g.title,'
                                        's.name AS semanticType',
                                skip=search.skip,
@@ -1376,7 +2415,7 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_obs_groups WHERE public
             # Create a deep copy of the search and set the properties required when creating exports
             search = mp.ObservationSearch.from_dict(export_config.search.as_dict())
             search.exclude_export_to = export_config.config_id
-            b = search_observations_sql_builder(search)
+            b = search_observations_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
 
             self.con.execute(b.get_select_sql(columns='o.uid'), b.sql_args)
             for result in self.con.fetchall():
@@ -1389,7 +2428,7 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_obs_groups WHERE public
             # Create a deep copy of the search and set the properties required when creating exports
             search = mp.FileRecordSearch.from_dict(export_config.search.as_dict())
             search.exclude_export_to = export_config.config_id
-            b = search_files_sql_builder(search)
+            b = search_files_sql_builder(search, metadata_key_id=self.get_metadata_key_id)
 
             self.con.execute(b.get_select_sql(columns='f.uid'), b.sql_args)
             for result in self.con.fetchall():
@@ -1433,3 +2472,4 @@ VALUES (%s, %s, %s, %s, %s, %s, (SELECT uid FROM archive_obs_groups WHERE public
                 self.delete_observation(obs['publicId'])
             self.con.execute('DELETE FROM archive_metadata WHERE (time BETWEEN %s AND %s) AND observatory=%s',
                              (tmin, tmax, obstory['uid']))
+            self.invalidate_obstory_status_cache(obstory_id=obstory_id)
@@ -4,7 +4,9 @@
 
 # Classes which represent observation archive objects
 
+import base64
 import hashlib
+import json
 import numbers
 import random
 import re
@@ -85,6 +87,37 @@ def get_md5_hash(file_path):
     return checksum.hexdigest()
 
 
+def encode_continuation_token(sort_time, uid):
+    """
+    Create an opaque token which marks the position of the last item on a page of search results, so that the next page
+    can be fetched by keyset pagination.
+
+    :param float sort_time:
+        The time of the last item returned
+    :param int uid:
+        The uid of the last item returned
+    :return:
+        String token
+    """
+    return base64.urlsafe_b64encode(json.dumps([sort_time, uid]).encode()).decode()
+
+
+def decode_continuation_token(token):
+    """
+    Decode a token created by :meth:`encode_continuation_token`.
+
+    :param string token:
+        The token to decode
+    :return:
+        List of [sort_time, uid]
+    """
+    try:
+        sort_time, uid = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+        return [float(sort_time), int(uid)]
+    except (ValueError, TypeError):
+        raise ValueError("Invalid continuation token <{}>".format(token))
+
+
 class ModelEqualityMixin(object):
     """
     Taken from http://stackoverflow.com/questions/390250/, simplifies object equality tests.
@@ -186,7 +219,7 @@ class FileRecordSearch(ModelEqualityMixin):
                  time_max=None, mime_type=None, semantic_type=None, observation_type=None,
                  observation_id=None, repository_fname=None,
                  meta_constraints=None, limit=100, skip=0, exclude_export_to=None,
-                 exclude_imported=False):
+                 exclude_imported=False, continuation=None):
         """
         Create a new FileRecordSearch. All parameters are optional, a default search will be created which returns
         at most the first 100 FileRecord instances. All parameters specify restrictions on these results.
@@ -233,6 +266,10 @@ class FileRecordSearch(ModelEqualityMixin):
             Optional, defaults to 0 - used with the limit parameter, this will skip the specified number
             of results from the result set. Use when limiting the number returned by each query to paginate the results,
             i.e. use skip 0 and limit 10 to get the first ten, then skip 10 limit 10 to get the next and so on.
+        :param string continuation:
+            Optional - the continuation token returned with the previous page of results. If specified, only results
+            which come after the end of that page are returned. Unlike skip, this costs the same however deep into the
+            results we are paging.
         :param string exclude_export_to:
             Optional, if specified excludes FileRecords with an entry in t_fileExport for the specified file export
             configuration.
@@ -260,6 +297,7 @@ class FileRecordSearch(ModelEqualityMixin):
         self.mime_type = mime_type
         self.skip = skip
         self.limit = limit
+        self.continuation = continuation
         self.semantic_type = semantic_type
         self.observation_type = observation_type
         self.observation_id = observation_id
@@ -299,6 +337,7 @@ class FileRecordSearch(ModelEqualityMixin):
         _add_value(d, 'mime_type', self.mime_type)
         _add_value(d, 'skip', self.skip)
         _add_value(d, 'limit', self.limit)
+        _add_string(d, 'continuation', self.continuation)
         _add_string(d, 'semantic_type', self.semantic_type)
         _add_string(d, 'observation_type', self.observation_type)
         _add_value(d, 'observation_id', self.observation_id)
@@ -326,6 +365,7 @@ class FileRecordSearch(ModelEqualityMixin):
         mime_type = _string_from_dict(d, 'mime_type')
         skip = _value_from_dict(d, 'skip', 0)
         limit = _value_from_dict(d, 'limit', 100)
+        continuation = _string_from_dict(d, 'continuation')
         semantic_type = _string_from_dict(d, 'semantic_type')
         observation_type = _string_from_dict(d, 'observation_type')
         observation_id = _value_from_dict(d, 'observation_id')
@@ -343,7 +383,7 @@ class FileRecordSearch(ModelEqualityMixin):
                                 observation_id=observation_id, repository_fname=repository_fname,
                                 meta_constraints=meta_constraints, limit=limit, skip=skip,
                                 exclude_imported=exclude_imported,
-                                exclude_export_to=exclude_export_to)
+                                exclude_export_to=exclude_export_to, continuation=continuation)
 
 
 class ObservationSearch(ModelEqualityMixin):
@@ -354,7 +394,7 @@ class ObservationSearch(ModelEqualityMixin):
 
     def __init__(self, obstory_ids=None, lat_min=None, lat_max=None, long_min=None, long_max=None, time_min=None,
                  time_max=None, observation_type=None, observation_id=None, meta_constraints=None, limit=100,
-                 skip=0, exclude_export_to=None, exclude_imported=False):
+                 skip=0, exclude_export_to=None, exclude_imported=False, continuation=None):
         """
         Create a new ObservationSearch. All parameters are optional, a default search will be created which returns
         at most the first 100 instances. All parameters specify restrictions on these results.
@@ -389,6 +429,10 @@ class ObservationSearch(ModelEqualityMixin):
             Optional, defaults to 0 - used with the limit parameter, this will skip the specified number
             of results from the result set. Use when limiting the number returned by each query to paginate the results,
             i.e. use skip 0 and limit 10 to get the first ten, then skip 10 limit 10 to get the next and so on.
+        :param string continuation:
+            Optional - the continuation token returned with the previous page of results. If specified, only results
+            which come after the end of that page are returned. Unlike skip, this costs the same however deep into the
+            results we are paging.
         :param string exclude_export_to:
             Optional, if specified excludes Observations with an entry in t_observationExport for the specified
             observation export configuration.
@@ -417,6 +461,7 @@ class ObservationSearch(ModelEqualityMixin):
         self.observation_id = observation_id
         self.limit = limit
         self.skip = skip
+        self.continuation = continuation
         # Import / export related functions
         self.exclude_imported = exclude_imported
         self.exclude_export_to = exclude_export_to
@@ -450,6 +495,7 @@ class ObservationSearch(ModelEqualityMixin):
         _add_value(d, 'time_max', self.time_max)
         _add_value(d, 'skip', self.skip)
         _add_value(d, 'limit', self.limit)
+        _add_string(d, 'continuation', self.continuation)
         _add_string(d, 'observation_type', self.observation_type)
         _add_string(d, 'observation_id', self.observation_id)
         _add_boolean(d, 'exclude_imported', self.exclude_imported)
@@ -468,6 +514,7 @@ class ObservationSearch(ModelEqualityMixin):
         time_max = _value_from_dict(d, 'time_max')
         skip = _value_from_dict(d, 'skip', 0)
         limit = _value_from_dict(d, 'limit', 100)
+        continuation = _string_from_dict(d, 'continuation')
         observation_type = _string_from_dict(d, 'observation_type')
         observation_id = _string_from_dict(d, 'observation_id')
         exclude_imported = _boolean_from_dict(d, 'exclude_imported')
@@ -481,7 +528,7 @@ class ObservationSearch(ModelEqualityMixin):
                                  meta_constraints=meta_constraints,
                                  observation_type=observation_type, observation_id=observation_id,
                                  limit=limit, skip=skip, exclude_imported=exclude_imported,
-                                 exclude_export_to=exclude_export_to)
+                                 exclude_export_to=exclude_export_to, continuation=continuation)
 
 
 class ObservationGroupSearch(ModelEqualityMixin):
@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 # obsarchive_server.py
 
+import os
 from functools import wraps
 
-from flask import Flask, request, g
+from flask import Flask, request, g, has_app_context
 from flask_cors import CORS
 from flask_jsonpify import jsonify
 from pigazing_helpers.settings_read import installation_info
 
-from .obsarchive_db import ObservationDatabase
+from .db_pool import ObservationDatabasePool
+from .thumbnails import ThumbnailEngine
 
 
 class ObservationApp(object):
@@ -21,9 +23,14 @@ class ObservationApp(object):
     :ivar app:
         A WSGI compliant application, this can be referenced from e.g. a fastcgi WSGI container and used to connect an
         external server such as LigHTTPD or Apache to the application logic.
+    :ivar db_pool:
+        The :class:`db_pool.ObservationDatabasePool` from which requests take their database connections.
+    :ivar thumbnails:
+        The :class:`thumbnails.ThumbnailEngine` which generates and caches thumbnails of images.
     """
 
-    def __init__(self, file_store_path, db_host, db_user, db_password, db_name, obstory_id):
+    def __init__(self, file_store_path, db_host, db_user, db_password, db_name, obstory_id, db_pool_size=8,
+                 thumbnail_cache_path=None, thumbnail_cache_bytes=2 * 1024 ** 3, thumbnail_workers=2):
         """
         Create a new ObservationApp, setting up the internal DB
 
@@ -39,6 +46,14 @@ class ObservationApp(object):
             Database name
         :param obstory_id:
             The local obstory ID
+        :param db_pool_size:
+            The maximum number of database connections to hold open at once
+        :param thumbnail_cache_path:
+            The directory in which thumbnails are cached. Defaults to <thumbnails>, alongside the file store.
+        :param thumbnail_cache_bytes:
+            The maximum total size of the cached thumbnails
+        :param thumbnail_workers:
+            The number of threads used to generate thumbnails
         """
         self.file_store_path = file_store_path
         self.db_host = db_host
@@ -48,14 +63,38 @@ class ObservationApp(object):
         self.obstory_id = obstory_id
         self.app = Flask(__name__)
         CORS(app=self.app, resources='/*', allow_headers=['authorization', 'content-type'])
+        self.db_pool = ObservationDatabasePool(file_store_path=file_store_path,
+                                               db_host=db_host,
+                                               db_user=db_user,
+                                               db_password=db_password,
+                                               db_name=db_name,
+                                               obstory_id=obstory_id,
+                                               max_size=db_pool_size)
+        if thumbnail_cache_path is None:
+            thumbnail_cache_path = os.path.join(file_store_path, "../thumbnails")
+        self.thumbnails = ThumbnailEngine(cache_path=thumbnail_cache_path,
+                                          max_cache_bytes=thumbnail_cache_bytes,
+                                          workers=thumbnail_workers)
+
+        @self.app.teardown_appcontext
+        def return_db_connections(exception=None):
+            # Return any database connections which a request did not close itself, e.g. after an exception
+            # Handles are only returned if they are still on the checkout this request was given
+            for db, token in g.pop('pooled_dbs', []):
+                self.db_pool.checkin(db=db, token=token)
 
     def get_db(self):
-        return ObservationDatabase(file_store_path=self.file_store_path,
-                                   db_host=self.db_host,
-                                   db_user=self.db_user,
-                                   db_password=self.db_password,
-                                   db_name=self.db_name,
-                                   obstory_id=self.obstory_id)
+        """
+        Check out a database handle from the connection pool. Calling close_db() on the handle returns it to the pool.
+        Any handles not returned by the end of the request are returned automatically.
+
+        :return:
+            An :class:`obsarchive_db.ObservationDatabase`
+        """
+        db = self.db_pool.checkout()
+        if has_app_context():
+            g.setdefault('pooled_dbs', []).append((db, db.pool_token))
+        return db
 
     @staticmethod
     def success(message='Okay'):
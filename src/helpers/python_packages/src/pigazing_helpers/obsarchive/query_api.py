@@ -1,18 +1,179 @@
 # -*- coding: utf-8 -*-
 # query_api.py
 
+import calendar
 import os
-import re
 import sys
 import time
+import uuid
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from urllib.parse import unquote
 
-from flask import request, send_file, Response
+from flask import request, Response
 from flask_jsonpify import jsonify
+from werkzeug.http import http_date, parse_date, parse_etags, parse_range_header, quote_etag
+from werkzeug.wsgi import wrap_file
 from yaml import safe_load
 
 from . import obsarchive_model as mp
 
+# Number of bytes read from disk at a time when streaming files to clients
+file_chunk_size = 256 * 1024
+
+# Files in the repository are never modified once they have been registered, so clients may cache them indefinitely
+immutable_cache_control = "public, max-age=31536000, immutable"
+
+
+def _not_modified(headers, etag, last_modified):
+    """
+    Work out whether a client's cached copy of a file is still valid, from the If-None-Match and If-Modified-Since
+    headers of its request. As in RFC 7232, If-Modified-Since is ignored when If-None-Match is present.
+
+    :param headers:
+        The headers of the HTTP request
+    :param string etag:
+        The unquoted entity tag of the file
+    :param int last_modified:
+        The unix time when the file was last modified
+    :return:
+        True if the client should be sent a 304 response
+    """
+    if_none_match = headers.get('If-None-Match', None)
+    if if_none_match is not None:
+        return parse_etags(if_none_match).contains_weak(etag)
+    if_modified_since = parse_date(headers.get('If-Modified-Since', None))
+    if if_modified_since is None:
+        return False
+    return last_modified <= calendar.timegm(if_modified_since.utctimetuple())
+
+
+def _requested_ranges(headers, size, etag, last_modified):
+    """
+    Work out which byte ranges of a file a client has requested, from the Range and If-Range headers of its request.
+
+    :param headers:
+        The headers of the HTTP request
+    :param int size:
+        The size of the file, in bytes
+    :param string etag:
+        The unquoted entity tag of the file
+    :param int last_modified:
+        The unix time when the file was last modified
+    :return:
+        None if the whole file should be sent; otherwise a list of (start, stop) tuples, where <stop> is exclusive.
+        The list is empty if none of the requested ranges can be satisfied.
+    """
+    range_header = headers.get('Range', None)
+    if range_header is None:
+        return None
+
+    # A range request is only honoured if the client's partial copy is of the current version of the file
+    if_range = headers.get('If-Range', None)
+    if if_range is not None and if_range.strip() not in (quote_etag(etag), http_date(last_modified)):
+        return None
+
+    # Invalid range headers are ignored, and the whole file is sent
+    byte_range = parse_range_header(range_header)
+    if byte_range is None or byte_range.units != 'bytes':
+        return None
+
+    ranges = []
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            # Suffix range, specifying the last N bytes of the file
+            start, stop = max(size + start, 0), size
+        elif stop is None or stop > size:
+            stop = size
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def _read_ranges(file_path, parts):
+    """
+    Generator which streams byte ranges of a file, reading no more than <file_chunk_size> bytes at a time.
+
+    :param string file_path:
+        The path of the file to read
+    :param list parts:
+        List of (prefix, start, stop) tuples. For each, the bytes string <prefix> is yielded, followed by the bytes of
+        the file between <start> and <stop>.
+    :return:
+        Iterator over bytes strings
+    """
+    with open(file_path, 'rb') as f:
+        for prefix, start, stop in parts:
+            if prefix:
+                yield prefix
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = f.read(min(remaining, file_chunk_size))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+
+def stream_file(file_path, mime_type, etag):
+    """
+    Build a response which streams a file from the repository to the client. The whole file is sent via the WSGI
+    server's <wsgi.file_wrapper>, which can use sendfile(). Single and multiple byte ranges are supported, and
+    304 responses are sent to clients whose cached copy is still valid.
+
+    :param string file_path:
+        The path of the file to send
+    :param string mime_type:
+        The MIME type of the file
+    :param string etag:
+        The unquoted entity tag of the file, usually its MD5 hash
+    :return:
+        A flask Response object
+    """
+    stat = os.stat(file_path)
+    size = stat.st_size
+    last_modified = int(stat.st_mtime)
+    headers = {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': immutable_cache_control
+    }
+
+    if _not_modified(headers=request.headers, etag=etag, last_modified=last_modified):
+        return Response(status=304, headers=headers)
+
+    ranges = _requested_ranges(headers=request.headers, size=size, etag=etag, last_modified=last_modified)
+
+    # Send the whole file
+    if ranges is None:
+        headers['Content-Length'] = str(size)
+        return Response(wrap_file(request.environ, open(file_path, 'rb'), buffer_size=file_chunk_size),
+                        status=200, mimetype=mime_type, headers=headers, direct_passthrough=True)
+
+    # None of the requested ranges overlap the file
+    if len(ranges) == 0:
+        headers['Content-Range'] = 'bytes */{:d}'.format(size)
+        return Response(status=416, headers=headers)
+
+    # Send a single range
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = 'bytes {:d}-{:d}/{:d}'.format(start, stop - 1, size)
+        headers['Content-Length'] = str(stop - start)
+        return Response(_read_ranges(file_path=file_path, parts=[(b'', start, stop)]),
+                        status=206, mimetype=mime_type, headers=headers, direct_passthrough=True)
+
+    # Send multiple ranges as a multipart/byteranges document
+    boundary = uuid.uuid4().hex
+    parts = [("\r\n--{}\r\nContent-Type: {}\r\nContent-Range: bytes {:d}-{:d}/{:d}\r\n\r\n".format(
+        boundary, mime_type, start, stop - 1, size).encode('utf-8'), start, stop) for start, stop in ranges]
+    epilogue = "\r\n--{}--\r\n".format(boundary).encode('utf-8')
+    parts.append((epilogue, 0, 0))
+    headers['Content-Length'] = str(sum(len(prefix) + stop - start for prefix, start, stop in parts))
+    return Response(_read_ranges(file_path=file_path, parts=parts),
+                    status=206, content_type='multipart/byteranges; boundary={}'.format(boundary), headers=headers,
+                    direct_passthrough=True)
+
 
 def add_routes(obsarchive_app, url_path=''):
     """
@@ -103,7 +264,8 @@ def add_routes(obsarchive_app, url_path=''):
             return jsonify({'error': str(sys.exc_info()[1])})
         observations = db.search_observations(search)
         db.close_db()
-        return jsonify({'obs': list(x.as_dict() for x in observations['obs']), 'count': observations['count']})
+        return jsonify({'obs': list(x.as_dict() for x in observations['obs']), 'count': observations['count'],
+                        'continuation': observations['continuation']})
 
     # Search for files using a YAML search string
     @app.route('{0}/files/<search_string>'.format(url_path), methods=['GET'])
@@ -115,7 +277,8 @@ def add_routes(obsarchive_app, url_path=''):
             return jsonify({'error': str(sys.exc_info()[1])})
         files = db.search_files(search)
         db.close_db()
-        return jsonify({'files': list(x.as_dict() for x in files['files']), 'count': files['count']})
+        return jsonify({'files': list(x.as_dict() for x in files['files']), 'count': files['count'],
+                        'continuation': files['continuation']})
 
     # Return a list of the number of observations of a particular type in a sequence
     # of time intervals between utc_min and utc_max, with step size period
@@ -123,87 +286,56 @@ def add_routes(obsarchive_app, url_path=''):
                methods=['GET'])
     def get_activity(obstory_id, semantic_type, utc_min, utc_max, period):
         db = obsarchive_app.get_db()
-        utc_min = float(utc_min)
-        utc_max = float(utc_max)
-        period = float(period)
-        count = 0
-        output = []
-        while count < 250:
-            a = utc_min + period * count
-            b = a + period
-            count += 1
-            db.con.execute("SELECT COUNT(*) FROM archive_observations o "
-                           "INNER JOIN archive_observatories l ON o.observatory = l.uid "
-                           "INNER JOIN archive_semanticTypes s ON o.obsType = s.uid "
-                           "WHERE l.publicId=%s AND s.name=%s AND o.obsTime>=%s AND o.obsTime<%s LIMIT 1",
-                           (obstory_id, semantic_type, a, b))
-            output.append(db.con.fetchone()['COUNT(*)'])
-            if b >= utc_max:
-                break
+        try:
+            output = db.get_activity(obstory_id=obstory_id, semantic_type=semantic_type,
+                                     utc_min=float(utc_min), utc_max=float(utc_max), period=float(period))
+        except ValueError:
+            db.close_db()
+            return jsonify({'error': str(sys.exc_info()[1])})
         db.close_db()
         return jsonify({"activity": output})
 
-    # Return a thumbnail version of an image
+    # Return a thumbnail version of an image. The query arguments <width> and <format> select one of the sizes and
+    # formats listed in ThumbnailEngine; by default a 300-pixel-wide thumbnail is returned in the source image's format
     @app.route('{0}/thumbnail/<file_id>/<file_name>'.format(url_path), methods=['GET'])
     def get_thumbnail(file_id, file_name):
+        thumbnails = obsarchive_app.thumbnails
         db = obsarchive_app.get_db()
         record = db.get_file(repository_fname=file_id)
-        if record is None:
-            db.close_db()
-            return ObservationApp.not_found(entity_id=file_id)
-        if record.mime_type != "image/png":
+        if record is None or record.mime_type not in thumbnails.source_mime_types:
             db.close_db()
             return ObservationApp.not_found(entity_id=file_id)
         file_path = db.file_path_for_id(record.id)
-        thumb_path = os.path.join(db.file_store_path, "../thumbnails", record.id)
-        if not os.path.exists(thumb_path):
-            os.system("convert {} -scale 300 {}".format(file_path, thumb_path))
+        if not os.path.exists(file_path):
+            file_path = db.restore_file(record.id)
         db.close_db()
-        return send_file(thumb_path, mimetype=record.mime_type)
+
+        image_format = request.args.get('format', thumbnails.source_mime_types[record.mime_type])
+        try:
+            width = int(request.args.get('width', thumbnails.default_width))
+            thumb_path = thumbnails.get_thumbnail(source_path=file_path, file_id=record.id, width=width,
+                                                  image_format=image_format)
+        except ValueError:
+            return jsonify({'error': str(sys.exc_info()[1])})
+        except FutureTimeoutError:
+            return Response("Thumbnail is still being generated", status=503, headers={'Retry-After': '5'})
+
+        return stream_file(file_path=thumb_path, mime_type=thumbnails.formats[image_format][1],
+                           etag="{}-{:d}-{}".format(record.file_md5, width, image_format))
 
     # Return a file from the repository
     @app.route('{0}/files/content/<file_id>/<file_name>'.format(url_path), methods=['GET'])
     @app.route('{0}/files/content/<file_id>'.format(url_path), methods=['GET'])
     def get_file_content(file_id, file_name=None):
-
-        # http://blog.asgaard.co.uk/2012/08/03/http-206-partial-content-for-flask-python
-        def send_file_partial(filename_or_fp, mimetype):
-            range_header = request.headers.get('Range', None)
-            if not range_header:
-                return send_file(filename_or_fp)
-
-            size = os.path.getsize(filename_or_fp)
-            byte1, byte2 = 0, None
-
-            m = re.search('(\d+)-(\d*)', range_header)
-            g = m.groups()
-
-            if g[0]:
-                byte1 = int(g[0])
-            if g[1]:
-                byte2 = int(g[1])
-
-            length = size - byte1
-            if byte2 is not None:
-                length = byte2 - byte1 + 1
-
-            with open(filename_or_fp, 'rb') as f:
-                f.seek(byte1)
-                data = f.read(length)
-
-            rv = Response(data,
-                          206,
-                          mimetype=mimetype,
-                          direct_passthrough=True)
-            rv.headers.add('Content-Range', 'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size))
-
-            return rv
-
         db = obsarchive_app.get_db()
         record = db.get_file(repository_fname=file_id)
         if record is None:
             db.close_db()
             return ObservationApp.not_found(entity_id=file_id)
         file_path = db.file_path_for_id(record.id)
+
+        # Files in cold storage are streamed from there, unless they are compressed, in which case they are restored
+        if not os.path.exists(file_path):
+            file_path = db.restore_file(record.id)
         db.close_db()
-        return send_file_partial(filename_or_fp=file_path, mimetype=record.mime_type)
+        return stream_file(file_path=file_path, mime_type=record.mime_type, etag=record.file_md5)
@@ -3,8 +3,10 @@
 
 # Helper functions to build SQL queries
 
+from .obsarchive_model import decode_continuation_token
 
-def search_observations_sql_builder(search):
+
+def search_observations_sql_builder(search, use_continuation=True, metadata_key_id=None):
     """
     Create and populate an instance of :class:`obsarchive_db.SQLBuilder` for a given
     :class:`obsarchive_model.ObservationSearch`. This can then be used to retrieve the results of the search, materialise
@@ -12,12 +14,17 @@ def search_observations_sql_builder(search):
 
     :param ObservationSearch search:
         The search to realise
+    :param bool use_continuation:
+        If false, the search's continuation token is ignored, e.g. when counting the total number of results
+    :param metadata_key_id:
+        Optionally, a function used to resolve the uids of metadata keys, with the same signature as
+        :meth:`obsarchive_db.ObservationDatabase.get_metadata_key_id`
     :return:
         A :class:`obsarchive_db.SQLBuilder` configured from the supplied search
     """
     b = SQLBuilder(tables="""archive_observations o
 INNER JOIN archive_semanticTypes s ON o.obsType=s.uid
-INNER JOIN archive_observatories l ON o.observatory=l.uid""", where_clauses=[])
+INNER JOIN archive_observatories l ON o.observatory=l.uid""", where_clauses=[], metadata_key_id=metadata_key_id)
     b.add_set_membership(search.obstory_ids, 'l.publicId')
     b.add_sql(search.observation_type, 's.name = %s')
     b.add_sql(search.observation_id, 'o.publicId = %s')
@@ -28,6 +35,8 @@ INNER JOIN archive_observatories l ON o.observatory=l.uid""", where_clauses=[])
     b.add_sql(search.long_min, 'l.longitude >= %s')
     b.add_sql(search.long_max, 'l.longitude <= %s')
     b.add_metadata_query_properties(meta_constraints=search.meta_constraints, id_column="observationId", id_table="o")
+    if use_continuation:
+        b.add_keyset_constraint(continuation=search.continuation, time_column='o.obsTime', uid_column='o.uid')
 
     # Check for import / export filters
     if search.exclude_imported:
@@ -42,7 +51,7 @@ INNER JOIN archive_observatories l ON o.observatory=l.uid""", where_clauses=[])
     return b
 
 
-def search_obsgroups_sql_builder(search):
+def search_obsgroups_sql_builder(search, metadata_key_id=None):
     """
     Create and populate an instance of :class:`obsarchive_db.SQLBuilder` for a given
     :class:`obsarchive_model.ObservationGroupSearch`. This can then be used to retrieve the results of the search,
@@ -50,11 +59,14 @@ def search_obsgroups_sql_builder(search):
 
     :param ObservationGroupSearch search:
         The search to realise
+    :param metadata_key_id:
+        Optionally, a function used to resolve the uids of metadata keys, with the same signature as
+        :meth:`obsarchive_db.ObservationDatabase.get_metadata_key_id`
     :return:
         A :class:`obsarchive_db.SQLBuilder` configured from the supplied search
     """
     b = SQLBuilder(tables="""archive_obs_groups g
-INNER JOIN archive_semanticTypes s ON g.semanticType=s.uid""", where_clauses=[])
+INNER JOIN archive_semanticTypes s ON g.semanticType=s.uid""", where_clauses=[], metadata_key_id=metadata_key_id)
     b.add_sql(search.obstory_name, """
 EXISTS (SELECT 1 FROM archive_obs_group_members x1
 INNER JOIN archive_observations x2 ON x2.uid=x1.observationId
@@ -76,7 +88,7 @@ WHERE y1.groupId=g.uid AND y2.publicId=%s)""")
     return b
 
 
-def search_files_sql_builder(search):
+def search_files_sql_builder(search, use_continuation=True, metadata_key_id=None):
     """
     Create and populate an instance of :class:`obsarchive_db.SQLBuilder` for a given
     :class:`obsarchive_model.FileRecordSearch`. This can then be used to retrieve the results of the search, materialise
@@ -84,6 +96,11 @@ def search_files_sql_builder(search):
 
     :param FileRecordSearch search:
         The search to realise
+    :param bool use_continuation:
+        If false, the search's continuation token is ignored, e.g. when counting the total number of results
+    :param metadata_key_id:
+        Optionally, a function used to resolve the uids of metadata keys, with the same signature as
+        :meth:`obsarchive_db.ObservationDatabase.get_metadata_key_id`
     :return:
         A :class:`obsarchive_db.SQLBuilder` configured from the supplied search
     """
@@ -91,7 +108,7 @@ def search_files_sql_builder(search):
 INNER JOIN archive_semanticTypes s2 ON f.semanticType=s2.uid
 INNER JOIN archive_observations o ON f.observationId=o.uid
 INNER JOIN archive_semanticTypes s ON o.obsType=s.uid
-INNER JOIN archive_observatories l ON o.observatory=l.uid""", where_clauses=[])
+INNER JOIN archive_observatories l ON o.observatory=l.uid""", where_clauses=[], metadata_key_id=metadata_key_id)
     b.add_set_membership(search.obstory_ids, 'l.publicId')
     b.add_sql(search.repository_fname, 'f.repositoryFname = %s')
     b.add_sql(search.observation_type, 's.name = %s')
@@ -105,6 +122,8 @@ INNER JOIN archive_observatories l ON o.observatory=l.uid""", where_clauses=[])
     b.add_sql(search.mime_type, 'f.mimeType = %s')
     b.add_sql(search.semantic_type, 's2.name = %s')
     b.add_metadata_query_properties(meta_constraints=search.meta_constraints, id_column="fileId", id_table="f")
+    if use_continuation:
+        b.add_keyset_constraint(continuation=search.continuation, time_column='f.fileTime', uid_column='f.uid')
 
     # Check for import / export filters
     if search.exclude_imported:
@@ -167,7 +186,7 @@ class SQLBuilder(object):
     debugging of issues with generated queries as we can pull out the query strings directly from this object.
     """
 
-    def __init__(self, tables, where_clauses=None):
+    def __init__(self, tables, where_clauses=None, metadata_key_id=None):
         """
         Construct a new, empty, SQLBuilder
 
@@ -176,6 +195,9 @@ class SQLBuilder(object):
             must not include the string 'WHERE', but should be e.g. ['e.statusID = s.internalID']
         :param tables:
             A SQL fragment defining the tables used by this SQLBuilder, e.g. 't_file f'
+        :param metadata_key_id:
+            Optionally, a function used to resolve the uids of metadata keys before queries are sent to the database,
+            with the same signature as :meth:`obsarchive_db.ObservationDatabase.get_metadata_key_id`.
         :ivar where_clauses:
             A list of strings of SQL, which will be prefixed by 'WHERE' to construct a constraint. As with the init
             parameter these will not include the 'WHERE' itself.
@@ -183,6 +205,7 @@ class SQLBuilder(object):
             An unpopulated SQLBuilder, including any initial where clauses.
         """
         self.tables = tables
+        self.metadata_key_id = metadata_key_id
         self.sql_args = []
         if where_clauses is None:
             self.where_clauses = []
@@ -237,10 +260,34 @@ class SQLBuilder(object):
             for value in values:
                 self.sql_args.append(SQLBuilder.map_value(value))
 
+    def add_keyset_constraint(self, continuation, time_column, uid_column):
+        """
+        Restrict results to those which come after the end of a previous page of results, when they are sorted in
+        descending order of (time_column, uid_column). Unlike OFFSET, this allows MySQL to seek straight to the start
+        of the next page using an index on time_column.
+
+        :param continuation:
+            A continuation token created by :meth:`obsarchive_model.encode_continuation_token`, marking the last item
+            on the previous page. If None, no constraint is added.
+        :param time_column:
+            The column which results are primarily sorted on, e.g. 'o.obsTime'
+        :param uid_column:
+            The column which is used to break ties in the sort order, e.g. 'o.uid'
+        """
+        if continuation is not None:
+            sort_time, uid = decode_continuation_token(continuation)
+            self.where_clauses.append('({0} < %s OR ({0} = %s AND {1} < %s))'.format(time_column, uid_column))
+            self.sql_args.extend([sort_time, sort_time, uid])
+
     def add_metadata_query_properties(self, meta_constraints, id_table, id_column):
         """
         Construct WHERE clauses from a list of MetaConstraint objects, adding them to the query state.
 
+        Each constraint becomes an EXISTS test against archive_metadata, keyed on the uid of the item and on the fieldId
+        of the metadata key. This is answered by probing the composite index on (fieldId, <id_column>) once per
+        candidate row, rather than materialising every value of the metadata field. Where possible, the fieldId is
+        resolved before the query is built, using the function supplied to the constructor.
+
         :param meta_constraints:
             A list of MetaConstraint objects, each of which defines a condition over metadata which must be satisfied
             for results to be included in the overall query.
@@ -250,28 +297,40 @@ class SQLBuilder(object):
         for mc in meta_constraints:
             meta_key = str(mc.key)
             ct = mc.constraint_type
-            sql_template = """
-{0}.uid IN (
-SELECT m.{1} FROM archive_metadata m
-INNER JOIN archive_metadataFields k ON m.fieldId=k.uid
-WHERE m.{2} {3} %s AND k.metaKey = %s
-)"""
-            # Add metadata value to list of SQL arguments
-            self.sql_args.append(SQLBuilder.map_value(mc.value))
-            # Add metadata key to list of SQL arguments
-            self.sql_args.append(meta_key)
-            # Put an appropriate WHERE clause
             if ct == 'less':
-                self.where_clauses.append(sql_template.format(id_table, id_column, 'floatValue', '<='))
+                value_column, operator = 'floatValue', '<='
             elif ct == 'greater':
-                self.where_clauses.append(sql_template.format(id_table, id_column, 'floatValue', '>='))
+                value_column, operator = 'floatValue', '>='
             elif ct == 'number_equals':
-                self.where_clauses.append(sql_template.format(id_table, id_column, 'floatValue', '='))
+                value_column, operator = 'floatValue', '='
             elif ct == 'string_equals':
-                self.where_clauses.append(sql_template.format(id_table, id_column, 'stringValue', '='))
+                value_column, operator = 'stringValue', '='
             else:
                 raise ValueError("Unknown meta constraint type!")
 
+            # Resolve the fieldId of the metadata key
+            if self.metadata_key_id is None:
+                field_sql = '(SELECT k.uid FROM archive_metadataFields k WHERE k.metaKey = %s)'
+                self.sql_args.append(meta_key)
+            else:
+                field_id = self.metadata_key_id(meta_key, create=False)
+                if field_id is None:
+                    # No item can have metadata with a key which doesn't exist
+                    self.where_clauses.append('FALSE')
+                    continue
+                field_sql = '%s'
+                self.sql_args.append(field_id)
+
+            # Put an appropriate WHERE clause
+            self.where_clauses.append("""
+EXISTS (
+SELECT 1 FROM archive_metadata m
+WHERE m.fieldId = {0} AND m.{1} = {2}.uid AND m.{3} {4} %s
+)""".format(field_sql, id_column, id_table, value_column, operator))
+
+            # Add metadata value to list of SQL arguments
+            self.sql_args.append(SQLBuilder.map_value(mc.value))
+
     def get_select_sql(self, columns, order=None, limit=0, skip=0):
         """
         Build a SELECT query based on the current state of the builder.
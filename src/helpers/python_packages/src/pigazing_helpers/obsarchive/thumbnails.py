@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# thumbnails.py
+
+# Generate and cache scaled-down copies of the images in the file store
+
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+from PIL import Image
+
+
+class ThumbnailEngine(object):
+    """
+    Generates thumbnails of images in the file store, in a range of sizes and formats, and caches them on disk.
+
+    Thumbnails are generated lazily, the first time they are requested, on a pool of worker threads using Pillow.
+    Concurrent requests for the same thumbnail wait for a single worker to generate it, rather than each generating
+    their own copy. The cache is bounded in size: when it grows beyond <max_cache_bytes>, the least recently used
+    thumbnails are deleted until it is back below <low_water_fraction> of that size.
+
+    :cvar logger:
+        Logs to 'obsarchive.thumbnails'
+    :cvar dict formats:
+        The formats in which thumbnails may be generated. Each entry is a tuple of the Pillow format name, the MIME
+        type, and a dictionary of options passed to Pillow when saving, indexed by the file extension of the format.
+    :cvar dict source_mime_types:
+        The MIME types of the images we can make thumbnails of, mapped to the extension of the equivalent thumbnail
+        format
+    :cvar tuple widths:
+        The widths, in pixels, of the thumbnails which may be requested
+    :cvar int default_width:
+        The width of thumbnails which are requested without specifying a size
+    :ivar string cache_path:
+        The directory in which thumbnails are stored
+    :ivar int max_cache_bytes:
+        The maximum total size of the thumbnails stored on disk
+    :ivar float low_water_fraction:
+        When thumbnails are evicted from the cache, they are deleted until the cache is below this fraction of
+        <max_cache_bytes>
+    """
+
+    logger = getLogger("obsarchive.thumbnails")
+
+    formats = {
+        'png': ('PNG', 'image/png', {'optimize': False}),
+        'jpeg': ('JPEG', 'image/jpeg', {'quality': 85}),
+        'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4})
+    }
+
+    source_mime_types = {
+        'image/png': 'png',
+        'image/jpeg': 'jpeg'
+    }
+
+    widths = (150, 300, 640, 1280)
+    default_width = 300
+
+    def __init__(self, cache_path, max_cache_bytes=2 * 1024 ** 3, workers=2, low_water_fraction=0.9):
+        """
+        Create a new thumbnail engine.
+
+        :param string cache_path:
+            The directory in which thumbnails are stored. This is created if it does not exist.
+        :param int max_cache_bytes:
+            The maximum total size of the thumbnails stored on disk
+        :param int workers:
+            The number of worker threads used to generate thumbnails
+        :param float low_water_fraction:
+            When thumbnails are evicted from the cache, they are deleted until the cache is below this fraction of
+            <max_cache_bytes>
+        """
+        self.cache_path = cache_path
+        self.max_cache_bytes = max_cache_bytes
+        self.low_water_fraction = low_water_fraction
+
+        os.makedirs(cache_path, exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+
+        # Futures for the thumbnails which are currently being generated, indexed by their paths
+        self._pending = {}
+
+        # Estimate of the total size of the cache. Other processes may share the same cache directory, so this is
+        # recomputed from disk whenever we evict thumbnails.
+        self._cache_bytes = self._scan_cache()[1]
+
+    def thumbnail_path(self, file_id, width, image_format):
+        """
+        Return the path where a thumbnail is stored in the cache. Does not check whether it exists.
+
+        :param string file_id:
+            The repositoryFname of the source image
+        :param int width:
+            The width of the thumbnail
+        :param string image_format:
+            The format of the thumbnail, which must be one of the keys of <formats>
+        :return:
+            The path of the thumbnail
+        """
+        return os.path.join(self.cache_path, "{}_{:d}.{}".format(file_id, width, image_format))
+
+    def get_thumbnail(self, source_path, file_id, width=None, image_format='png', timeout=60):
+        """
+        Fetch the path of a thumbnail of an image, generating it if it is not already in the cache. If another thread
+        is already generating the same thumbnail, we wait for it to finish.
+
+        :param string source_path:
+            The path of the source image in the file store
+        :param string file_id:
+            The repositoryFname of the source image
+        :param int width:
+            The width of the thumbnail, which must be one of <widths>. Images narrower than this are not enlarged.
+        :param string image_format:
+            The format of the thumbnail, which must be one of the keys of <formats>
+        :param float timeout:
+            The maximum number of seconds to wait for the thumbnail to be generated
+        :return:
+            The path of the thumbnail
+        """
+        if width is None:
+            width = self.default_width
+        if width not in self.widths:
+            raise ValueError("Thumbnails may not be {} pixels wide. Allowed widths are {}".format(width, self.widths))
+        if image_format not in self.formats:
+            raise ValueError("Unknown thumbnail format <{}>".format(image_format))
+
+        thumb_path = self.thumbnail_path(file_id=file_id, width=width, image_format=image_format)
+
+        # Mark cache hits as recently used, since many filesystems are mounted with noatime
+        try:
+            os.utime(thumb_path)
+            return thumb_path
+        except FileNotFoundError:
+            pass
+
+        return self.submit(source_path=source_path, file_id=file_id, width=width,
+                           image_format=image_format).result(timeout=timeout)
+
+    def submit(self, source_path, file_id, width, image_format):
+        """
+        Queue a thumbnail to be generated on the worker pool, unless it is already queued.
+
+        :param string source_path:
+            The path of the source image in the file store
+        :param string file_id:
+            The repositoryFname of the source image
+        :param int width:
+            The width of the thumbnail
+        :param string image_format:
+            The format of the thumbnail, which must be one of the keys of <formats>
+        :return:
+            A :class:`concurrent.futures.Future` whose result is the path of the thumbnail
+        """
+        thumb_path = self.thumbnail_path(file_id=file_id, width=width, image_format=image_format)
+        with self._lock:
+            future = self._pending.get(thumb_path, None)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._generate, source_path, thumb_path, width, image_format)
+            self._pending[thumb_path] = future
+
+        # This callback runs immediately if the future has already finished, so it must be added outside the lock
+        future.add_done_callback(lambda f: self._finished(thumb_path))
+        return future
+
+    def submit_all(self, source_path, file_id):
+        """
+        Queue every size and format of thumbnail of an image to be generated on the worker pool, for example to warm
+        the cache with newly imported images.
+
+        :param string source_path:
+            The path of the source image in the file store
+        :param string file_id:
+            The repositoryFname of the source image
+        :return:
+            List of :class:`concurrent.futures.Future`
+        """
+        return [self.submit(source_path=source_path, file_id=file_id, width=width, image_format=image_format)
+                for width in self.widths for image_format in self.formats]
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker pool.
+
+        :param bool wait:
+            If true, wait for all queued thumbnails to be generated
+        :return:
+            None
+        """
+        self._executor.shutdown(wait=wait)
+
+    def _finished(self, thumb_path):
+        with self._lock:
+            self._pending.pop(thumb_path, None)
+
+    def _generate(self, source_path, thumb_path, width, image_format):
+        """
+        Generate a thumbnail, writing it to a temporary file which is renamed into place, so that other processes
+        never see a partially written thumbnail. Runs on the worker pool.
+
+        :param string source_path:
+            The path of the source image in the file store
+        :param string thumb_path:
+            The path of the thumbnail in the cache
+        :param int width:
+            The width of the thumbnail
+        :param string image_format:
+            The format of the thumbnail, which must be one of the keys of <formats>
+        :return:
+            The path of the thumbnail
+        """
+        if os.path.exists(thumb_path):
+            return thumb_path
+
+        pillow_format, save_options = self.formats[image_format][0], self.formats[image_format][2]
+
+        with Image.open(source_path) as image:
+            # Ask the decoder to skip detail we will not use; only JPEG decoders support this
+            image.draft(image.mode, (width, width * image.size[1] // max(image.size[0], 1)))
+
+            # Convert high bit-depth and other unusual modes into ones which every output format supports
+            if image.mode not in ('RGB', 'RGBA', 'L') or (image_format == 'jpeg' and image.mode == 'RGBA'):
+                image = image.convert('RGB')
+
+            image.thumbnail((width, image.size[1]), Image.BICUBIC)
+
+            temp_path = "{}.{}.tmp".format(thumb_path, uuid.uuid4().hex)
+            try:
+                image.save(temp_path, format=pillow_format, **save_options)
+                os.replace(temp_path, thumb_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+
+        with self._lock:
+            self._cache_bytes += os.path.getsize(thumb_path)
+            over_limit = self._cache_bytes > self.max_cache_bytes
+        if over_limit:
+            self._evict()
+        return thumb_path
+
+    def _scan_cache(self):
+        """
+        List the thumbnails in the cache.
+
+        :return:
+            List of [last used time, size, path] lists, and the total size of the thumbnails
+        """
+        entries = []
+        for entry in os.scandir(self.cache_path):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append([max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path])
+        return entries, sum(item[1] for item in entries)
+
+    def _evict(self):
+        """
+        Delete the least recently used thumbnails until the cache is below its low-water mark.
+
+        :return:
+            None
+        """
+        entries, total_bytes = self._scan_cache()
+        target_bytes = self.max_cache_bytes * self.low_water_fraction
+        evicted = 0
+        for last_used, size, path in sorted(entries):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            evicted += 1
+        with self._lock:
+            self._cache_bytes = total_bytes
+        self.logger.info("Evicted {:d} thumbnails from cache; {:.1f} MB remain".format(evicted, total_bytes / 1e6))
@@ -120,6 +120,10 @@ settings = {
 
     # Video settings.
     'videoDev': installation_info['videoDev'],
+
+    # Flag specifying whether to import observations into the database during the night, as they are made, rather
+    # than all at once in the morning
+    'ingestDuringNight': installation_info.get('ingestDuringNight', 0),
 }
 
 # Check to make sure everything is going to work
@@ -23,6 +23,14 @@
 
 BEGIN;
 
+# Record of the migrations which have been applied to this schema, by initialisation/migrateDatabase.py
+CREATE TABLE pigazing_schemaMigrations
+(
+    version     INTEGER PRIMARY KEY,
+    description VARCHAR(255) NOT NULL,
+    appliedTime REAL         NOT NULL
+);
+
 # Create users tables
 CREATE TABLE pigazing_users
 (
@@ -170,7 +178,8 @@ CREATE TABLE archive_observations
     SPATIAL INDEX (position),
     SPATIAL INDEX (skyArea),
     INDEX (derived_observed_year, derived_observed_month, derived_observed_day),
-    INDEX (derived_published_year, derived_published_month, derived_published_day)
+    INDEX (derived_published_year, derived_published_month, derived_published_day),
+    INDEX (observatory, obsTime)
 );
 
 # Groups of observations
@@ -216,7 +225,18 @@ CREATE TABLE archive_files
     FOREIGN KEY (semanticType) REFERENCES archive_semanticTypes (uid) ON DELETE CASCADE,
     FOREIGN KEY (observationId) REFERENCES archive_observations (uid) ON DELETE CASCADE,
     INDEX (fileTime),
-    INDEX (repositoryFname)
+    INDEX (repositoryFname),
+    INDEX (observationId, semanticType)
+);
+
+# Files which have been moved out of the file store into cold storage, in the directory <cold> within the file store
+CREATE TABLE archive_coldFiles
+(
+    fileId      INTEGER PRIMARY KEY,
+    compression VARCHAR(8), /* NULL if the file is stored uncompressed */
+    storedSize  BIGINT NOT NULL, /* size of the file in cold storage, after compression */
+    movedTime   REAL   NOT NULL,
+    FOREIGN KEY (fileId) REFERENCES archive_files (uid) ON DELETE CASCADE
 );
 
 # Metadata pertaining to observations, observatories, or groups of observations
@@ -250,7 +270,69 @@ CREATE TABLE archive_metadata
     INDEX (publicId),
     INDEX (fieldId, observationId),
     INDEX (fieldId, fileId),
-    INDEX (fieldId, observatory)
+    INDEX (fieldId, observatory),
+    INDEX (fieldId, groupId),
+    INDEX (fieldId, floatValue),
+    INDEX (observationId, fieldId),
+    INDEX (fileId, fieldId),
+    INDEX (observatory, fieldId, time),
+    INDEX (observatory, time),
+    INDEX (groupId, fieldId)
+);
+
+# Denormalised copy of the metadata most often needed when analysing moving objects, one row per observation.
+# Values set on an object's video file take precedence over those set on the observation itself.
+# Maintained by obsarchive_db whenever any of these metadata fields are changed.
+CREATE TABLE archive_event_summary
+(
+    observationId  INTEGER PRIMARY KEY,
+    observatory    INTEGER NOT NULL,
+    obsTime        REAL    NOT NULL,
+    videoFileId    INTEGER,
+    path           TEXT, /* pigazing:path */
+    pathBezier     TEXT, /* pigazing:pathBezier */
+    duration       REAL, /* pigazing:duration */
+    detectionCount REAL, /* pigazing:detectionCount */
+    videoStart     REAL, /* pigazing:videoStart */
+    category       VARCHAR(64), /* web:category, set on the observation */
+    FOREIGN KEY (observationId) REFERENCES archive_observations (uid) ON DELETE CASCADE,
+    FOREIGN KEY (observatory) REFERENCES archive_observatories (uid) ON DELETE CASCADE,
+    FOREIGN KEY (videoFileId) REFERENCES archive_files (uid) ON DELETE SET NULL,
+    INDEX (obsTime)
+);
+
+# Number of observations of each semantic type made by each observatory in each hour, used to draw activity charts.
+# Maintained by obsarchive_db whenever observations are registered or deleted.
+CREATE TABLE archive_activityHourly
+(
+    observatory      INTEGER NOT NULL,
+    semanticType     INTEGER NOT NULL,
+    hourIndex        INTEGER NOT NULL, /* floor(unix time / 3600) */
+    observationCount INTEGER NOT NULL,
+    PRIMARY KEY (observatory, semanticType, hourIndex),
+    FOREIGN KEY (observatory) REFERENCES archive_observatories (uid) ON DELETE CASCADE,
+    FOREIGN KEY (semanticType) REFERENCES archive_semanticTypes (uid) ON DELETE CASCADE
+);
+
+# Number and total size of the files of each semantic type recorded by each observatory in each hour, used by reports
+# of disk usage and trigger rates. Maintained by obsarchive_db whenever files or their metadata change.
+CREATE TABLE archive_fileUsageHourly
+(
+    observatory     INTEGER NOT NULL,
+    obsType         INTEGER NOT NULL, /* semantic type of the observations the files belong to */
+    semanticType    INTEGER NOT NULL, /* semantic type of the files */
+    hourIndex       INTEGER NOT NULL, /* floor(fileTime / 3600) */
+    fileCount       INTEGER NOT NULL,
+    totalBytes      BIGINT  NOT NULL,
+    skyClarityCount INTEGER NOT NULL, /* number of files with pigazing:skyClarity set */
+    skyClaritySum   REAL    NOT NULL,
+    sunAltCount     INTEGER NOT NULL, /* number of files with pigazing:sunAlt set */
+    sunAltSum       REAL    NOT NULL,
+    PRIMARY KEY (observatory, obsType, semanticType, hourIndex),
+    FOREIGN KEY (observatory) REFERENCES archive_observatories (uid) ON DELETE CASCADE,
+    FOREIGN KEY (obsType) REFERENCES archive_semanticTypes (uid) ON DELETE CASCADE,
+    FOREIGN KEY (semanticType) REFERENCES archive_semanticTypes (uid) ON DELETE CASCADE,
+    INDEX (hourIndex)
 );
 
 # Configuration used to export observations to an external server
@@ -276,7 +358,9 @@ CREATE TABLE archive_observationExport
     exportConfig  INTEGER NOT NULL,
     exportState   INTEGER NOT NULL, /* 0 for complete, non-zero for active */
     FOREIGN KEY (observationId) REFERENCES archive_observations (uid) ON DELETE CASCADE,
-    FOREIGN KEY (exportConfig) REFERENCES archive_exportConfig (uid) ON DELETE CASCADE
+    FOREIGN KEY (exportConfig) REFERENCES archive_exportConfig (uid) ON DELETE CASCADE,
+    INDEX (exportState, exportConfig, observationId),
+    INDEX (observationId, exportConfig)
 );
 
 CREATE TABLE archive_observationImport
@@ -296,7 +380,9 @@ CREATE TABLE archive_fileExport
     exportConfig INTEGER NOT NULL,
     exportState  INTEGER NOT NULL, /* 0 for complete, non-zero for active */
     FOREIGN KEY (fileId) REFERENCES archive_files (uid) ON DELETE CASCADE,
-    FOREIGN KEY (exportConfig) REFERENCES archive_exportConfig (uid) ON DELETE CASCADE
+    FOREIGN KEY (exportConfig) REFERENCES archive_exportConfig (uid) ON DELETE CASCADE,
+    INDEX (exportState, exportConfig, fileId),
+    INDEX (fileId, exportConfig)
 );
 
 
@@ -317,7 +403,9 @@ CREATE TABLE archive_metadataExport
     exportConfig INTEGER NOT NULL, /* URL of the target import API */
     exportState  INTEGER NOT NULL, /* 0 for complete, non-zero for active */
     FOREIGN KEY (metadataId) REFERENCES archive_metadata (uid) ON DELETE CASCADE,
-    FOREIGN KEY (exportConfig) REFERENCES archive_exportConfig (uid) ON DELETE CASCADE
+    FOREIGN KEY (exportConfig) REFERENCES archive_exportConfig (uid) ON DELETE CASCADE,
+    INDEX (exportState, exportConfig, metadataId),
+    INDEX (metadataId, exportConfig)
 );
 
 CREATE TABLE archive_metadataImport
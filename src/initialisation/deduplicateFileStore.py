@@ -0,0 +1,162 @@
+#!../../datadir/virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+# deduplicateFileStore.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Switch the file store into content-addressed mode, in which files with identical contents are stored only once, and
+convert the files already in it. Each distinct file is stored as a blob named after its MD5 checksum, and each file in
+the archive becomes a hard link to its blob. Files are checksummed before they are linked, so a file whose checksum
+in the database is wrong is never replaced. This script may be run while Pi Gazing is running, and may be interrupted
+and restarted at any time.
+"""
+
+import argparse
+import logging
+import os
+import time
+
+from pigazing_helpers.obsarchive import file_store, obsarchive_db
+from pigazing_helpers.obsarchive import obsarchive_model as mp
+from pigazing_helpers.settings_read import settings, installation_info
+
+
+def remove_orphan_blobs(file_store_path, dry_run):
+    """
+    Delete blobs which no longer have any files linked to them. These can be left behind if two files sharing a blob
+    are deleted at the same moment.
+
+    :param string file_store_path:
+        The path of the file store
+    :param bool dry_run:
+        If true, list the blobs which would be deleted, without deleting them
+    :return:
+        The number of bytes freed
+    """
+    freed = 0
+    for dir_path, dir_names, filenames in os.walk(os.path.join(file_store_path, file_store.blob_directory)):
+        for filename in filenames:
+            blob_path = os.path.join(dir_path, filename)
+            stat = os.stat(blob_path)
+            if stat.st_nlink == 1:
+                logging.info("Removing orphan blob <{}>".format(blob_path))
+                freed += stat.st_size
+                if not dry_run:
+                    os.unlink(blob_path)
+    return freed
+
+
+def deduplicate_file_store(dry_run, pause):
+    """
+    Convert the file store to content-addressed mode.
+
+    :param bool dry_run:
+        If true, report how much disk space would be saved, without changing anything
+    :param float pause:
+        The number of seconds to pause after each 1000 files, to limit the load this places on the disk
+    :return:
+        None
+    """
+    # Open connection to image archive
+    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                           db_host=installation_info['mysqlHost'],
+                                           db_user=installation_info['mysqlUser'],
+                                           db_password=installation_info['mysqlPassword'],
+                                           db_name=installation_info['mysqlDatabase'],
+                                           obstory_id=installation_info['observatoryId'])
+    file_store_path = db.file_store_path
+
+    # Switch on content-addressed mode first, so that new files are stored as blobs while we convert the old ones
+    if not dry_run:
+        os.makedirs(os.path.join(file_store_path, file_store.blob_directory), exist_ok=True)
+
+    # Files which are the only ones with their checksum gain nothing now, but are linked so that identical files
+    # registered later can share them. Files in cold storage are left alone.
+    db.con.execute("SELECT repositoryFname, fileMD5, fileSize FROM archive_files "
+                   "WHERE uid NOT IN (SELECT fileId FROM archive_coldFiles) ORDER BY fileMD5;")
+    files = db.con.fetchall()
+    db.close_db()
+
+    saved = 0
+    linked = 0
+    skipped = 0
+    seen_checksums = set()
+    for item in files:
+        file_path = file_store.find_file(file_store_path=file_store_path, repository_fname=item['repositoryFname'],
+                                         layout=db.file_store_layout)
+        target_blob = file_store.blob_path(file_store_path=file_store_path, file_md5=item['fileMD5'])
+
+        try:
+            file_stat = os.stat(file_path)
+        except FileNotFoundError:
+            logging.info("File <{}> is missing".format(item['repositoryFname']))
+            skipped += 1
+            continue
+
+        # Skip files which are already linked to their blob
+        if os.path.exists(target_blob) and os.path.samestat(file_stat, os.stat(target_blob)):
+            continue
+
+        if mp.get_md5_hash(file_path) != item['fileMD5']:
+            logging.info("File <{}> does not match its checksum in the database".format(item['repositoryFname']))
+            skipped += 1
+            continue
+
+        if dry_run:
+            if os.path.exists(target_blob) or item['fileMD5'] in seen_checksums:
+                saved += file_stat.st_size
+            seen_checksums.add(item['fileMD5'])
+        else:
+            saved += file_store.link_to_blob(file_store_path=file_store_path, file_path=file_path,
+                                             file_md5=item['fileMD5'])
+        linked += 1
+
+        if linked % 1000 == 0:
+            logging.info("Linked {:d} files, saving {:.3f} GB".format(linked, saved / 1e9))
+            time.sleep(pause)
+
+    saved += remove_orphan_blobs(file_store_path=file_store_path, dry_run=dry_run)
+
+    logging.info("Linked {:d} files to blobs; {:d} files skipped.".format(linked, skipped))
+    logging.info("Total storage saved: {:.3f} GB".format(saved / 1e9))
+
+
+if __name__ == "__main__":
+    # Read commandline arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help="Report how much disk space would be saved, without changing anything")
+    parser.add_argument('--pause', dest='pause', default=0.5, type=float,
+                        help="Number of seconds to pause after each 1000 files, to reduce disk load")
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S',
+                        handlers=[
+                            logging.FileHandler(os.path.join(settings['pythonPath'], "../datadir/pigazing.log")),
+                            logging.StreamHandler()
+                        ])
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    deduplicate_file_store(dry_run=args.dry_run, pause=args.pause)
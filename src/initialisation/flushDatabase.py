@@ -47,10 +47,11 @@ os.system("./makeMysqlConfig.py")
 
 print("4/7: Setting up database schema.")
 os.system("mysql --defaults-extra-file=../../datadir/mysql_login.cfg < data/databaseSchema.sql")
+os.system("./migrateDatabase.py")
 
 print("5/7: Creating directory to store files associated with database")
 os.system("mkdir -p ../../datadir/raw_video ../../datadir/db_filestore ../../datadir/thumbnails")
-os.system("rm -f ../../datadir/db_filestore/* ../../datadir/thumbnails/*")
+os.system("rm -rf ../../datadir/db_filestore/* ../../datadir/db_filestore/.layout ../../datadir/thumbnails/*")
 os.system("chown -R {0}:{0} ../../datadir".format(installation_info['username']))
 os.system("chown -R {0}:{0} ../../datadir/thumbnails".format(installation_info['webServerUsername']))
 
@@ -0,0 +1,503 @@
+#!../../datadir/virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+# indexAdvisor.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Report how the indexes on the Pi Gazing database are being used, and which queries might benefit from new indexes.
+Statistics are read from MySQL's performance_schema, or from a slow query log. Optionally, build a synthetic archive in
+temporary tables, and time typical queries against it before and after the indexes added by migrateDatabase.py.
+"""
+
+import argparse
+import logging
+import os
+import random
+import re
+import time
+
+from migrateDatabase import migrations, table_indexes, missing_indexes
+from pigazing_helpers.obsarchive import obsarchive_db
+from pigazing_helpers.settings_read import settings, installation_info
+
+
+def performance_schema_enabled(db):
+    """
+    Test whether MySQL is collecting statistics in performance_schema.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :return:
+        Boolean
+    """
+    db.con.execute("SHOW VARIABLES LIKE 'performance_schema';")
+    results = db.con.fetchall()
+    return len(results) > 0 and results[0]['Value'] == 'ON'
+
+
+def report_index_usage(db):
+    """
+    List how many rows have been read through each index on each table since MySQL was started, flagging indexes
+    which have never been used and tables which have been read without using any index.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :return:
+        None
+    """
+    db.con.execute("""
+SELECT OBJECT_NAME AS tableName, INDEX_NAME AS indexName, COUNT_READ AS countRead, COUNT_WRITE AS countWrite
+FROM performance_schema.table_io_waits_summary_by_index_usage
+WHERE OBJECT_SCHEMA=%s
+ORDER BY OBJECT_NAME, INDEX_NAME;
+""", (db.db_name,))
+    results = db.con.fetchall()
+
+    logging.info("Index usage since MySQL was started:")
+    index_columns = {}
+    for item in results:
+        table = item['tableName']
+        if table not in index_columns:
+            index_columns[table] = table_indexes(db=db, table_name=table)
+
+        if item['indexName'] is None:
+            if item['countRead'] > 0:
+                logging.info("  {:28s} {:48s} {:12d} rows read without an index".format(
+                    table, "-", item['countRead']))
+            continue
+
+        columns = "({})".format(", ".join(index_columns[table].get(item['indexName'], ())))
+        logging.info("  {:28s} {:48s} {:12d} rows read{}".format(
+            table, columns, item['countRead'],
+            "  UNUSED" if item['countRead'] == 0 and item['indexName'] != 'PRIMARY' else ""))
+
+
+def report_statements_without_indexes(db, limit):
+    """
+    List the statements which MySQL has executed without using a suitable index, which are candidates for new
+    indexes, in order of the total time spent executing them.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :param limit:
+        The maximum number of statements to list
+    :return:
+        None
+    """
+    db.con.execute("""
+SELECT DIGEST_TEXT AS sqlText, COUNT_STAR AS count, SUM_TIMER_WAIT AS totalTime,
+       SUM_ROWS_EXAMINED AS rowsExamined, SUM_ROWS_SENT AS rowsSent,
+       SUM_NO_INDEX_USED AS noIndexUsed, SUM_NO_GOOD_INDEX_USED AS noGoodIndexUsed
+FROM performance_schema.events_statements_summary_by_digest
+WHERE SCHEMA_NAME=%s AND (SUM_NO_INDEX_USED > 0 OR SUM_NO_GOOD_INDEX_USED > 0)
+ORDER BY SUM_TIMER_WAIT DESC LIMIT %s;
+""", (db.db_name, limit))
+
+    logging.info("Statements executed without a suitable index (candidates for new indexes):")
+    for item in db.con.fetchall():
+        # performance_schema timers count in picoseconds
+        logging.info("  {:8d} calls, {:10.1f} ms each, {:10.0f} rows examined per row sent".format(
+            item['count'], item['totalTime'] / 1e9 / max(item['count'], 1),
+            item['rowsExamined'] / max(item['rowsSent'], 1)))
+        logging.info("      {}".format(re.sub(r"\s+", " ", item['sqlText'] or "")[:240]))
+
+
+def normalise_sql(sql):
+    """
+    Replace the literal values in an SQL statement with placeholders, so that statements which differ only in their
+    arguments can be grouped together.
+
+    :param sql:
+        An SQL statement
+    :return:
+        The normalised SQL statement
+    """
+    sql = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", "?", sql)
+    sql = re.sub(r"\b-?\d+(\.\d+)?(e[-+]?\d+)?\b", "?", sql)
+    sql = re.sub(r"\(\s*\?(\s*,\s*\?)*\s*\)", "(?)", sql)
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def report_slow_log(path, limit, minimum_scan_ratio):
+    """
+    Read a MySQL slow query log, and list the statements which examined many more rows than they returned, which are
+    candidates for new indexes, in order of the total time spent executing them.
+
+    :param path:
+        The path of the slow query log
+    :param limit:
+        The maximum number of statements to list
+    :param minimum_scan_ratio:
+        Only list statements which examined at least this many rows for each row they returned
+    :return:
+        None
+    """
+    header = re.compile(r"# Query_time: ([\d.]+)\s+Lock_time: [\d.]+\s+Rows_sent: (\d+)\s+Rows_examined: (\d+)")
+
+    statements = {}
+    entry = None
+    sql_lines = []
+
+    def finish_entry():
+        if entry is None or not sql_lines:
+            return
+        sql = normalise_sql(" ".join(sql_lines))
+        if sql not in statements:
+            statements[sql] = {'count': 0, 'time': 0, 'rows_sent': 0, 'rows_examined': 0}
+        statements[sql]['count'] += 1
+        statements[sql]['time'] += entry[0]
+        statements[sql]['rows_sent'] += entry[1]
+        statements[sql]['rows_examined'] += entry[2]
+
+    with open(path) as f:
+        for line in f:
+            match = header.match(line)
+            if match is not None:
+                finish_entry()
+                entry = [float(match.group(1)), int(match.group(2)), int(match.group(3))]
+                sql_lines = []
+            elif line.startswith("#") or line.startswith("SET timestamp=") or line.startswith("use "):
+                continue
+            elif entry is not None:
+                sql_lines.append(line.strip())
+    finish_entry()
+
+    candidates = [(sql, item) for sql, item in statements.items()
+                  if item['rows_examined'] >= minimum_scan_ratio * max(item['rows_sent'], 1)]
+    candidates.sort(key=lambda x: -x[1]['time'])
+
+    logging.info("Slow statements examining more than {:.0f} rows per row returned:".format(minimum_scan_ratio))
+    for sql, item in candidates[:limit]:
+        logging.info("  {:8d} calls, {:10.1f} ms each, {:10.0f} rows examined per row sent".format(
+            item['count'], item['time'] * 1e3 / item['count'], item['rows_examined'] / max(item['rows_sent'], 1)))
+        logging.info("      {}".format(sql[:240]))
+
+
+# Synthetic copies of the tables whose indexes are added by migrateDatabase.py. These have the indexes that these
+# tables had before migration 3, including those which InnoDB creates automatically for foreign keys.
+synthetic_tables = {
+    'archive_observations': ['synthetic_observations', """
+CREATE TEMPORARY TABLE synthetic_observations
+(
+    uid         INTEGER PRIMARY KEY,
+    observatory INTEGER NOT NULL,
+    obsTime     REAL    NOT NULL,
+    INDEX (obsTime),
+    INDEX (observatory)
+);"""],
+    'archive_metadata': ['synthetic_metadata', """
+CREATE TEMPORARY TABLE synthetic_metadata
+(
+    uid           INTEGER PRIMARY KEY AUTO_INCREMENT,
+    fieldId       INTEGER,
+    time          REAL,
+    stringValue   TEXT,
+    floatValue    REAL,
+    fileId        INTEGER,
+    observationId INTEGER,
+    observatory   INTEGER,
+    groupId       INTEGER,
+    INDEX (fieldId, observationId),
+    INDEX (fieldId, fileId),
+    INDEX (fieldId, observatory),
+    INDEX (fieldId, groupId),
+    INDEX (fieldId, floatValue),
+    INDEX (observationId),
+    INDEX (fileId),
+    INDEX (observatory),
+    INDEX (groupId)
+);"""],
+    'archive_observationExport': ['synthetic_observationExport', """
+CREATE TEMPORARY TABLE synthetic_observationExport
+(
+    uid           INTEGER PRIMARY KEY AUTO_INCREMENT,
+    observationId INTEGER NOT NULL,
+    exportConfig  INTEGER NOT NULL,
+    exportState   INTEGER NOT NULL,
+    INDEX (observationId),
+    INDEX (exportConfig)
+);"""]
+}
+
+
+def populate_synthetic_archive(db, observation_count, rng):
+    """
+    Create a synthetic archive in temporary tables, with similar proportions of observations, files and metadata to
+    a real Pi Gazing installation.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :param observation_count:
+        The number of observations to create
+    :param rng:
+        A random.Random instance
+    :return:
+        Dictionary describing the ranges of IDs used
+    """
+    for table_name, definition in synthetic_tables.values():
+        db.con.execute("DROP TEMPORARY TABLE IF EXISTS {};".format(table_name))
+        db.con.execute(definition)
+
+    obstory_count = 5
+    obs_fields = 8
+    file_count = 3
+    file_fields = 4
+    obstory_fields = 20
+    export_configs = 2
+    time_span = 365 * 86400
+
+    def insert(sql, rows):
+        for batch in db.generators._batches(rows, 1000):
+            db.con.executemany(sql, batch)
+
+    obs_times = sorted(rng.uniform(0, time_span) for i in range(observation_count))
+    insert("INSERT INTO synthetic_observations (uid, observatory, obsTime) VALUES (%s, %s, %s);",
+           [(uid + 1, rng.randrange(obstory_count) + 1, obs_times[uid]) for uid in range(observation_count)])
+
+    metadata_sql = ("INSERT INTO synthetic_metadata (fieldId, time, stringValue, floatValue, fileId, observationId, "
+                    "observatory, groupId) VALUES (%s, %s, %s, %s, %s, %s, %s, %s);")
+    insert(metadata_sql, [(field + 1, None, None, rng.random(), None, uid + 1, None, None)
+                          for uid in range(observation_count) for field in range(obs_fields)])
+    insert(metadata_sql, [(obs_fields + field + 1, None, None, rng.random(), uid + 1, None, None, None)
+                          for uid in range(observation_count * file_count) for field in range(file_fields)])
+    insert(metadata_sql, [(obs_fields + file_fields + field + 1, rng.uniform(0, time_span), "value", None,
+                           None, None, obstory + 1, None)
+                          for obstory in range(obstory_count) for field in range(obstory_fields)
+                          for i in range(max(1, observation_count // 200))])
+
+    insert("INSERT INTO synthetic_observationExport (observationId, exportConfig, exportState) VALUES (%s, %s, %s);",
+           [(uid + 1, config + 1, 1 if rng.random() < 0.01 else 0)
+            for uid in range(observation_count) for config in range(export_configs)])
+    db.commit()
+
+    return {
+        'observations': observation_count,
+        'files': observation_count * file_count,
+        'obstories': obstory_count,
+        'obstory_field_min': obs_fields + file_fields + 1,
+        'obstory_field_max': obs_fields + file_fields + obstory_fields,
+        'file_field_min': obs_fields + 1,
+        'file_field_max': obs_fields + file_fields,
+        'export_configs': export_configs,
+        'time_span': time_span
+    }
+
+
+def synthetic_queries(ranges, rng):
+    """
+    Build a list of queries against the synthetic archive, following the access paths used by obsarchive_db.
+
+    :param ranges:
+        Dictionary describing the ranges of IDs used, as returned by :meth:`populate_synthetic_archive`
+    :param rng:
+        A random.Random instance
+    :return:
+        List of [description, function returning [sql, args]] lists
+    """
+
+    def obs_batch():
+        batch = [rng.randint(1, ranges['observations']) for i in range(100)]
+        return ["SELECT fieldId, stringValue, floatValue, observationId FROM synthetic_metadata "
+                "WHERE observationId IN ({});".format(",".join(["%s"] * len(batch))), batch]
+
+    def file_field():
+        return ["SELECT stringValue, floatValue FROM synthetic_metadata WHERE fileId=%s AND fieldId=%s;",
+                [rng.randint(1, ranges['files']), rng.randint(ranges['file_field_min'], ranges['file_field_max'])]]
+
+    def obstory_status():
+        return ["SELECT MAX(time) AS time FROM synthetic_metadata WHERE observatory=%s AND fieldId=%s AND time<=%s;",
+                [rng.randint(1, ranges['obstories']),
+                 rng.randint(ranges['obstory_field_min'], ranges['obstory_field_max']),
+                 rng.uniform(0, ranges['time_span'])]]
+
+    def obstory_changes():
+        t = rng.uniform(0, ranges['time_span'])
+        return ["SELECT fieldId, time FROM synthetic_metadata WHERE observatory=%s AND time BETWEEN %s AND %s;",
+                [rng.randint(1, ranges['obstories']), t, t + 86400]]
+
+    def observatory_night():
+        t = rng.uniform(0, ranges['time_span'])
+        return ["SELECT uid FROM synthetic_observations WHERE observatory=%s AND obsTime BETWEEN %s AND %s;",
+                [rng.randint(1, ranges['obstories']), t, t + 86400]]
+
+    def next_export():
+        return ["SELECT x.observationId FROM synthetic_observationExport x "
+                "INNER JOIN synthetic_observations o ON x.observationId=o.uid "
+                "WHERE x.exportConfig=%s AND x.exportState > 0 ORDER BY o.obsTime, o.uid LIMIT 1;",
+                [rng.randint(1, ranges['export_configs'])]]
+
+    def export_check():
+        return ["SELECT 1 FROM synthetic_observationExport WHERE observationId=%s AND exportConfig=%s;",
+                [rng.randint(1, ranges['observations']), rng.randint(1, ranges['export_configs'])]]
+
+    return [
+        ["All metadata for 100 observations", obs_batch],
+        ["One metadata field of a file", file_field],
+        ["Observatory status at a given time", obstory_status],
+        ["Observatory metadata changes in a day", obstory_changes],
+        ["Observations by one observatory in a day", observatory_night],
+        ["Next observation to export", next_export],
+        ["Has observation been exported", export_check]
+    ]
+
+
+def time_queries(db, queries, repeats):
+    """
+    Time each of a list of queries.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :param queries:
+        List of queries, as returned by :meth:`synthetic_queries`
+    :param repeats:
+        The number of times to run each query, with different random arguments
+    :return:
+        List of the mean time taken by each query, in seconds
+    """
+    output = []
+    for description, query in queries:
+        time_total = 0
+        for i in range(repeats):
+            sql, args = query()
+            time_start = time.time()
+            db.con.execute(sql, args)
+            db.con.fetchall()
+            time_total += time.time() - time_start
+        output.append(time_total / repeats)
+    return output
+
+
+def benchmark_migrations(db, observation_count, repeats):
+    """
+    Build a synthetic archive, and time a set of typical queries against it, before and after adding the indexes
+    created by migrateDatabase.py.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :param observation_count:
+        The number of observations in the synthetic archive
+    :param repeats:
+        The number of times to run each query
+    :return:
+        None
+    """
+    logging.info("Building synthetic archive with {:d} observations".format(observation_count))
+    ranges = populate_synthetic_archive(db=db, observation_count=observation_count, rng=random.Random(1))
+
+    # The arguments to the queries are generated from a freshly seeded random number generator on each pass, so that
+    # the same queries are run before and after adding indexes
+    before = time_queries(db=db, queries=synthetic_queries(ranges=ranges, rng=random.Random(2)), repeats=repeats)
+
+    # Add the indexes created by the migrations
+    for migration in migrations:
+        for table_name, wanted_indexes in migration['indexes'].items():
+            if table_name not in synthetic_tables:
+                continue
+            synthetic_name = synthetic_tables[table_name][0]
+            new_indexes = missing_indexes(existing_indexes=table_indexes(db=db, table_name=synthetic_name),
+                                          wanted_indexes=wanted_indexes)
+            for columns in new_indexes:
+                db.con.execute("ALTER TABLE {} ADD INDEX ({});".format(synthetic_name, ", ".join(columns)))
+    db.con.execute("ANALYZE TABLE {};".format(", ".join(item[0] for item in synthetic_tables.values())))
+    db.con.fetchall()
+
+    after = time_queries(db=db, queries=synthetic_queries(ranges=ranges, rng=random.Random(2)), repeats=repeats)
+
+    logging.info("{:44s} {:>10s} {:>10s} {:>8s}".format("Query", "Before/ms", "After/ms", "Speedup"))
+    for (description, query), time_before, time_after in zip(synthetic_queries(ranges=ranges, rng=None),
+                                                             before, after):
+        logging.info("{:44s} {:10.3f} {:10.3f} {:8.1f}".format(description, time_before * 1e3, time_after * 1e3,
+                                                                time_before / max(time_after, 1e-9)))
+
+    for table_name, definition in synthetic_tables.values():
+        db.con.execute("DROP TEMPORARY TABLE IF EXISTS {};".format(table_name))
+
+
+def index_advisor(slow_log, limit, minimum_scan_ratio, benchmark, repeats):
+    """
+    Report on index usage, and on statements which might benefit from new indexes.
+
+    :param slow_log:
+        Path of a MySQL slow query log to analyse, or None to use performance_schema
+    :param limit:
+        The maximum number of statements to list
+    :param minimum_scan_ratio:
+        Only list slow statements which examined at least this many rows for each row they returned
+    :param benchmark:
+        The number of observations in a synthetic archive to benchmark migrations against, or zero to skip
+    :param repeats:
+        The number of times to run each query in the benchmark
+    :return:
+        None
+    """
+    # Open connection to image archive
+    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                           db_host=installation_info['mysqlHost'],
+                                           db_user=installation_info['mysqlUser'],
+                                           db_password=installation_info['mysqlPassword'],
+                                           db_name=installation_info['mysqlDatabase'],
+                                           obstory_id=installation_info['observatoryId'])
+
+    if slow_log is not None:
+        report_slow_log(path=slow_log, limit=limit, minimum_scan_ratio=minimum_scan_ratio)
+    elif performance_schema_enabled(db=db):
+        report_index_usage(db=db)
+        report_statements_without_indexes(db=db, limit=limit)
+    else:
+        logging.info("performance_schema is not enabled on this MySQL server. Enable it in my.cnf, or pass the path "
+                     "of a slow query log with --slow-log.")
+
+    if benchmark > 0:
+        benchmark_migrations(db=db, observation_count=benchmark, repeats=repeats)
+
+    # Close database handle
+    db.close_db()
+
+
+if __name__ == "__main__":
+    # Read commandline arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--slow-log', dest='slow_log', default=None,
+                        help="Path of a MySQL slow query log to analyse, instead of reading performance_schema")
+    parser.add_argument('--limit', dest='limit', default=20, type=int,
+                        help="The maximum number of statements to list")
+    parser.add_argument('--scan-ratio', dest='minimum_scan_ratio', default=100, type=float,
+                        help="Only list slow statements which examined this many rows for each row returned")
+    parser.add_argument('--benchmark', dest='benchmark', default=0, type=int,
+                        help="Time typical queries before and after migration, on a synthetic archive with this "
+                             "many observations")
+    parser.add_argument('--repeats', dest='repeats', default=200, type=int,
+                        help="The number of times to run each query in the benchmark")
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S',
+                        handlers=[
+                            logging.FileHandler(os.path.join(settings['pythonPath'], "../datadir/pigazing.log")),
+                            logging.StreamHandler()
+                        ])
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    index_advisor(slow_log=args.slow_log, limit=args.limit, minimum_scan_ratio=args.minimum_scan_ratio,
+                  benchmark=args.benchmark, repeats=args.repeats)
@@ -0,0 +1,329 @@
+#!../../datadir/virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+# migrateDatabase.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Bring the schema of an existing Pi Gazing database up to date, by applying any numbered migrations which have not
+yet been applied to it. The version of the schema is recorded in the table <pigazing_schemaMigrations>.
+"""
+
+import argparse
+import logging
+import os
+import re
+import time
+
+from pigazing_helpers.obsarchive import obsarchive_db
+from pigazing_helpers.settings_read import settings, installation_info
+
+# Path of the SQL file which creates the database schema for new installations
+schema_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/databaseSchema.sql")
+
+
+def populate_event_summary(db):
+    """
+    Fill the table <archive_event_summary> with all existing moving objects.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :return:
+        None
+    """
+    db.refresh_event_summary()
+
+
+def populate_activity(db):
+    """
+    Fill the table <archive_activityHourly> with counts of all existing observations.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :return:
+        None
+    """
+    db.refresh_activity()
+
+
+def populate_file_usage(db):
+    """
+    Fill the table <archive_fileUsageHourly> with the sizes of all existing files.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :return:
+        None
+    """
+    db.refresh_file_usage()
+
+
+# List of all migrations, in the order in which they must be applied. Each migration may create tables, which must
+# be defined in <databaseSchema.sql>, and add indexes, each of which is a tuple of the names of the indexed columns.
+# Tables and indexes which already exist are left alone, so that new installations, whose schema already contains
+# them, can simply be marked as up to date. Finally, an optional function is called with an ObservationDatabase.
+migrations = [
+    {
+        'version': 1,
+        'description': "Indexes used to evaluate metadata constraints in searches",
+        'tables': [],
+        'indexes': {
+            'archive_metadata': [('fieldId', 'groupId'), ('fieldId', 'floatValue')]
+        },
+        'function': None
+    },
+    {
+        'version': 2,
+        'description': "Table summarising the metadata of moving objects",
+        'tables': ['archive_event_summary'],
+        'indexes': {},
+        'function': populate_event_summary
+    },
+    {
+        'version': 3,
+        'description': "Covering indexes for metadata, file and export lookups",
+        'tables': [],
+        'indexes': {
+            'archive_metadata': [('observationId', 'fieldId'), ('fileId', 'fieldId'),
+                                 ('observatory', 'fieldId', 'time'), ('observatory', 'time'),
+                                 ('groupId', 'fieldId')],
+            'archive_observations': [('observatory', 'obsTime')],
+            'archive_files': [('observationId', 'semanticType')],
+            'archive_observationExport': [('exportState', 'exportConfig', 'observationId'),
+                                          ('observationId', 'exportConfig')],
+            'archive_fileExport': [('exportState', 'exportConfig', 'fileId'),
+                                   ('fileId', 'exportConfig')],
+            'archive_metadataExport': [('exportState', 'exportConfig', 'metadataId'),
+                                       ('metadataId', 'exportConfig')]
+        },
+        'function': None
+    },
+    {
+        'version': 4,
+        'description': "Table of the number of observations made in each hour",
+        'tables': ['archive_activityHourly'],
+        'indexes': {},
+        'function': populate_activity
+    },
+    {
+        'version': 5,
+        'description': "Table of the number and size of the files recorded in each hour",
+        'tables': ['archive_fileUsageHourly'],
+        'indexes': {},
+        'function': populate_file_usage
+    },
+    {
+        'version': 6,
+        'description': "Table of the files which have been moved into cold storage",
+        'tables': ['archive_coldFiles'],
+        'indexes': {},
+        'function': None
+    }
+]
+
+
+def table_definition(table_name):
+    """
+    Extract the CREATE TABLE statement for a table from <databaseSchema.sql>.
+
+    :param table_name:
+        The name of the table
+    :return:
+        String containing a CREATE TABLE statement
+    """
+    schema = open(schema_path).read()
+    match = re.search(r"^CREATE TABLE {}\s*\(.*?^\);".format(re.escape(table_name)), schema, re.M | re.S)
+    if match is None:
+        raise ValueError("Table <{}> is not defined in <{}>".format(table_name, schema_path))
+    return match.group(0)
+
+
+def table_exists(db, table_name):
+    """
+    Test whether a table exists in the database.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :param table_name:
+        The name of the table
+    :return:
+        Boolean
+    """
+    db.con.execute("SELECT 1 FROM information_schema.TABLES WHERE TABLE_SCHEMA=%s AND TABLE_NAME=%s;",
+                   (db.db_name, table_name))
+    return len(db.con.fetchall()) > 0
+
+
+def table_indexes(db, table_name):
+    """
+    List the indexes which exist on a table.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :param table_name:
+        The name of the table
+    :return:
+        Dictionary of tuples of the names of the indexed columns, indexed by the names of the indexes
+    """
+    # SHOW INDEX works on temporary tables, which are not listed in information_schema
+    db.con.execute("SHOW INDEX FROM {};".format(table_name))
+    indexes = {}
+    for item in sorted(db.con.fetchall(), key=lambda x: (x['Key_name'], x['Seq_in_index'])):
+        indexes[item['Key_name']] = indexes.get(item['Key_name'], ()) + (item['Column_name'],)
+    return indexes
+
+
+def missing_indexes(existing_indexes, wanted_indexes):
+    """
+    Work out which of a list of indexes are not yet present on a table. An index is present if an existing index
+    starts with the same columns, in the same order.
+
+    :param existing_indexes:
+        Dictionary of the indexes already on the table, as returned by :meth:`table_indexes`
+    :param wanted_indexes:
+        List of tuples of the names of indexed columns
+    :return:
+        List of tuples of the names of indexed columns
+    """
+    return [columns for columns in wanted_indexes
+            if not any(index[:len(columns)] == columns for index in existing_indexes.values())]
+
+
+def applied_versions(db):
+    """
+    Fetch the list of migrations which have already been applied to the database, creating the table
+    <pigazing_schemaMigrations> if it does not yet exist.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :return:
+        Dictionary of [description, time applied] lists, indexed by version number
+    """
+    if not table_exists(db=db, table_name='pigazing_schemaMigrations'):
+        db.con.execute(table_definition(table_name='pigazing_schemaMigrations'))
+    db.con.execute("SELECT version, description, appliedTime FROM pigazing_schemaMigrations;")
+    return {item['version']: [item['description'], item['appliedTime']] for item in db.con.fetchall()}
+
+
+def apply_migration(db, migration, dry_run):
+    """
+    Apply a single migration to the database, and record that it has been applied.
+
+    :param db:
+        An :class:`obsarchive_db.ObservationDatabase`
+    :param migration:
+        Dictionary describing the migration, as listed in <migrations>
+    :param dry_run:
+        If true, list the SQL statements needed, without executing them
+    :return:
+        None
+    """
+    statements = []
+
+    # Create new tables
+    for table_name in migration['tables']:
+        if not table_exists(db=db, table_name=table_name):
+            statements.append(table_definition(table_name=table_name))
+
+    # Add indexes to each table in a single ALTER TABLE statement, so it only needs to be rebuilt once
+    for table_name, wanted_indexes in migration['indexes'].items():
+        new_indexes = missing_indexes(existing_indexes=table_indexes(db=db, table_name=table_name),
+                                      wanted_indexes=wanted_indexes)
+        if new_indexes:
+            statements.append("ALTER TABLE {} {};".format(
+                table_name, ", ".join("ADD INDEX ({})".format(", ".join(columns)) for columns in new_indexes)))
+
+    for statement in statements:
+        logging.info("  {}".format(statement if dry_run else statement.split("\n")[0]))
+        if not dry_run:
+            time_start = time.time()
+            db.con.execute(statement)
+            logging.info("    took {:.1f} sec".format(time.time() - time_start))
+
+    if dry_run:
+        return
+
+    if migration['function'] is not None:
+        logging.info("  Running {}()".format(migration['function'].__name__))
+        migration['function'](db)
+
+    db.con.execute("REPLACE INTO pigazing_schemaMigrations (version, description, appliedTime) VALUES (%s, %s, %s);",
+                   (migration['version'], migration['description'], time.time()))
+    db.commit()
+
+
+def migrate_database(dry_run, status_only):
+    """
+    Apply any migrations which have not yet been applied to the database.
+
+    :param dry_run:
+        If true, list the SQL statements needed, without executing them
+    :param status_only:
+        If true, only list which migrations have been applied
+    :return:
+        None
+    """
+    # Open connection to image archive
+    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                           db_host=installation_info['mysqlHost'],
+                                           db_user=installation_info['mysqlUser'],
+                                           db_password=installation_info['mysqlPassword'],
+                                           db_name=installation_info['mysqlDatabase'],
+                                           obstory_id=installation_info['observatoryId'])
+
+    applied = applied_versions(db=db)
+
+    for migration in migrations:
+        if migration['version'] in applied:
+            logging.info("Migration {:3d} applied {}: {}".format(
+                migration['version'], time.strftime("%Y-%m-%d %H:%M", time.gmtime(applied[migration['version']][1])),
+                migration['description']))
+            continue
+        if status_only:
+            logging.info("Migration {:3d} pending         : {}".format(migration['version'], migration['description']))
+            continue
+        logging.info("Applying migration {:3d}: {}".format(migration['version'], migration['description']))
+        apply_migration(db=db, migration=migration, dry_run=dry_run)
+
+    # Close database handle
+    db.close_db()
+
+
+if __name__ == "__main__":
+    # Read commandline arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help="List the SQL statements needed to migrate the database, without executing them")
+    parser.add_argument('--status', dest='status_only', action='store_true',
+                        help="List which migrations have been applied, without applying any more")
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S',
+                        handlers=[
+                            logging.FileHandler(os.path.join(settings['pythonPath'], "../datadir/pigazing.log")),
+                            logging.StreamHandler()
+                        ])
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    migrate_database(dry_run=args.dry_run, status_only=args.status_only)
@@ -0,0 +1,155 @@
+#!../../datadir/virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+# migrateFileStore.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Move the files in the file store into a new layout, for example from a single flat directory into subdirectories
+YYYY/MM/DD. The new layout is recorded before any files are moved, so new files are immediately stored in the new
+layout, and files which have not yet been moved are still found in the old layout. This script may therefore be run
+while Pi Gazing is running, and may be interrupted and restarted at any time.
+"""
+
+import argparse
+import logging
+import os
+import time
+
+from pigazing_helpers.obsarchive import file_store
+from pigazing_helpers.settings_read import settings
+
+
+def files_to_move(file_store_path, layout):
+    """
+    Generator which lists the files in the file store which are not where <layout> puts them. The file store is
+    scanned one directory at a time, so the whole listing is never held in memory.
+
+    :param string file_store_path:
+        The path of the file store
+    :param string layout:
+        The name of the layout which files are being moved into
+    :return:
+        Iterator over (current path, target path) tuples
+    """
+    for dir_path, dir_names, filenames in os.walk(file_store_path):
+        # Content-addressed blobs are not named after files, and files in cold storage are always in the date layout
+        if dir_path == file_store_path:
+            dir_names[:] = [item for item in dir_names
+                            if item not in (file_store.blob_directory, file_store.cold_directory)]
+        for filename in filenames:
+            if filename.startswith(file_store.layout_marker_filename):
+                continue
+            current_path = os.path.join(dir_path, filename)
+            target_path = os.path.join(file_store_path, file_store.relative_path(repository_fname=filename,
+                                                                                 layout=layout))
+            if current_path != target_path:
+                yield current_path, target_path
+
+
+def migrate_file_store(layout, dry_run, limit, pause):
+    """
+    Move the files in the file store into a new layout.
+
+    :param string layout:
+        The name of the layout to move files into
+    :param bool dry_run:
+        If true, list the files which would be moved, without moving them
+    :param int limit:
+        The maximum number of files to move, or zero for no limit
+    :param float pause:
+        The number of seconds to pause after each 1000 files, to limit the load this places on the disk
+    :return:
+        None
+    """
+    file_store_path = settings['dbFilestore']
+    old_layout = file_store.read_layout(file_store_path=file_store_path)
+    logging.info("File store <{}> currently uses layout <{}>".format(file_store_path, old_layout))
+
+    # Record the new layout first, so that new files are stored in it, while lookups fall back to the old layout
+    if not dry_run:
+        file_store.write_layout(file_store_path=file_store_path, layout=layout)
+
+    moved = 0
+    collisions = 0
+    for current_path, target_path in files_to_move(file_store_path=file_store_path, layout=layout):
+        if limit and moved >= limit:
+            logging.info("Stopping after moving {:d} files. Run again to continue.".format(moved))
+            break
+
+        if dry_run:
+            logging.info("Would move <{}> to <{}>".format(current_path, target_path))
+            moved += 1
+            continue
+
+        # Never overwrite a file which is already in place
+        if os.path.exists(target_path):
+            logging.info("Not moving <{}>, since <{}> already exists".format(current_path, target_path))
+            collisions += 1
+            continue
+
+        # Renaming within a single filesystem is atomic, so readers see the file in exactly one place
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        os.rename(current_path, target_path)
+        moved += 1
+
+        if moved % 1000 == 0:
+            logging.info("Moved {:d} files".format(moved))
+            time.sleep(pause)
+
+    # Remove subdirectories left empty by moving files back into a flat layout
+    if layout == 'flat' and not dry_run:
+        kept_directories = [os.path.join(file_store_path, item)
+                            for item in (file_store.blob_directory, file_store.cold_directory)]
+        for dir_path, dir_names, filenames in os.walk(file_store_path, topdown=False):
+            if any(os.path.commonpath([dir_path, item]) == item for item in kept_directories):
+                continue
+            if dir_path != file_store_path and not os.listdir(dir_path):
+                os.rmdir(dir_path)
+
+    logging.info("Moved {:d} files into layout <{}>. {:d} files could not be moved.".format(moved, layout,
+                                                                                          collisions))
+
+
+if __name__ == "__main__":
+    # Read commandline arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--layout', dest='layout', default='date', choices=file_store.layouts,
+                        help="The layout to move files into")
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help="List the files which would be moved, without moving them")
+    parser.add_argument('--limit', dest='limit', default=0, type=int,
+                        help="The maximum number of files to move in this run")
+    parser.add_argument('--pause', dest='pause', default=0.5, type=float,
+                        help="Number of seconds to pause after each 1000 files, to reduce disk load")
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S',
+                        handlers=[
+                            logging.FileHandler(os.path.join(settings['pythonPath'], "../datadir/pigazing.log")),
+                            logging.StreamHandler()
+                        ])
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    migrate_file_store(layout=args.layout, dry_run=args.dry_run, limit=args.limit, pause=args.pause)
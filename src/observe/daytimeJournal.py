@@ -0,0 +1,192 @@
+#!../../datadir/virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+# daytimeJournal.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+A journal recording the progress of each group of jobs run by <daytimeTaskDefinitions.execute_shell_command>, so that
+if the daytime tasks are interrupted, the next run can tell which groups had already been imported into the database,
+and finish them off rather than importing them a second time.
+
+Each group of jobs with a common time stamp passes through the following states:
+
+* started -- the jobs' shell commands have been run, or are running.
+* registering -- the group's products have been registered as the observation <observationId>, but this may not yet
+  have been committed to the database.
+* committed -- the group's products have been committed to the database, but its input files may not yet have been
+  deleted.
+* done -- the group's input files have been deleted.
+
+The journal also records the range of times over which each observatory has had new observations imported, so that
+<daytimeTaskDefinitions.SelectBestImages> can select the best images from them, even when they were imported by a
+different process, such as <ingestionDaemon.py> during the night.
+"""
+
+import os
+import sqlite3
+import time
+
+from pigazing_helpers.settings_read import settings
+
+# The default location of the journal
+journal_path = os.path.join(settings['pythonPath'], '../datadir/daytimeJournal.sqlite')
+
+
+class DaytimeJournal:
+    """
+    The journal of the progress of groups of jobs, stored in an SQLite database. Each process should open the journal
+    for itself; instances must not be shared between processes.
+    """
+
+    def __init__(self, path=journal_path):
+        """
+        Open the journal, creating it if it does not already exist.
+
+        :param string path:
+            The path of the journal file
+        """
+        self.path = path
+
+        # Several worker processes write to the journal at once, so we wait for each other's locks, and each change is
+        # flushed to disk before we carry on
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL;")
+        self.db.execute("PRAGMA synchronous=FULL;")
+        self.db.execute("""
+CREATE TABLE IF NOT EXISTS job_groups (
+    groupKey TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    observationId TEXT,
+    updatedTime REAL
+);""")
+        self.db.execute("""
+CREATE TABLE IF NOT EXISTS observatories_seen (
+    obstoryId TEXT PRIMARY KEY,
+    utcMin REAL NOT NULL,
+    utcMax REAL NOT NULL
+);""")
+        self.db.commit()
+
+    def fetch(self, group_key):
+        """
+        Look up the state of a group of jobs.
+
+        :param string group_key:
+            The key identifying the group of jobs
+        :return:
+            A (state, observation ID) tuple, or None if the group is not in the journal
+        """
+        return self.db.execute("SELECT state, observationId FROM job_groups WHERE groupKey=?;",
+                               (group_key,)).fetchone()
+
+    def record(self, group_key, state, observation_id=None):
+        """
+        Record the state of a group of jobs. The change is on disk by the time this method returns.
+
+        :param string group_key:
+            The key identifying the group of jobs
+        :param string state:
+            The new state of the group
+        :param string observation_id:
+            The ID of the observation the group's products were registered as, if any. If None, any ID already
+            recorded is kept.
+        :return:
+            None
+        """
+        self.db.execute("""
+INSERT INTO job_groups (groupKey, state, observationId, updatedTime) VALUES (?, ?, ?, ?)
+ON CONFLICT(groupKey) DO UPDATE SET
+    state=excluded.state,
+    observationId=COALESCE(excluded.observationId, observationId),
+    updatedTime=excluded.updatedTime;
+""", (group_key, state, observation_id, time.time()))
+        self.db.commit()
+
+    def record_observation(self, obstory_id, utc):
+        """
+        Record that an observation has been imported, extending the range of times over which its observatory has had
+        new observations. The change is on disk by the time this method returns.
+
+        :param string obstory_id:
+            The publicId of the observatory which made the observation
+        :param float utc:
+            The unix time of the observation
+        :return:
+            None
+        """
+        self.db.execute("""
+INSERT INTO observatories_seen (obstoryId, utcMin, utcMax) VALUES (?, ?, ?)
+ON CONFLICT(obstoryId) DO UPDATE SET
+    utcMin=MIN(utcMin, excluded.utcMin),
+    utcMax=MAX(utcMax, excluded.utcMax);
+""", (obstory_id, utc, utc))
+        self.db.commit()
+
+    def fetch_observatories_seen(self):
+        """
+        Look up the observatories which have had new observations imported.
+
+        :return:
+            Dictionary of {'utc_min', 'utc_max'} dictionaries, giving the range of times of the new observations,
+            indexed by observatory publicId
+        """
+        return dict((obstory_id, {'utc_min': utc_min, 'utc_max': utc_max})
+                    for obstory_id, utc_min, utc_max
+                    in self.db.execute("SELECT obstoryId, utcMin, utcMax FROM observatories_seen;"))
+
+    def clear_observatory_seen(self, obstory_id, utc_min, utc_max):
+        """
+        Forget the range of times over which an observatory has had new observations, once they have been dealt with.
+        If the range has been extended since it was fetched, it is kept.
+
+        :param string obstory_id:
+            The publicId of the observatory
+        :param float utc_min:
+            The start of the range of times, as returned by <fetch_observatories_seen>
+        :param float utc_max:
+            The end of the range of times, as returned by <fetch_observatories_seen>
+        :return:
+            None
+        """
+        self.db.execute("DELETE FROM observatories_seen WHERE obstoryId=? AND utcMin=? AND utcMax=?;",
+                        (obstory_id, utc_min, utc_max))
+        self.db.commit()
+
+    def prune(self, max_age):
+        """
+        Remove entries from the journal which have not been updated for a long time.
+
+        :param float max_age:
+            The age, in days, of the entries to remove
+        :return:
+            None
+        """
+        self.db.execute("DELETE FROM job_groups WHERE updatedTime < ?;", (time.time() - max_age * 86400,))
+        self.db.commit()
+
+    def close(self):
+        """
+        Close the journal.
+
+        :return:
+            None
+        """
+        self.db.close()
@@ -27,25 +27,52 @@ It is generic file processor. Each class looks for files in particular directori
 works out the time associated with each file from its filename, and performs predefined shell-commands on them.
 """
 
+import contextlib
+import fcntl
 import glob
 import logging
 import multiprocessing
+import multiprocessing.util
 import subprocess
 import os
 import time
-import json
+import struct
 import uuid
 import numpy
 
+import MySQLdb
+
 from math import floor, ceil
 
+import daytimeJournal
+
 from pigazing_helpers.dcf_ast import unix_from_jd, jd_from_unix, julian_day, inv_julian_day
 from pigazing_helpers.sunset_times import sun_pos, alt_az
 from pigazing_helpers.obsarchive import obsarchive_model, obsarchive_db
-from pigazing_helpers import hardware_properties
+from pigazing_helpers import clipping_mask, hardware_properties, mp4_faststart
 from pigazing_helpers.settings_read import settings, installation_info, known_observatories
 
-observatories_seen = {}
+# Lock file held by whichever process is importing files from <datadir> into the database
+ingestion_lock_path = os.path.join(settings['pythonPath'], '../datadir/ingestion.lock')
+
+
+def acquire_ingestion_lock(blocking=True):
+    """
+    Take the lock which ensures that only one process at a time imports files from <datadir> into the database. The
+    lock is held until the returned file object is closed, or the process exits.
+
+    :param bool blocking:
+        If true, wait for the lock to become free. Otherwise, give up at once if another process holds it.
+    :return:
+        A file object which holds the lock, or None if the lock is held by another process
+    """
+    lock_file = open(ingestion_lock_path, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
 
 
 def check_observatory_exists(db_handle, obs_id=installation_info['observatoryId'], utc=0):
@@ -127,6 +154,172 @@ def check_observatory_exists(db_handle, obs_id=installation_info['observatoryId'
                                             user_created=settings['pigazingUser'])
 
 
+class WorkerDatabase:
+    """
+    A connection to the database which a worker process holds open for as long as it lives, so that the jobs it runs
+    with <execute_shell_command> do not each need to open a connection of their own.
+
+    Changes are committed after every <commit_interval> jobs. The input files of each job are only deleted once its
+    changes have been committed, so if a worker dies, or loses its connection, before committing, those jobs are simply
+    run again next time. The progress of each group of jobs is recorded in <journal>.
+
+    :ivar DaytimeJournal journal:
+        The journal in which we record the progress of each group of jobs
+    :ivar int commit_interval:
+        The number of jobs to run between commits
+    :ivar float ping_interval:
+        If the connection has been idle for longer than this number of seconds, it is pinged before being used, and
+        reopened if the server has closed it
+    """
+
+    def __init__(self, journal, commit_interval=1, ping_interval=10):
+        self.journal = journal
+        self.commit_interval = commit_interval
+        self.ping_interval = ping_interval
+        self.db = None
+        self.last_used = 0
+        self.jobs_since_commit = 0
+        self.files_to_delete = []
+        self.groups_to_commit = []
+
+    def get(self):
+        """
+        Return this worker's database handle, opening a new connection if there is none, or if the server has closed
+        the old one.
+
+        :return:
+            An :class:`obsarchive_db.ObservationDatabase`
+        """
+        if (self.db is not None) and (time.time() - self.last_used > self.ping_interval):
+            try:
+                self.db.db.ping()
+            except MySQLdb.Error:
+                logging.info("Reopening broken database connection")
+                self.reset()
+
+        if self.db is None:
+            self.db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                                        db_host=installation_info['mysqlHost'],
+                                                        db_user=installation_info['mysqlUser'],
+                                                        db_password=installation_info['mysqlPassword'],
+                                                        db_name=installation_info['mysqlDatabase'],
+                                                        obstory_id=installation_info['observatoryId'])
+
+        self.last_used = time.time()
+        return self.db
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager which provides this worker's database handle. If an error occurs while it is in use, the
+        connection is discarded, rolling back the job's partial changes, so that the next job starts with a fresh one.
+
+        :return:
+            An :class:`obsarchive_db.ObservationDatabase`
+        """
+        try:
+            yield self.get()
+        except Exception:
+            self.reset()
+            raise
+
+    def reset(self):
+        """
+        Close the connection after an error. Any uncommitted changes are rolled back, so the files which the jobs that made
+        them would have deleted are kept.
+
+        :return:
+            None
+        """
+        if self.db is not None:
+            try:
+                self.db.close_db()
+            except MySQLdb.Error:
+                pass
+        self.db = None
+        self.jobs_since_commit = 0
+        self.files_to_delete = []
+        self.groups_to_commit = []
+
+    def job_finished(self, files_to_delete, group_key=None):
+        """
+        Record that a job has finished, committing its changes if enough jobs have finished since the last commit.
+
+        :param list files_to_delete:
+            The files to delete once this job's changes have been committed
+        :param string group_key:
+            The key of the job in the journal, if it has one
+        :return:
+            None
+        """
+        self.files_to_delete.extend(files_to_delete)
+        if group_key is not None:
+            self.groups_to_commit.append(group_key)
+        self.jobs_since_commit += 1
+        if self.jobs_since_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        """
+        Commit any outstanding changes, and delete the files belonging to the jobs which made them.
+
+        :return:
+            None
+        """
+        if self.db is not None:
+            with self.connection() as db:
+                db.commit()
+        for group_key in self.groups_to_commit:
+            self.journal.record(group_key=group_key, state='committed')
+
+        for item in self.files_to_delete:
+            if os.path.exists(item):
+                os.unlink(item)
+        for group_key in self.groups_to_commit:
+            self.journal.record(group_key=group_key, state='done')
+
+        self.files_to_delete = []
+        self.groups_to_commit = []
+        self.jobs_since_commit = 0
+
+    def close(self):
+        """
+        Commit any outstanding changes and close the connection.
+
+        :return:
+            None
+        """
+        self.commit()
+        if self.db is not None:
+            self.db.close_db()
+            self.db = None
+        self.journal.close()
+
+
+# The database connection belonging to this process, when it is a worker running <execute_shell_command>
+worker_database = None
+
+
+def initialise_worker(commit_interval=1):
+    """
+    Give a worker process its own database connection, which it keeps open for as long as it lives. This should be
+    passed as the <initializer> of any pool of worker processes which run <execute_shell_command>.
+
+    Tasks which depend on others read their products from the database, and so only see them once they have been
+    committed. Commit intervals greater than one should only be used for tasks which nothing depends on.
+
+    :param int commit_interval:
+        The number of jobs to run between commits
+    :return:
+        None
+    """
+    global worker_database
+    worker_database = WorkerDatabase(journal=daytimeJournal.DaytimeJournal(), commit_interval=commit_interval)
+
+    # Commit any outstanding changes when the worker process exits
+    multiprocessing.util.Finalize(None, worker_database.close, exitpriority=10)
+
+
 def execute_shell_command(arguments):
     """
     Run a shell command to compete some task. Import the resulting file products into the database, and then delete
@@ -142,40 +335,39 @@ def execute_shell_command(arguments):
     if (arguments['must_quit_by'] is not None) and (time.time() > arguments['must_quit_by']):
         return
 
+    # Use this worker's database connection, opening one if it wasn't started by <initialise_worker>
+    if worker_database is None:
+        initialise_worker()
+
+    # Record in the journal that we have started work on this group of jobs
+    group_key = arguments.get('group_key', None)
+    if group_key is not None:
+        worker_database.journal.record(group_key=group_key, state='started')
+
     # Compile a list of all of the output files we have generated
     file_inputs = []
     file_products = []
 
+    # The status of the observatory, which we fetch if any job needs its clipping mask
+    obstory_status = None
+
     # Loop over all the input files associated with this time stamp
     for job in arguments['job_list']:
 
-        # If this job requires a clipping mask, we create that now
+        # If this job requires a clipping mask, fetch the mask files for the observatory's clipping region from the
+        # cache. The bitmap is only used if the video turns out to be the size the camera is configured to record.
         if 'mask_file' in job['shell_command']:
-            # Open connection to the database
-            db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
-                                                   db_host=installation_info['mysqlHost'],
-                                                   db_user=installation_info['mysqlUser'],
-                                                   db_password=installation_info['mysqlPassword'],
-                                                   db_name=installation_info['mysqlDatabase'],
-                                                   obstory_id=installation_info['observatoryId'])
-
-            # Fetch observatory status
-            obstory_status = db.get_obstory_status(obstory_id=arguments['obs_id'],
-                                                   time=arguments['utc'])
-
-            # Close database connection
-            db.close_db()
-            del db
-
-            # Export the clipping mask to a JSON file
-            mask_file = "/tmp/mask_{}_{}.txt".format(os.getpid(), str(uuid.uuid4()))
-            with open(mask_file, "w") as f:
-                f.write("\n\n".join(
-                    ["\n".join([("%d %d" % p) for p in pointList])
-                     for pointList in json.loads(obstory_status['clipping_region'])]
-                )
-                )
-            job['mask_file'] = mask_file
+            if obstory_status is None:
+                with worker_database.connection() as db:
+                    obstory_status = db.get_obstory_status(obstory_id=arguments['obs_id'],
+                                                           time=arguments['utc'])
+
+            job['mask_file'] = clipping_mask.mask_file(obstory_id=arguments['obs_id'],
+                                                       clipping_region=obstory_status['clipping_region'])
+            job['mask_bitmap_file'] = clipping_mask.mask_file(obstory_id=arguments['obs_id'],
+                                                              clipping_region=obstory_status['clipping_region'],
+                                                              width=int(obstory_status['camera_width']),
+                                                              height=int(obstory_status['camera_height']))
 
         # Make settings available as string substitutions
         job['settings'] = settings
@@ -218,107 +410,110 @@ def execute_shell_command(arguments):
 
     # Only add anything to the database if we created some output files
     if len(file_products) > 0:
-        # Open connection to the database
-        db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
-                                               db_host=installation_info['mysqlHost'],
-                                               db_user=installation_info['mysqlUser'],
-                                               db_password=installation_info['mysqlPassword'],
-                                               db_name=installation_info['mysqlDatabase'],
-                                               obstory_id=installation_info['observatoryId'])
-
-        # Collect metadata associated with this observation
-        observation_metadata = {}
-        for output_file in file_products:
+        with worker_database.connection() as db:
+            # Collect metadata associated with this observation
+            observation_metadata = {}
+            for output_file in file_products:
 
-            # Collect metadata associated with this output file
-            try:
-                product_metadata_file, obstory_info, product_metadata = metadata_file_to_dict(
-                    db_handle=db,
-                    product_filename=output_file['filename'],
-                    input_metadata=output_file['input_file_metadata'],
-                    required=False
-                )
-            except AssertionError:
-                logging.error("Invalid metadata for file <{}>".format(output_file['filename']))
-                continue
+                # Collect metadata associated with this output file
+                try:
+                    product_metadata_file, obstory_info, product_metadata = metadata_file_to_dict(
+                        db_handle=db,
+                        product_filename=output_file['filename'],
+                        input_metadata=output_file['input_file_metadata'],
+                        required=False
+                    )
+                except AssertionError:
+                    logging.error("Invalid metadata for file <{}>".format(output_file['filename']))
+                    continue
 
-            # Store metadata associated with this file
+                # Move the index of videos to the start of the file, so that browsers can start playing them without
+                # first fetching the end of the file, and record where the keyframes are, so that players can seek to
+                # them
+                if output_file['mime_type'] == 'video/mp4':
+                    try:
+                        video_metadata = mp4_faststart.prepare_for_streaming(file_path=output_file['filename'])
+                        for key, value in video_metadata.items():
+                            product_metadata.setdefault(key, value)
+                    except (OSError, ValueError, struct.error):
+                        logging.error("Could not prepare video <{}> for streaming".format(output_file['filename']))
+
+                # Store metadata associated with this file
+                metadata_objs = metadata_to_object_list(db_handle=db,
+                                                        obs_time=arguments['utc'],
+                                                        obs_id=arguments['obs_id'],
+                                                        user_id=arguments['user_id'],
+                                                        meta_dict=product_metadata)
+
+                if product_metadata_file is not None:
+                    output_file['metadata_files'].append(product_metadata_file)
+
+                output_file['product_metadata'] = product_metadata
+                output_file['metadata_objs'] = metadata_objs
+                output_file['obstory_info'] = obstory_info
+
+                # Check which fields this file propagates to its parent observation
+                for field_to_propagate in output_file['propagate_metadata']:
+                    if field_to_propagate in product_metadata:
+                        observation_metadata[field_to_propagate] = product_metadata[field_to_propagate]
+
+            # Turn metadata associated with this observation into database metadata objects
             metadata_objs = metadata_to_object_list(db_handle=db,
                                                     obs_time=arguments['utc'],
                                                     obs_id=arguments['obs_id'],
                                                     user_id=arguments['user_id'],
-                                                    meta_dict=product_metadata)
-
-            if product_metadata_file is not None:
-                output_file['metadata_files'].append(product_metadata_file)
-
-            output_file['product_metadata'] = product_metadata
-            output_file['metadata_objs'] = metadata_objs
-            output_file['obstory_info'] = obstory_info
-
-            # Check which fields this file propagates to its parent observation
-            for field_to_propagate in output_file['propagate_metadata']:
-                if field_to_propagate in product_metadata:
-                    observation_metadata[field_to_propagate] = product_metadata[field_to_propagate]
-
-        # Turn metadata associated with this observation into database metadata objects
-        metadata_objs = metadata_to_object_list(db_handle=db,
-                                                obs_time=arguments['utc'],
-                                                obs_id=arguments['obs_id'],
-                                                user_id=arguments['user_id'],
-                                                meta_dict=observation_metadata)
-
-        # Import file products into the database
-        obs_obj = db.register_observation(obstory_id=arguments['obs_id'],
-                                          random_id=False,
-                                          obs_time=arguments['utc'],
-                                          creation_time=time.time(),
-                                          obs_type=arguments['obs_type'],
-                                          user_id=arguments['user_id'],
-                                          obs_meta=metadata_objs,
-                                          published=1, moderated=1, featured=0,
-                                          ra=-999, dec=-999,
-                                          field_width=None, field_height=None,
-                                          position_angle=None, central_constellation=None,
-                                          altitude=-999, azimuth=-999, alt_az_pa=None,
-                                          astrometry_processed=None, astrometry_processing_time=None,
-                                          astrometry_source=None)
-        obs_id = obs_obj.id
-
-        for output_file in file_products:
+                                                    meta_dict=observation_metadata)
+
+            # Import file products into the database
+            obs_obj = db.register_observation(obstory_id=arguments['obs_id'],
+                                              random_id=False,
+                                              obs_time=arguments['utc'],
+                                              creation_time=time.time(),
+                                              obs_type=arguments['obs_type'],
+                                              user_id=arguments['user_id'],
+                                              obs_meta=metadata_objs,
+                                              published=1, moderated=1, featured=0,
+                                              ra=-999, dec=-999,
+                                              field_width=None, field_height=None,
+                                              position_angle=None, central_constellation=None,
+                                              altitude=-999, azimuth=-999, alt_az_pa=None,
+                                              astrometry_processed=None, astrometry_processing_time=None,
+                                              astrometry_source=None)
+            obs_id = obs_obj.id
+
             # The semantic types which we should make the primary images of their parent observations
             primary_image_type_list = (
                 'pigazing:movingObject/maximumBrightness',
                 'pigazing:timelapse/backgroundSubtracted'
             )
 
-            db.register_file(file_path=output_file['filename'],
-                             user_id=output_file['obstory_info']['userId'],
-                             mime_type=output_file['mime_type'],
-                             semantic_type=output_file['product_metadata']['semanticType'],
-                             primary_image=output_file['product_metadata']['semanticType'] in primary_image_type_list,
-                             file_time=arguments['utc'],
-                             file_meta=output_file['metadata_objs'],
-                             observation_id=obs_id,
-                             random_id=False)
-
-        # Close connection to the database
-        db.commit()
-        db.close_db()
-        del db
-
-    # Delete input files
-    for item in file_inputs:
-        if os.path.exists(item):
-            os.unlink(item)
-
-    # Delete output files
-    for item in file_products:
-        if os.path.exists(item['filename']):
-            os.unlink(item['filename'])
-        for metadata_filename in item['metadata_files']:
-            if os.path.exists(metadata_filename):
-                os.unlink(metadata_filename)
+            # Register all of the file products in one go, so that they are committed in a single transaction
+            db.register_files_bulk(files=[{
+                'file_path': output_file['filename'],
+                'user_id': output_file['obstory_info']['userId'],
+                'mime_type': output_file['mime_type'],
+                'semantic_type': output_file['product_metadata']['semanticType'],
+                'primary_image': output_file['product_metadata']['semanticType'] in primary_image_type_list,
+                'file_time': arguments['utc'],
+                'file_meta': output_file['metadata_objs'],
+                'observation_id': obs_id,
+                'random_id': False
+            } for output_file in file_products if 'metadata_objs' in output_file])
+
+            # Record which observation we created before it is committed, so that if we are interrupted, the next run
+            # can check whether the commit happened
+            if group_key is not None:
+                worker_database.journal.record(group_key=group_key, state='registering', observation_id=obs_id)
+
+            # Record that this observatory has new observations at this time, so that <SelectBestImages> looks at them
+            worker_database.journal.record_observation(obstory_id=arguments['obs_id'], utc=arguments['utc'])
+
+    # Delete the input files and any output files which were not imported, once our changes have been committed
+    worker_database.job_finished(files_to_delete=file_inputs +
+                                 [item['filename'] for item in file_products] +
+                                 [metadata_filename for item in file_products
+                                  for metadata_filename in item['metadata_files']],
+                                 group_key=group_key)
 
 
 observatory_information = {}
@@ -517,6 +712,14 @@ class TaskRunner:
     format of the shell command we need to run on each file.
     """
 
+    # Tasks which run a shell command on each of a list of input files can share a pool of worker processes with other
+    # tasks. Tasks which override <execute_tasks> to do something else are run in a thread of their own.
+    runs_in_pool = True
+
+    # If set, a function which is passed the path of each input file, and returns False for files which should be left
+    # alone for now. This is used by <ingestionDaemon.py> to skip files which are still being written.
+    input_file_filter = None
+
     def __init__(self, must_quit_by=None):
         """
         Initialise task runner.
@@ -536,8 +739,6 @@ class TaskRunner:
             None
         """
 
-        global observatories_seen
-
         # Open connection to the database
         db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
                                                db_host=installation_info['mysqlHost'],
@@ -553,6 +754,8 @@ class TaskRunner:
         jobs_by_time = {}
         for glob_pattern in self.glob_patterns():
             for input_file in sorted(glob.glob(os.path.join(data_dir, glob_pattern['wildcard']))):
+                if (self.input_file_filter is not None) and not self.input_file_filter(input_file):
+                    continue
 
                 # Collect metadata associated with this input file
                 try:
@@ -598,18 +801,6 @@ class TaskRunner:
                 # Append this job to list of others with the same time stamp
                 jobs_by_time[time_stamp_string]['job_list'].append(job_descriptor)
 
-                # Record that we've seen this observatory at this time
-                if obstory_id not in observatories_seen:
-                    observatories_seen[obstory_id] = {
-                        'utc_min': utc,
-                        'utc_max': utc
-                    }
-
-                if utc < observatories_seen[obstory_id]['utc_min']:
-                    observatories_seen[obstory_id]['utc_min'] = utc
-                if utc > observatories_seen[obstory_id]['utc_max']:
-                    observatories_seen[obstory_id]['utc_max'] = utc
-
         # Close database connection
         db.commit()
         db.close_db()
@@ -629,6 +820,13 @@ class TaskRunner:
         # Sort list of input files by time stamp
         jobs_by_time = self.fetch_job_list_by_time_stamp()
 
+        # Give each group of jobs a key in the journal, and skip any which an earlier run has already imported. Tasks
+        # which do not run shell commands list a placeholder here instead of groups of jobs, and are not journalled.
+        for time_stamp, job_group in jobs_by_time.items():
+            if isinstance(job_group, dict):
+                job_group['group_key'] = "{}/{}".format(self.__class__.__name__, time_stamp)
+        self.resume_from_journal(jobs_by_time=jobs_by_time)
+
         # Make list of all time stamps
         time_stamps = sorted(jobs_by_time.keys())
 
@@ -638,6 +836,58 @@ class TaskRunner:
         # Write update on our progress
         logging.info("Starting job group <{}>. Running {} tasks.".format(self.__class__.__name__, len(self.task_list)))
 
+    @staticmethod
+    def resume_from_journal(jobs_by_time):
+        """
+        Check the journal for groups of jobs which an earlier, interrupted, run had already imported into the database,
+        but whose input files it had not yet deleted. These groups are finished off by deleting their input files, and
+        are removed from <jobs_by_time>. Groups which were interrupted before their products were committed are left
+        to be run again.
+
+        :param dict jobs_by_time:
+            Dictionary of job descriptors, with time stamp strings as the dictionary key
+        :return:
+            None
+        """
+        journal = daytimeJournal.DaytimeJournal()
+        db = None
+
+        for time_stamp in list(jobs_by_time):
+            if not isinstance(jobs_by_time[time_stamp], dict):
+                continue
+            group_key = jobs_by_time[time_stamp]['group_key']
+            entry = journal.fetch(group_key=group_key)
+            if entry is None:
+                continue
+            state, observation_id = entry
+
+            # If we were interrupted while committing, check whether the observation made it into the database
+            if state == 'registering':
+                if db is None:
+                    db = obsarchive_db.ObservationDatabase(file_store_path=settings['dbFilestore'],
+                                                           db_host=installation_info['mysqlHost'],
+                                                           db_user=installation_info['mysqlUser'],
+                                                           db_password=installation_info['mysqlPassword'],
+                                                           db_name=installation_info['mysqlDatabase'],
+                                                           obstory_id=installation_info['observatoryId'])
+                if db.has_observation_id(observation_id):
+                    state = 'committed'
+
+            if state not in ('committed', 'done'):
+                continue
+
+            logging.info("Group <{}> was imported by an earlier run. Deleting its input files.".format(group_key))
+            for job in jobs_by_time[time_stamp]['job_list']:
+                for item in (job['input_file'], job['input_metadata_filename']):
+                    if (item is not None) and os.path.exists(item):
+                        os.unlink(item)
+            journal.record(group_key=group_key, state='done')
+            del jobs_by_time[time_stamp]
+
+        if db is not None:
+            db.close_db()
+        journal.close()
+
     @staticmethod
     def glob_patterns():
         """
@@ -649,6 +899,17 @@ class TaskRunner:
         """
         return []
 
+    def pool_jobs(self):
+        """
+        Return the list of jobs that need to be run on a pool of worker processes to perform this task. This is used
+        by <daytimeTasks.py> to run jobs from several tasks on a single shared pool.
+
+        :return:
+            List of (function, argument) tuples
+        """
+        self.fetch_job_list()
+        return [(execute_shell_command, item) for item in self.task_list]
+
     def execute_tasks(self):
         """
         Execute this task on all of the input files which we have identified.
@@ -658,9 +919,10 @@ class TaskRunner:
         """
         self.fetch_job_list()
 
-        pool = multiprocessing.Pool(processes=self.maximum_concurrency())
+        pool = multiprocessing.Pool(processes=self.maximum_concurrency(), initializer=initialise_worker)
         pool.map(func=execute_shell_command, iterable=self.task_list)
         pool.close()
+        pool.join()
 
     @staticmethod
     def maximum_concurrency():
@@ -741,9 +1003,9 @@ class MergeOutputIntoSingleObservations(TaskRunner):
         # Instantiate sub tasks
         self.sub_tasks = []
         for sub_task_class in self.sub_task_classes:
-            self.sub_tasks.append(
-                sub_task_class(must_quit_by=self.must_quit_by)
-            )
+            sub_task = sub_task_class(must_quit_by=self.must_quit_by)
+            sub_task.input_file_filter = self.input_file_filter
+            self.sub_tasks.append(sub_task)
 
         # Fetch list of input files, and sort them by time stamp
         jobs_by_time = {}
@@ -778,6 +1040,12 @@ class MergeOutputIntoSingleObservations(TaskRunner):
         # Return combined list of jobs
         return jobs_by_time
 
+    def glob_patterns(self):
+        output = []
+        for sub_task_class in self.sub_task_classes:
+            output.extend(sub_task_class.glob_patterns())
+        return output
+
     def output_file_wildcards(self, input_file):
         output = []
         for sub_task in self.sub_tasks:
@@ -803,7 +1071,8 @@ class AnalyseRawVideos(TaskRunner):
          --obsid \"{input_metadata[obstoryId]}\" \
          --time-start {input_metadata[utc_start]} \
          --fps {input_metadata[fps]} \
-         --mask \"{mask_file}\"
+         --mask \"{mask_file}\" \
+         --mask-bitmap \"{mask_bitmap_file}\"
         """
 
     @staticmethod
@@ -944,12 +1213,12 @@ class SelectBestImages(TaskRunner):
     A TaskRunner which picks the best image from every 30 minute period, and flags it as a featured observation.
     """
 
+    runs_in_pool = False
+
     def fetch_job_list_by_time_stamp(self):
         return {0: True}
 
     def execute_tasks(self):
-        global observatories_seen
-
         # We should select the best image from every N seconds of observing
         period = 1800
 
@@ -964,18 +1233,26 @@ class SelectBestImages(TaskRunner):
                                                db_name=installation_info['mysqlDatabase'],
                                                obstory_id=installation_info['observatoryId'])
 
+        # Look up the IDs of the semantic type and metadata field we filter on
+        timelapse_type_id = db.get_obs_type_id('pigazing:timelapse/')
+        sky_clarity_key_id = db.get_metadata_key_id('pigazing:skyClarity')
+
+        # Look up which observatories have had new observations imported since we last ran. These are recorded in the
+        # journal, since they may have been imported by a different process, such as <ingestionDaemon.py>.
+        journal = daytimeJournal.DaytimeJournal()
+        observatories_seen = journal.fetch_observatories_seen()
+
         # Select best images for each observatory in turn
         for obstory_id in observatories_seen:
+            obstory_uid = db.get_obstory_uid(obstory_id)
             utc_start = floor(observatories_seen[obstory_id]['utc_min'] / period) * period
             utc_end = ceil(observatories_seen[obstory_id]['utc_max'] / period) * period
 
             # Remove featured flag from any time-lapse images that are already highlighted
             db.con.execute("""
 UPDATE archive_observations SET featured=0
-WHERE observatory=(SELECT uid FROM archive_observatories WHERE publicId=%s)
-      AND obsType=(SELECT uid FROM archive_semanticTypes WHERE name='pigazing:timelapse/')
-      AND obsTime BETWEEN %s AND %s;
-""", (obstory_id, utc_start - 1, utc_end + 1))
+WHERE observatory=%s AND obsType=%s AND obsTime BETWEEN %s AND %s;
+""", (obstory_uid, timelapse_type_id, utc_start - 1, utc_end + 1))
 
             # Loop over each hour within the time period for which we have new observations
             for hour in numpy.arange(utc_start, utc_end - 1, period):
@@ -985,13 +1262,10 @@ WHERE observatory=(SELECT uid FROM archive_observatories WHERE publicId=%s)
 SELECT o.uid
 FROM archive_files f
 INNER JOIN archive_observations o ON f.observationId = o.uid
-INNER JOIN archive_metadata m ON f.uid = m.fileId AND
-           m.fieldId=(SELECT uid FROM archive_metadataFields WHERE metaKey='pigazing:skyClarity')
-WHERE o.observatory=(SELECT uid FROM archive_observatories WHERE publicId=%s)
-      AND obsType=(SELECT uid FROM archive_semanticTypes WHERE name='pigazing:timelapse/')
-      AND obsTime BETWEEN %s AND %s
+INNER JOIN archive_metadata m ON f.uid = m.fileId AND m.fieldId=%s
+WHERE o.observatory=%s AND obsType=%s AND obsTime BETWEEN %s AND %s
 ORDER BY m.floatValue DESC LIMIT 1;
-""", (obstory_id, hour, hour + period))
+""", (sky_clarity_key_id, obstory_uid, timelapse_type_id, hour, hour + period))
 
                 # Feature that image
                 for item in db.con.fetchall():
@@ -1002,12 +1276,20 @@ ORDER BY m.floatValue DESC LIMIT 1;
         db.close_db()
         del db
 
+        # Once our selections are committed, we no longer need to look at these observations again
+        for obstory_id, time_range in observatories_seen.items():
+            journal.clear_observatory_seen(obstory_id=obstory_id, utc_min=time_range['utc_min'],
+                                           utc_max=time_range['utc_max'])
+        journal.close()
+
 
 class ExportData(TaskRunner):
     """
     A TaskRunner which calls the script <exportData.py> to export all observations and metadata to an external server.
     """
 
+    runs_in_pool = False
+
     def fetch_job_list_by_time_stamp(self):
         return {0: True}
 
@@ -1037,6 +1319,8 @@ class DetermineLensCorrection(TaskRunner):
     lens.
     """
 
+    runs_in_pool = False
+
     def fetch_job_list_by_time_stamp(self):
         return {0: True}
 
@@ -1065,6 +1349,8 @@ class DeterminePointing(TaskRunner):
     A TaskRunner which calls the script <orientation_calculate.py> to work out which direction the camera is pointing.
     """
 
+    runs_in_pool = False
+
     def fetch_job_list_by_time_stamp(self):
         return {0: True}
 
@@ -1099,6 +1385,8 @@ class CleanDatabase(TaskRunner):
     the SD cards in observatories don't run out of space
     """
 
+    runs_in_pool = False
+
     def fetch_job_list_by_time_stamp(self):
         return {0: True}
 
@@ -1119,6 +1407,8 @@ class Snooze(TaskRunner):
     A TaskRunner which sleeps until we next want to start observing.
     """
 
+    runs_in_pool = False
+
     def fetch_job_list_by_time_stamp(self):
         return {0: True}
 
@@ -1132,18 +1422,65 @@ class Snooze(TaskRunner):
                 time.sleep(sleep_period)
 
 
-# A list of all the tasks we need to perform, in order
-task_running_order = [
-    AnalyseRawVideos,
-    MergeOutputIntoSingleObservations(
-        sub_task_classes=(TriggerRawImages, TriggerRawVideos),
-        must_have_semantic_types=('pigazing:movingObject/video',)
-    ),
-    TimelapseRawImages,
-    SelectBestImages,
-    # DetermineLensCorrection,
-    DeterminePointing,
-    ExportData,
-    CleanDatabase,
-    Snooze
+# All the tasks we need to perform. Each task starts once all of the tasks it depends on have finished, and tasks
+# whose dependencies are met run concurrently. When we are short of time, jobs from the tasks with the highest
+# priority are run first, so that the most valuable products are finished before we must start observing again.
+task_graph = [
+    {
+        'name': 'analyse_raw_videos',
+        'task': AnalyseRawVideos,
+        'depends_on': [],
+        'priority': 100
+    },
+    {
+        'name': 'triggers',
+        'task': MergeOutputIntoSingleObservations(
+            sub_task_classes=(TriggerRawImages, TriggerRawVideos),
+            must_have_semantic_types=('pigazing:movingObject/video',)
+        ),
+        'depends_on': ['analyse_raw_videos'],
+        'priority': 90
+    },
+    {
+        'name': 'timelapse',
+        'task': TimelapseRawImages,
+        'depends_on': ['analyse_raw_videos'],
+        'priority': 80
+    },
+    {
+        'name': 'select_best_images',
+        'task': SelectBestImages,
+        'depends_on': ['timelapse'],
+        'priority': 70
+    },
+    # {
+    #     'name': 'lens_correction',
+    #     'task': DetermineLensCorrection,
+    #     'depends_on': ['timelapse'],
+    #     'priority': 40
+    # },
+    {
+        'name': 'pointing',
+        'task': DeterminePointing,
+        'depends_on': ['timelapse'],
+        'priority': 50
+    },
+    {
+        'name': 'export',
+        'task': ExportData,
+        'depends_on': ['triggers', 'select_best_images', 'pointing'],
+        'priority': 60
+    },
+    {
+        'name': 'clean_database',
+        'task': CleanDatabase,
+        'depends_on': ['export'],
+        'priority': 20
+    },
+    {
+        'name': 'snooze',
+        'task': Snooze,
+        'depends_on': ['clean_database'],
+        'priority': 0
+    }
 ]
@@ -27,15 +27,194 @@ This performs a set of tasks which need to be performed on Pi Gazing data during
 
 import argparse
 import logging
+import multiprocessing
 import os
+import queue
+import sys
+import threading
 import time
 
+import daytimeJournal
 import daytimeTaskDefinitions
 
 from pigazing_helpers.settings_read import settings
 
 
-def daytime_tasks(must_quit_by=None):
+class TaskScheduler:
+    """
+    Runs the tasks listed in <daytimeTaskDefinitions.task_graph>, starting each task as soon as all of the tasks it
+    depends on have finished. Jobs from all of the tasks which are running are dispatched to a single shared pool of
+    worker processes, so that no worker sits idle while a slow task finishes. Whenever a worker is free, it is given a
+    job from the running task with the highest priority, subject to each task's <maximum_concurrency>. Tasks which do
+    not run on the pool run in threads of their own. Once <must_quit_by> has passed, no further jobs are started.
+
+    Tasks which raise an exception, or whose jobs could not be listed, are marked as failed, and so are the tasks
+    which depend on them.
+    """
+
+    def __init__(self, task_graph, workers, must_quit_by=None):
+        """
+        Create a scheduler.
+
+        :param list task_graph:
+            List of task descriptors, as in <daytimeTaskDefinitions.task_graph>
+        :param int workers:
+            The number of worker processes in the shared pool
+        :param float must_quit_by:
+            The unix time when we need to exit, even if jobs are unfinished
+        """
+        self.workers = workers
+        self.must_quit_by = must_quit_by
+
+        self.tasks = {}
+        for item in task_graph:
+            self.tasks[item['name']] = {
+                'descriptor': item,
+                'state': 'waiting',
+                'runner': None,
+                'jobs': [],
+                'in_flight': 0
+            }
+            for dependency in item['depends_on']:
+                if dependency not in self.tasks:
+                    raise ValueError("Task <{}> depends on <{}>, which must be listed before it".format(
+                        item['name'], dependency))
+
+        # Notifications from pool callbacks and threads that a job or task has finished
+        self._finished = queue.Queue()
+
+    def out_of_time(self):
+        """
+        Test whether <must_quit_by> has passed.
+
+        :return:
+            Boolean
+        """
+        return (self.must_quit_by is not None) and (time.time() > self.must_quit_by)
+
+    def _run_in_thread(self, name, runner):
+        try:
+            runner.execute_tasks()
+        except Exception:
+            logging.exception("Task <{}> failed".format(name))
+            self._finished.put((name, 'failed'))
+            return
+        self._finished.put((name, 'done'))
+
+    def _start_ready_tasks(self):
+        """
+        Start all of the tasks whose dependencies have finished.
+
+        :return:
+            None
+        """
+        for name, task in self.tasks.items():
+            if task['state'] != 'waiting':
+                continue
+            failed_dependencies = [dependency for dependency in task['descriptor']['depends_on']
+                                   if self.tasks[dependency]['state'] == 'failed']
+            if failed_dependencies:
+                logging.error("Skipping task <{}> as <{}> failed.".format(name, ", ".join(failed_dependencies)))
+                task['state'] = 'failed'
+                continue
+            if any(self.tasks[dependency]['state'] != 'done' for dependency in task['descriptor']['depends_on']):
+                continue
+
+            if self.out_of_time():
+                logging.info("Skipping task <{}> as we have run out of time.".format(name))
+                task['state'] = 'done'
+                continue
+
+            logging.info("Starting task <{}>".format(name))
+            task['runner'] = task['descriptor']['task'](must_quit_by=self.must_quit_by)
+            task['state'] = 'running'
+            if task['runner'].runs_in_pool:
+                try:
+                    task['jobs'] = task['runner'].pool_jobs()
+                except Exception:
+                    logging.exception("Could not list the jobs in task <{}>".format(name))
+                    task['state'] = 'failed'
+            else:
+                threading.Thread(target=self._run_in_thread, args=(name, task['runner'])).start()
+
+    def _next_job(self):
+        """
+        Choose the task whose job should run next on the pool.
+
+        :return:
+            The name of the task, or None if no jobs can be started
+        """
+        candidates = [name for name, task in self.tasks.items()
+                      if task['state'] == 'running' and task['jobs'] and
+                      task['in_flight'] < task['runner'].maximum_concurrency()]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda name: self.tasks[name]['descriptor']['priority'])
+
+    def run(self):
+        """
+        Run all of the tasks.
+
+        :return:
+            List of the names of the tasks which failed
+        """
+        # Each worker keeps one connection to the database open for as long as it lives
+        pool = multiprocessing.Pool(processes=self.workers, initializer=daytimeTaskDefinitions.initialise_worker)
+        in_flight = 0
+
+        while True:
+            self._start_ready_tasks()
+
+            # Drop jobs which have not started if we have run out of time
+            if self.out_of_time():
+                for task in self.tasks.values():
+                    task['jobs'] = []
+
+            # Give jobs to all of the free workers
+            while in_flight < self.workers:
+                name = self._next_job()
+                if name is None:
+                    break
+                task = self.tasks[name]
+                function, argument = task['jobs'].pop(0)
+                task['in_flight'] += 1
+                in_flight += 1
+                pool.apply_async(function, (argument,),
+                                 callback=lambda result, task_name=name: self._finished.put((task_name, None)),
+                                 error_callback=lambda error, task_name=name: self._finished.put((task_name, error)))
+
+            # Mark tasks as done once all of their jobs have finished
+            for name, task in self.tasks.items():
+                if (task['state'] == 'running' and task['runner'].runs_in_pool and
+                        not task['jobs'] and task['in_flight'] == 0):
+                    logging.info("Finished task <{}>".format(name))
+                    task['state'] = 'done'
+
+            if all(task['state'] in ('done', 'failed') for task in self.tasks.values()):
+                break
+            if not any(task['state'] == 'running' for task in self.tasks.values()):
+                # Nothing is running, so nothing will make progress; go round again to start newly ready tasks
+                continue
+
+            # Wait for a job or threaded task to finish. Threaded tasks report their final state; jobs report any error.
+            name, result = self._finished.get()
+            if result in ('done', 'failed'):
+                if result == 'done':
+                    logging.info("Finished task <{}>".format(name))
+                self.tasks[name]['state'] = result
+            else:
+                if result is not None:
+                    logging.error("Job in task <{}> failed: {}".format(name, result))
+                self.tasks[name]['in_flight'] -= 1
+                in_flight -= 1
+
+        pool.close()
+        pool.join()
+
+        return [name for name, task in self.tasks.items() if task['state'] == 'failed']
+
+
+def daytime_tasks(must_quit_by=None, workers=None):
     """
     This performs a set of tasks which need to be performed on Pi Gazing data during the daytime.
 
@@ -43,25 +222,39 @@ def daytime_tasks(must_quit_by=None):
         The unix time when we need to exit, even if jobs are unfinished
     :type must_quit_by:
         float
+    :param workers:
+        The number of worker processes to run jobs on, or None to use one per CPU core
+    :type workers:
+        int
     :return:
-        None
+        List of the names of the tasks which failed
     """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
 
-    # Run each task in sequence
-    for task in daytimeTaskDefinitions.task_running_order:
-
-        # If we have run out of time, exit immediately
-        if (must_quit_by is not None) and (time.time() > must_quit_by):
-            logging.info("Quiting as we have run out of time.")
-            return
+    # Wait for <ingestionDaemon.py> to finish, if it is still importing the night's observations
+    lock = daytimeTaskDefinitions.acquire_ingestion_lock(blocking=False)
+    if lock is None:
+        logging.info("Waiting for another process to finish importing files.")
+        lock = daytimeTaskDefinitions.acquire_ingestion_lock()
 
-        # Initialise task runner
-        task_runner = task(must_quit_by=must_quit_by)
+    # Forget about groups of jobs which were finished long ago
+    journal = daytimeJournal.DaytimeJournal()
+    journal.prune(max_age=30)
+    journal.close()
 
-        # Run task
-        task_runner.execute_tasks()
+    scheduler = TaskScheduler(task_graph=daytimeTaskDefinitions.task_graph, workers=workers,
+                              must_quit_by=must_quit_by)
+    failed_tasks = scheduler.run()
+    lock.close()
 
-    logging.info("Day time tasks complete.")
+    if failed_tasks:
+        logging.error("Day time tasks failed: <{}>".format(", ".join(failed_tasks)))
+    if scheduler.out_of_time():
+        logging.info("Quiting as we have run out of time.")
+    else:
+        logging.info("Day time tasks complete.")
+    return failed_tasks
 
 
 if __name__ == "__main__":
@@ -69,6 +262,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--stop-by', default=None, type=float,
                         dest='stop_by', help='The unix time when we need to exit, even if jobs are unfinished')
+    parser.add_argument('--workers', default=None, type=int,
+                        dest='workers', help='The number of worker processes to run jobs on')
     args = parser.parse_args()
 
     # Set up logging
@@ -82,4 +277,5 @@ if __name__ == "__main__":
     logger = logging.getLogger(__name__)
     logger.info(__doc__.strip())
 
-    daytime_tasks(must_quit_by=args.stop_by)
+    if daytime_tasks(must_quit_by=args.stop_by, workers=args.workers):
+        sys.exit(1)
@@ -0,0 +1,243 @@
+#!../../datadir/virtualenv/bin/python3
+# -*- coding: utf-8 -*-
+# ingestionDaemon.py
+#
+# -------------------------------------------------
+# Copyright 2015-2021 Dominic Ford
+#
+# This file is part of Pi Gazing.
+#
+# Pi Gazing is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pi Gazing is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pi Gazing.  If not, see <http://www.gnu.org/licenses/>.
+# -------------------------------------------------
+
+"""
+Import moving objects and time-lapse images into the database while we are still observing, as soon as the observing
+code has finished writing them, rather than waiting to import a whole night's observations in the morning. This runs
+at low priority, and only uses a limited fraction of the CPU time, so that it does not disturb the observing code.
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import glob
+import logging
+import multiprocessing
+import os
+import select
+import time
+
+import daytimeTaskDefinitions
+
+from pigazing_helpers.settings_read import settings
+
+# The tasks in <daytimeTaskDefinitions.task_graph> whose input files are written by the observing code during the night
+streaming_tasks = ('triggers', 'timelapse')
+
+# inotify event types which indicate that a file has been written
+inotify_close_write = 0x00000008
+inotify_moved_to = 0x00000080
+
+
+class DirectoryWatcher:
+    """
+    Waits for files to be written into a set of directories. This uses the Linux inotify API where it is available, and
+    otherwise falls back to polling the directories at regular intervals.
+    """
+
+    def __init__(self, directories):
+        """
+        Start watching a set of directories.
+
+        :param list directories:
+            The directories to watch
+        """
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "Could not initialise inotify")
+            for directory in directories:
+                if libc.inotify_add_watch(fd, os.fsencode(directory), inotify_close_write | inotify_moved_to) < 0:
+                    os.close(fd)
+                    raise OSError(ctypes.get_errno(), "Could not watch <{}>".format(directory))
+            self.fd = fd
+        except (OSError, AttributeError):
+            logging.info("inotify is not available, so polling for new files instead")
+
+    def wait(self, timeout):
+        """
+        Wait until a file has been written into one of the directories, or until a timeout has elapsed.
+
+        :param float timeout:
+            The maximum number of seconds to wait
+        :return:
+            None
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+
+        if select.select([self.fd], [], [], timeout)[0]:
+            # We only need to know that something has changed, so discard the details of the events
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        """
+        Stop watching the directories.
+
+        :return:
+            None
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def find_settled_files(input_files, settle_time):
+    """
+    Work out which input files the observing code has finished writing. Files are grouped by the time stamp at the
+    start of their filenames, and a group is settled once all of its files have metadata files, and none of them has
+    been modified for <settle_time> seconds. This stops us from importing half of a moving object before the rest of its
+    files have been written.
+
+    :param list input_files:
+        The paths of the input files
+    :param float settle_time:
+        The number of seconds a group of files must be left unmodified before we import it
+    :return:
+        A (set of the paths of the files which are settled, number of files which are not yet settled) tuple
+    """
+    groups = {}
+    for input_file in input_files:
+        time_stamp = daytimeTaskDefinitions.filename_to_utc(filename=input_file)
+        groups.setdefault(time_stamp, []).append(input_file)
+
+    settled = set()
+    unsettled = 0
+    for time_stamp, group in groups.items():
+        try:
+            last_modified = max(max(os.stat(input_file).st_mtime,
+                                    os.stat("{}.txt".format(os.path.splitext(input_file)[0])).st_mtime)
+                                for input_file in group)
+        except FileNotFoundError:
+            unsettled += len(group)
+            continue
+        if last_modified < time.time() - settle_time:
+            settled.update(group)
+        else:
+            unsettled += len(group)
+    return settled, unsettled
+
+
+def ingestion_daemon(must_quit_by, cpu_budget, settle_time, poll_interval, workers):
+    """
+    Import new observations into the database as they are written, until <must_quit_by>.
+
+    :param float must_quit_by:
+        The unix time when we need to exit
+    :param float cpu_budget:
+        The fraction of the time that each worker process may spend importing files
+    :param float settle_time:
+        The number of seconds a group of files must be left unmodified before we import it
+    :param float poll_interval:
+        The maximum number of seconds between checks for new files
+    :param int workers:
+        The number of worker processes to import files with
+    :return:
+        None
+    """
+    # Only one process may import files at once
+    lock = daytimeTaskDefinitions.acquire_ingestion_lock(blocking=False)
+    if lock is None:
+        logging.info("Another process is already importing files. Exiting.")
+        return
+
+    # Run at the lowest priority, so that we never hold up the observing code. Worker processes inherit this.
+    os.nice(19)
+
+    tasks = [item['task'] for item in daytimeTaskDefinitions.task_graph if item['name'] in streaming_tasks]
+    data_dir = os.path.join(settings['pythonPath'], '../datadir/')
+    glob_patterns = [pattern['wildcard'] for task in tasks for pattern in task(must_quit_by=None).glob_patterns()]
+
+    # Watch the directories the observing code writes into
+    directories = sorted(set(os.path.dirname(os.path.join(data_dir, wildcard)) for wildcard in glob_patterns))
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    watcher = DirectoryWatcher(directories=directories)
+
+    pool = multiprocessing.Pool(processes=workers, initializer=daytimeTaskDefinitions.initialise_worker)
+    timeout = 0
+    while time.time() < must_quit_by:
+        watcher.wait(timeout=min(timeout, max(0, must_quit_by - time.time())))
+        start_time = time.time()
+
+        # Work out which of the files that are waiting have finished being written
+        input_files = [input_file for wildcard in glob_patterns
+                       for input_file in glob.glob(os.path.join(data_dir, wildcard))]
+        settled, unsettled = find_settled_files(input_files=input_files, settle_time=settle_time)
+
+        # Import them
+        for task in tasks:
+            runner = task(must_quit_by=must_quit_by)
+            runner.input_file_filter = settled.__contains__
+            jobs = runner.pool_jobs()
+            if jobs:
+                pool.map(func=daytimeTaskDefinitions.execute_shell_command, iterable=[item[1] for item in jobs])
+
+        # If there are files still being written, check back once they have had time to settle
+        timeout = settle_time if unsettled else poll_interval
+
+        # Pause for long enough to keep within our CPU budget
+        busy_time = time.time() - start_time
+        time.sleep(min(busy_time * (1 / cpu_budget - 1), max(0, must_quit_by - time.time())))
+
+    pool.close()
+    pool.join()
+    watcher.close()
+    lock.close()
+
+
+if __name__ == "__main__":
+    # Read commandline arguments
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--stop-by', default=None, type=float, required=True,
+                        dest='stop_by', help='The unix time when we need to exit')
+    parser.add_argument('--cpu-budget', default=0.25, type=float,
+                        dest='cpu_budget', help='The fraction of the time each worker may spend importing files')
+    parser.add_argument('--settle-time', default=30, type=float,
+                        dest='settle_time', help='The number of seconds files must be left unmodified before import')
+    parser.add_argument('--poll-interval', default=300, type=float,
+                        dest='poll_interval', help='The maximum number of seconds between checks for new files')
+    parser.add_argument('--workers', default=1, type=int,
+                        dest='workers', help='The number of worker processes to import files with')
+    args = parser.parse_args()
+
+    # Set up logging
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S',
+                        handlers=[
+                            logging.FileHandler(os.path.join(settings['pythonPath'], "../datadir/pigazing.log")),
+                            logging.StreamHandler()
+                        ])
+    logger = logging.getLogger(__name__)
+    logger.info(__doc__.strip())
+
+    ingestion_daemon(must_quit_by=args.stop_by, cpu_budget=args.cpu_budget, settle_time=args.settle_time,
+                     poll_interval=args.poll_interval, workers=args.workers)
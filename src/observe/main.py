@@ -32,7 +32,7 @@ import os
 import subprocess
 import time
 
-from pigazing_helpers import dcf_ast, sunset_times, relay_control
+from pigazing_helpers import clipping_mask, dcf_ast, sunset_times, relay_control
 from pigazing_helpers.obsarchive import obsarchive_db
 from pigazing_helpers.settings_read import settings, installation_info, known_observatories
 
@@ -230,14 +230,14 @@ Waiting {:.0f} seconds (until {}) to start observing.
                                              time_created=time.time(),
                                              user_created=settings['pigazingUser'])
         
-            # Create clipping region mask file
-            mask_file = "/tmp/triggermask_%d.txt" % os.getpid()
-            open(mask_file, "w").write(
-                "\n\n".join(
-                    ["\n".join([("%d %d" % tuple(p)) for p in point_list])
-                     for point_list in json.loads(obstory_status["clipping_region"])]
-                )
-            )
+            # Fetch clipping region mask files from the cache. The observing code uses the bitmap if the camera
+            # gives it frames of the size we ask for, and otherwise rasterises the polygons in the text file.
+            mask_file = clipping_mask.mask_file(obstory_id=obstory_id,
+                                                clipping_region=obstory_status["clipping_region"])
+            mask_bitmap_file = clipping_mask.mask_file(obstory_id=obstory_id,
+                                                       clipping_region=obstory_status["clipping_region"],
+                                                       width=int(obstory_status['camera_width']),
+                                                       height=int(obstory_status['camera_height']))
         
             # Commit updates to the database
             db.commit()
@@ -268,14 +268,14 @@ Starting observing run until {} (running for {:.0f} seconds).
 
             # Work out which C binary we're using to do observing
             if settings['realTime']:
-                output_argument = ""
+                extra_arguments = """ --mask-bitmap \"{}\" """.format(mask_bitmap_file)
                 if obstory_status["camera_type"] == "gphoto2":
                     binary = "realtimeObserve_dslr"
                 else:
                     binary = "realtimeObserve"
             else:
-                output_argument = """ --output \"{}/raw_video/{}_{}\" """.format(settings['dataPath'],
-                                                                                 time_key, obstory_id)
+                extra_arguments = """ --output \"{}/raw_video/{}_{}\" """.format(settings['dataPath'],
+                                                                                   time_key, obstory_id)
                 if settings['i_am_a_rpi']:
                     binary = "recordH264_openmax"
                 else:
@@ -298,7 +298,7 @@ timeout {timeout} \
          --longitude {longitude} \
          --flag-gps {flag_gps} \
          --flag-upside-down {upside_down} \
-         {output_argument}
+         {extra_arguments}
 """.format(
                 timeout=float(observing_duration + 300),
                 binary=binary_full_path,
@@ -313,9 +313,15 @@ timeout {timeout} \
                 longitude=float(longitude),
                 flag_gps=int(flag_gps),
                 upside_down=int(obstory_status['camera_upside_down']),
-                output_argument=output_argument
+                extra_arguments=extra_arguments
             ).strip()
 
+            # Import triggers and time-lapse images into the database while we observe, if configured to do so
+            if settings['realTime'] and settings['ingestDuringNight']:
+                subprocess.Popen("cd {} ; ./ingestionDaemon.py --stop-by {}".format(
+                    os.path.join(settings['pythonPath'], "observe"),
+                    t_stop), shell=True)
+
             logging.info("Running command: {}".format(cmd))
             os.system(cmd)
 
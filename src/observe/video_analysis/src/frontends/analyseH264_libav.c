@@ -74,7 +74,7 @@ typedef struct context {
 
     int frame;
     double utc_start, utc_stop, fps;
-    const char *filename, *mask_file;
+    const char *filename, *mask_file, *mask_bitmap_file;
     unsigned char *mask;
 } context;
 
@@ -241,11 +241,13 @@ int create_observation_mask(context *ctx) {
     fetch_frame((void *) ctx, NULL, NULL);
 
     ctx->mask = malloc(ctx->c->width * ctx->c->height);
-    FILE *mask_file = fopen(ctx->mask_file, "r");
-    if (!mask_file) { logging_fatal(__FILE__, __LINE__, "mask file could not be opened"); }
+    if (!read_mask_bitmap(ctx->mask_bitmap_file, ctx->mask, ctx->c->width, ctx->c->height)) {
+        FILE *mask_file = fopen(ctx->mask_file, "r");
+        if (!mask_file) { logging_fatal(__FILE__, __LINE__, "mask file could not be opened"); }
 
-    fill_polygons_from_file(mask_file, ctx->mask, ctx->c->width, ctx->c->height);
-    fclose(mask_file);
+        fill_polygons_from_file(mask_file, ctx->mask, ctx->c->width, ctx->c->height);
+        fclose(mask_file);
+    }
 
     // Rewind video
     rewind_video(ctx, NULL);
@@ -263,6 +265,7 @@ int main(int argc, const char **argv) {
     context ctx;
     const char *filename = "\0";
     const char *mask_file = "\0";
+    const char *mask_bitmap_file = "\0";
     const char *obstory_id = "\0";
 
     ctx.utc_start = 0;
@@ -275,6 +278,7 @@ int main(int argc, const char **argv) {
             OPT_STRING('i', "input", &filename, "input filename"),
             OPT_STRING('o', "obsid", &obstory_id, "observatory id"),
             OPT_STRING('m', "mask", &mask_file, "mask file"),
+            OPT_STRING('b', "mask-bitmap", &mask_bitmap_file, "mask bitmap in PBM format"),
             OPT_FLOAT('t', "time-start", &ctx.utc_start, "time stamp of start of video clip"),
             OPT_FLOAT('f', "fps", &ctx.fps, "frame count per second"),
             OPT_END(),
@@ -297,6 +301,7 @@ int main(int argc, const char **argv) {
 
     ctx.filename = filename;
     ctx.mask_file = mask_file;
+    ctx.mask_bitmap_file = mask_bitmap_file;
 
     initLut();
 
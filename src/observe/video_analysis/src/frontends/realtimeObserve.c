@@ -76,6 +76,7 @@ int rewind_video(void *video_handle, double *utc) {
 int main(int argc, const char *argv[]) {
     video_metadata vmd;
     const char *mask_file = "\0";
+    const char *mask_bitmap_file = "\0";
     const char *obstory_id = "\0";
     const char *input_device = "\0";
 
@@ -97,6 +98,7 @@ int main(int argc, const char *argv[]) {
             OPT_STRING('o', "obsid", &obstory_id, "observatory id"),
             OPT_STRING('d', "device", &input_device, "input video device, e.g. /dev/video0"),
             OPT_STRING('m', "mask", &mask_file, "mask file"),
+            OPT_STRING('b', "mask-bitmap", &mask_bitmap_file, "mask bitmap in PBM format"),
             OPT_FLOAT('s', "utc-stop", &vmd.utc_stop, "time stamp at which to end observing"),
             OPT_FLOAT('f', "fps", &vmd.fps, "frame count per second"),
             OPT_FLOAT('l', "latitude", &vmd.lat, "latitude of observatory"),
@@ -127,6 +129,7 @@ int main(int argc, const char *argv[]) {
     vmd.obstory_id = obstory_id;
     vmd.video_device = input_device;
     vmd.mask_file = mask_file;
+    vmd.mask_bitmap_file = mask_bitmap_file;
 
     struct video_info *video_in;
 
@@ -156,10 +159,12 @@ int main(int argc, const char *argv[]) {
     video_in->upside_down = vmd.flag_upside_down;
 
     unsigned char *mask = malloc(width * height);
-    FILE *maskfile = fopen(vmd.mask_file, "r");
-    if (!maskfile) { logging_fatal(__FILE__, __LINE__, "mask file could not be opened"); }
-    fill_polygons_from_file(maskfile, mask, width, height);
-    fclose(maskfile);
+    if (!read_mask_bitmap(vmd.mask_bitmap_file, mask, width, height)) {
+        FILE *maskfile = fopen(vmd.mask_file, "r");
+        if (!maskfile) { logging_fatal(__FILE__, __LINE__, "mask file could not be opened"); }
+        fill_polygons_from_file(maskfile, mask, width, height);
+        fclose(maskfile);
+    }
 
     observe((void *) video_in, vmd.obstory_id, vmd.utc_start, vmd.utc_stop, width, height, vmd.fps, "live", mask,
             STACK_COMPARISON_INTERVAL, TRIGGER_PREFIX_TIME, TRIGGER_SUFFIX_TIME,
@@ -31,6 +31,52 @@
 #include "utils/filledPoly.h"
 #include "str_constants.h"
 
+//! read_mask_bitmap - Read the mask which indicates which pixels of the frame may trigger from a bitmap in binary
+//! PBM format, in which set bits mark the pixels which may trigger. This saves rasterising the clipping polygons.
+//! \param filename The filename of the bitmap, or an empty string if there is none
+//! \param mask Array of width * height bytes, which is populated with ones for pixels which may trigger
+//! \param width The width of the frame
+//! \param height The height of the frame
+//! \return One if the mask was read, or zero if the bitmap is missing, corrupt, or does not match the frame size,
+//! in which case the caller should fall back to reading the clipping polygons
+
+int read_mask_bitmap(const char *filename, unsigned char *mask, int width, int height) {
+    int file_width, file_height, x, y;
+
+    if ((filename == NULL) || (filename[0] == '\0')) return 0;
+    FILE *infile = fopen(filename, "rb");
+    if (!infile) return 0;
+
+    // The header gives the size of the bitmap, and is followed by a single whitespace character
+    if ((fscanf(infile, "P4 %d %d", &file_width, &file_height) != 2) ||
+        (file_width != width) || (file_height != height)) {
+        fclose(infile);
+        return 0;
+    }
+    fgetc(infile);
+
+    // Each row of pixels is packed into bytes, most significant bit first
+    const int row_bytes = (width + 7) / 8;
+    unsigned char *row = malloc(row_bytes);
+    if (!row) {
+        fclose(infile);
+        return 0;
+    }
+
+    for (y = 0; y < height; y++) {
+        if (fread(row, 1, row_bytes, infile) != row_bytes) {
+            free(row);
+            fclose(infile);
+            return 0;
+        }
+        for (x = 0; x < width; x++) mask[x + width * y] = (row[x / 8] >> (7 - x % 8)) & 1;
+    }
+
+    free(row);
+    fclose(infile);
+    return 1;
+}
+
 void fill_polygons_from_file(FILE *infile, unsigned char *mask, int width, int height) {
     char line[FNAME_LENGTH];
     int polyCorners = 0, polyX[MAX_POLY_CORNERS], polyY[MAX_POLY_CORNERS];
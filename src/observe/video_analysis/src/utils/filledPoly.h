@@ -28,6 +28,8 @@
 
 #define MAX_POLY_CORNERS 1024
 
+int read_mask_bitmap(const char *filename, unsigned char *mask, int width, int height);
+
 void fill_polygons_from_file(FILE *infile, unsigned char *mask, int width, int height);
 
 int fillPolygon(int polyCorners, int *polyX, int *polyY, unsigned char *mask, int width, int height);
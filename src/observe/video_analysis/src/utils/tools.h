@@ -33,7 +33,7 @@
 typedef struct video_metadata {
     double utc_start, utc_stop, fps, lng, lat;
     int width, height, flag_gps, flag_upside_down, frame_count;
-    const char *obstory_id, *video_device, *filename, *mask_file;
+    const char *obstory_id, *video_device, *filename, *mask_file, *mask_bitmap_file;
 } video_metadata;
 
 void write_raw_video_metadata(video_metadata v);
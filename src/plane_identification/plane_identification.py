@@ -367,39 +367,17 @@ def plane_determination(utc_min, utc_max, source):
     # Status update
     logging.info("Searching for aircraft within period {} to {}".format(date_string(utc_min), date_string(utc_max)))
 
-    # Open direct connection to database
-    conn = db.con
-
     # Search for planes and satellites within this time period
-    conn.execute("""
-SELECT ao.obsTime, ao.publicId AS observationId, f.repositoryFname, l.publicId AS observatory
-FROM archive_observations ao
-LEFT OUTER JOIN archive_files f ON (ao.uid = f.observationId AND
-    f.semanticType=(SELECT uid FROM archive_semanticTypes WHERE name="pigazing:movingObject/video"))
-INNER JOIN archive_observatories l ON ao.observatory = l.uid
-INNER JOIN archive_metadata am2 ON ao.uid = am2.observationId AND
-    am2.fieldId=(SELECT uid FROM archive_metadataFields WHERE metaKey="web:category")
-WHERE ao.obsType=(SELECT uid FROM archive_semanticTypes WHERE name='pigazing:movingObject/') AND
-      ao.obsTime BETWEEN %s AND %s AND
-      (am2.stringValue='Plane' OR am2.stringValue='Satellite' OR am2.stringValue='Junk')
-ORDER BY ao.obsTime
-""", (utc_min, utc_max))
-    results = conn.fetchall()
+    results = [item for item in db.bulk_load_events(utc_min=utc_min, utc_max=utc_max)
+               if item['category'] in ('Plane', 'Satellite', 'Junk')]
 
     # Display logging list of the images we are going to work on
     logging.info("Estimating the identity of {:d} aircraft.".format(len(results)))
 
     # Analyse each aircraft in turn
     for item_index, item in enumerate(results):
-        # Fetch metadata about this object, some of which might be on the file, and some on the observation
-        obs_obj = db.get_observation(observation_id=item['observationId'])
-        obs_metadata = {item.key: item.value for item in obs_obj.meta}
-        if item['repositoryFname']:
-            file_obj = db.get_file(repository_fname=item['repositoryFname'])
-            file_metadata = {item.key: item.value for item in file_obj.meta}
-        else:
-            file_metadata = {}
-        all_metadata = {**obs_metadata, **file_metadata}
+        # Metadata about this object, some of which might be on the file, and some on the observation
+        all_metadata = item['metadata']
 
         # Check we have all required metadata
         if 'pigazing:path' not in all_metadata:
@@ -77,38 +77,16 @@ def frame_drop_detection(utc_min, utc_max):
     # Status update
     logging.info("Searching for frame drops within period {} to {}".format(date_string(utc_min), date_string(utc_max)))
 
-    # Open direct connection to database
-    conn = db.con
-
-    # Search for meteors within this time period
-    conn.execute("""
-SELECT ao.obsTime, ao.publicId AS observationId, f.repositoryFname, l.publicId AS observatory, am6.stringValue AS type
-FROM archive_observations ao
-LEFT OUTER JOIN archive_files f ON (ao.uid = f.observationId AND
-    f.semanticType=(SELECT uid FROM archive_semanticTypes WHERE name="pigazing:movingObject/video"))
-INNER JOIN archive_observatories l ON ao.observatory = l.uid
-LEFT OUTER JOIN archive_metadata am6 ON ao.uid = am6.observationId AND
-    am6.fieldId = (SELECT uid FROM archive_metadataFields WHERE metaKey="web:category")
-WHERE ao.obsType=(SELECT uid FROM archive_semanticTypes WHERE name='pigazing:movingObject/') AND
-      ao.obsTime BETWEEN %s AND %s
-ORDER BY ao.obsTime
-""", (utc_min, utc_max))
-    results = conn.fetchall()
+    # Search for moving objects within this time period
+    results = db.bulk_load_events(utc_min=utc_min, utc_max=utc_max)
 
     # Display logging list of the videos we are going to work on
     logging.info("Searching for dropped frames within {:d} videos.".format(len(results)))
 
     # Analyse each video in turn
     for item_index, item in enumerate(results):
-        # Fetch metadata about this object, some of which might be on the file, and some on the observation
-        obs_obj = db.get_observation(observation_id=item['observationId'])
-        obs_metadata = {item.key: item.value for item in obs_obj.meta}
-        if item['repositoryFname']:
-            file_obj = db.get_file(repository_fname=item['repositoryFname'])
-            file_metadata = {item.key: item.value for item in file_obj.meta}
-        else:
-            file_metadata = {}
-        all_metadata = {**obs_metadata, **file_metadata}
+        # Metadata about this object, some of which might be on the file, and some on the observation
+        all_metadata = item['metadata']
 
         # Check we have all required metadata
         if ('pigazing:path' not in all_metadata) or ('pigazing:videoStart' not in all_metadata):
@@ -119,7 +97,7 @@ ORDER BY ao.obsTime
         logging_prefix = "{date} [{obs}/{type:16s}]".format(
             date=date_string(utc=item['obsTime']),
             obs=item['observationId'],
-            type=item['type'] if item['type'] is not None else ''
+            type=item['category'] if item['category'] is not None else ''
         )
 
         # Read path of the moving object in pixel coordinates
@@ -55,21 +55,26 @@ def search_simultaneous_detections(utc_min, utc_max, utc_must_stop):
     search = mp.ObservationSearch(observation_type="pigazing:movingObject/",
                                   time_min=utc_min,
                                   time_max=utc_max,
-                                  limit=1000000)
-    events_raw = db.search_observations(search)
+                                  limit=0)
 
-    # Use only event descriptors, not other returned fields
-    events = events_raw['obs']
+    # Stream events from the database, keeping only those which have been classified as something other than junk
+    events = []
+    event_count = 0
+    for event in db.stream_observations(search):
+        event_count += 1
 
-    # Make a list of which events are already members of groups
-    events_used = [False] * len(events)
+        # Look up the categorisation of each event, from the metadata returned with the search results
+        event.category = None
+        for meta in event.meta:
+            if meta.key == "web:category":
+                event.category = meta.value
 
-    # Look up the categorisation of each event
-    for event in events:
-        event.category = db.get_observation_metadata(event.id, "web:category")
+        # Throw out junk events and unclassified events
+        if event.category is not None and event.category not in ('Junk', 'Bin'):
+            events.append(event)
 
-    # Throw out junk events and unclassified events
-    events = [x for x in events if x.category is not None and x.category not in ('Junk', 'Bin')]
+    # Make a list of which events are already members of groups
+    events_used = [False] * len(events)
 
     # Look up which pre-existing observation groups each event is in
     for index, event in enumerate(events):
@@ -215,9 +220,9 @@ WHERE grp.semanticType = (SELECT y.uid FROM archive_semanticTypes y WHERE y.name
 
     # Report statistics on events we found
     logging.info("{:6d} moving objects seen within this time period".
-                 format(len(events_raw['obs'])))
+                 format(event_count))
     logging.info("{:6d} moving objects rejected because they were unclassified".
-                 format(len(events_raw['obs']) - len(events)))
+                 format(event_count - len(events)))
     logging.info("{:6d} simultaneous detections found.".
                  format(len(groups)))
 
@@ -182,14 +182,12 @@ def do_triangulation(utc_min, utc_max, utc_must_stop):
 
     # Search for observation groups containing groups of simultaneous detections
     conn.execute("""
-SELECT g.publicId AS groupId, o.publicId AS observationId, o.obsTime, f.repositoryFname,
+SELECT g.publicId AS groupId, o.publicId AS observationId, o.obsTime,
        am.stringValue AS objectType, l.publicId AS observatory
 FROM archive_obs_groups g
 INNER JOIN archive_obs_group_members m on g.uid = m.groupId
 INNER JOIN archive_observations o ON m.childObservation = o.uid
 INNER JOIN archive_observatories l ON o.observatory = l.uid
-LEFT OUTER JOIN archive_files f on o.uid = f.observationId AND
-    f.semanticType=(SELECT uid FROM archive_semanticTypes WHERE name="pigazing:movingObject/video")
 INNER JOIN archive_metadata am ON g.uid = am.groupId AND
     am.fieldId = (SELECT uid FROM archive_metadataFields WHERE metaKey="web:category")
 WHERE """ + " AND ".join(where) + """
@@ -197,6 +195,10 @@ ORDER BY o.obsTime;
 """, args)
     results = conn.fetchall()
 
+    # Fetch the metadata we need about every moving object within this time period in one go
+    event_metadata = {item['observationId']: item['metadata']
+                      for item in db.bulk_load_events(utc_min=utc_min, utc_max=utc_max)}
+
     # Compile list of events into list of groups
     obs_groups = {}
     obs_group_ids = []
@@ -231,15 +233,8 @@ ORDER BY o.obsTime;
 
         # Fetch information about each observation in turn
         for item in obs_groups[group_info['groupId']]:
-            # Fetch metadata about this object, some of which might be on the file, and some on the observation
-            obs_obj = db.get_observation(observation_id=item['observationId'])
-            obs_metadata = {item.key: item.value for item in obs_obj.meta}
-            if item['repositoryFname']:
-                file_obj = db.get_file(repository_fname=item['repositoryFname'])
-                file_metadata = {item.key: item.value for item in file_obj.meta}
-            else:
-                file_metadata = {}
-            all_metadata = {**obs_metadata, **file_metadata}
+            # Metadata about this object, some of which might be on the file, and some on the observation
+            all_metadata = event_metadata.get(item['observationId'], {})
 
             # Project path from (x,y) coordinates into (RA, Dec)
             projector = PathProjection(
@@ -271,7 +271,7 @@ $pageTemplate->header($pageInfo);
                          data-start='<?php echo $metadata_by_key['pigazing:videoStart']; ?>'
                     >
                         <img class="video_path_marker" alt="" title="" src="/img/crosshair.gif"/>
-                        <video class="gallery_still_img" controls>
+                        <video class="gallery_still_img" controls preload="metadata">
                             <source src="<?php echo $file_url; ?>" type="video/mp4"/>
                             Your browser does not support the video tag.
                         </video>
@@ -279,7 +279,7 @@ $pageTemplate->header($pageInfo);
                 <?php else: ?>
                     <div class="gallery_still_img scrolling_text_container">
                         <?php
-                        $file_path = $const->datapath . $result['repositoryFname'];
+                        $file_path = $const->file_path($result['repositoryFname']);
                         if (file_exists($file_path)) echo htmlentities(file_get_contents($file_path));
                         ?>
                     </div>
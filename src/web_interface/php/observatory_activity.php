@@ -86,17 +86,18 @@ function get_activity_history($metaKey, $suffix, $url)
         $a = floor($tmin['utc'] / 86400) * 86400 + 43200 + $period * $count;
         $b = $a + $period;
         $count++;
+        // Days start at noon UTC, so they are made up of whole hours in archive_activityHourly
         $stmt = $const->db->prepare("
-SELECT COUNT(*) FROM archive_observations o
-INNER JOIN archive_observatories l ON o.observatory = l.uid
-INNER JOIN archive_semanticTypes s ON o.obsType = s.uid
-WHERE l.publicId=:o AND s.name=:k AND o.obsTime BETWEEN :x AND :y;");
+SELECT COALESCE(SUM(a.observationCount), 0) AS count FROM archive_activityHourly a
+INNER JOIN archive_observatories l ON a.observatory = l.uid
+INNER JOIN archive_semanticTypes s ON a.semanticType = s.uid
+WHERE l.publicId=:o AND s.name=:k AND a.hourIndex>=:x AND a.hourIndex<:y;");
         $stmt->bindParam(':o', $o, PDO::PARAM_STR, strlen($obstory));
         $stmt->bindParam(':k', $k, PDO::PARAM_STR, strlen($metaKey));
         $stmt->bindParam(':x', $x, PDO::PARAM_INT);
         $stmt->bindParam(':y', $y, PDO::PARAM_INT);
-        $stmt->execute(['o' => $obstory, 'k' => $metaKey, 'x' => $a, 'y' => $b]);
-        $items = $stmt->fetchAll()[0]['COUNT(*)'];
+        $stmt->execute(['o' => $obstory, 'k' => $metaKey, 'x' => $a / 3600, 'y' => $b / 3600]);
+        $items = $stmt->fetchAll()[0]['count'];
         if ($items > 0) {
             $tomorrow = $count + 1;
             $text = "<div style='height:55px;'>" .
@@ -43,6 +43,10 @@ class constants
         $this->path = realpath(dirname(__FILE__));
         $this->datapath = $this->path . "/../../../../datadir/db_filestore/";
 
+        // Files may be stored in subdirectories of the file store by date; see obsarchive/file_store.py
+        $layout_file = $this->datapath . ".layout";
+        $this->datapath_layout = file_exists($layout_file) ? trim(file_get_contents($layout_file)) : "flat";
+
         // Time we started execution
         $this->timeStart = microtime(True);
 
@@ -162,6 +166,7 @@ class constants
             "pigazing:width" => "Width of frame",
             "pigazing:videoDuration" => "Video duration",
             "pigazing:videoFPS" => "Video frames/second",
+            "pigazing:videoKeyframes" => "Video keyframe times and byte offsets",
             "pigazing:videoStart" => "Video start time",
             "plane:angular_offset" => "Aircraft: Angular mismatch (deg)",
             "plane:call_sign" => "Aircraft: call sign",
@@ -192,6 +197,17 @@ class constants
             "web:category" => "Identification: Object type"
         ];
     }
+
+    // Return the path of a file in the file store. While the file store is being migrated between layouts,
+    // files may be found in either place.
+    public function file_path($repository_fname)
+    {
+        $flat_path = $this->datapath . $repository_fname;
+        if (!preg_match('/^(\d{4})(\d{2})(\d{2})_/', $repository_fname, $date)) return $flat_path;
+        $date_path = $this->datapath . "{$date[1]}/{$date[2]}/{$date[3]}/" . $repository_fname;
+        if ($this->datapath_layout == "date") return file_exists($date_path) ? $date_path : $flat_path;
+        return file_exists($flat_path) ? $flat_path : $date_path;
+    }
 }
 
 $const = new constants();
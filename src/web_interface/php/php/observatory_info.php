@@ -68,25 +68,23 @@ ORDER BY obsTime DESC LIMIT 1;");
 
         // Total image count
         $stmt = $const->db->prepare("
-SELECT COUNT(*) FROM archive_observations o
-INNER JOIN archive_observatories l ON o.observatory = l.uid
-INNER JOIN archive_semanticTypes s ON o.obsType = s.uid
-WHERE l.publicId=:o AND s.name=\"pigazing:timelapse/\"
-ORDER BY obsTime DESC LIMIT 1;");
+SELECT COALESCE(SUM(a.observationCount), 0) AS count FROM archive_activityHourly a
+INNER JOIN archive_observatories l ON a.observatory = l.uid
+INNER JOIN archive_semanticTypes s ON a.semanticType = s.uid
+WHERE l.publicId=:o AND s.name=\"pigazing:timelapse/\";");
         $stmt->bindParam(':o', $o, PDO::PARAM_STR, strlen($obstory));
         $stmt->execute(["o" => $obstory]);
-        $image_count = $stmt->fetch()['COUNT(*)'];
+        $image_count = $stmt->fetch()['count'];
 
         // Moving object count
         $stmt = $const->db->prepare("
-SELECT COUNT(*) FROM archive_observations o
-INNER JOIN archive_observatories l ON o.observatory = l.uid
-INNER JOIN archive_semanticTypes s ON o.obsType = s.uid
-WHERE l.publicId=:o AND s.name=\"pigazing:movingObject/\"
-ORDER BY obsTime DESC LIMIT 1;");
+SELECT COALESCE(SUM(a.observationCount), 0) AS count FROM archive_activityHourly a
+INNER JOIN archive_observatories l ON a.observatory = l.uid
+INNER JOIN archive_semanticTypes s ON a.semanticType = s.uid
+WHERE l.publicId=:o AND s.name=\"pigazing:movingObject/\";");
         $stmt->bindParam(':o', $o, PDO::PARAM_STR, strlen($obstory));
         $stmt->execute(["o" => $obstory]);
-        $moving_count = $stmt->fetch()['COUNT(*)'];
+        $moving_count = $stmt->fetch()['count'];
 
         return [
             "moving_count" => $moving_count,
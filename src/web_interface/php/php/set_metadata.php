@@ -49,6 +49,7 @@ function set_metadata($key, $value, $time, $uid, $column)
 {
     global $const, $user;
 
+    $meta_key = $key;
     $meta_id = get_metadata_key_id($key);
     $stringValue = $floatValue = null;
     if (is_numeric($value)) $floatValue = floatval($value);
@@ -65,7 +66,10 @@ WHERE m.{$column}=:i AND m.fieldId=:k;");
     $stmt->bindParam(':i', $i, PDO::PARAM_INT);
     $stmt->bindParam(':k', $k, PDO::PARAM_INT);
     $stmt->execute(['i' => $uid, 'k' => $meta_id]);
-    if ($value == null) return;
+    if ($value == null) {
+        update_event_summary($meta_key, $uid, $column);
+        return;
+    }
     $stmt = $const->db->prepare("
 INSERT INTO archive_metadata ({$column}, fieldId, publicId, time, setAtTime, setByUser, stringValue, floatValue)
 VALUES (:i,:k,:p,:t,:st,:u,:sv,:fv);");
@@ -86,4 +90,21 @@ VALUES (:i,:k,:p,:t,:st,:u,:sv,:fv);");
         'sv' => $stringValue,
         'fv' => $floatValue
     ]);
+    update_event_summary($meta_key, $uid, $column);
+}
+
+// Keep the denormalised table archive_event_summary in step with edits made via the web interface. Of the fields it
+// holds, only web:category is ever edited here.
+function update_event_summary($key, $uid, $column)
+{
+    global $const;
+    if (($key != "web:category") || ($column != "observationId")) return;
+
+    $stmt = $const->db->prepare("
+UPDATE archive_event_summary e
+SET e.category=(SELECT m.stringValue FROM archive_metadata m WHERE m.observationId=e.observationId AND m.fieldId=:k)
+WHERE e.observationId=:i;");
+    $stmt->bindParam(':i', $i, PDO::PARAM_INT);
+    $stmt->bindParam(':k', $k, PDO::PARAM_INT);
+    $stmt->execute(['i' => $uid, 'k' => get_metadata_key_id($key)]);
 }